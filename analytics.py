@@ -0,0 +1,96 @@
+"""
+Analytics of a selection as plain data.
+
+The numbers behind the dashboard panels: top ports, barge ages, the summary of
+the top port, the trimmed service and waiting distributions, the Brent price
+and the operations series. Each function takes the query backend (or the time
+series store) and a FilterState and returns a dict of lists, numpy arrays and
+numbers, no components or figures. The panel builders of app.py render them and
+api.py serves them as JSON.
+"""
+import numpy as np
+
+##Ports with fewer operations in a selection are left out of the distributions
+MIN_SAMPLE=30
+##Quantile of the trimmed distributions and means
+TRIM=0.95
+##Waiting times above it are drawn at it
+WAITING_CLIP=13
+
+def ranking(backend,state,top=5):
+    '''Ports with most operations
+    Input:
+        backend; query backend (backends.py)
+        state; FilterState
+        top; ports returned
+    Returns. Dict with port (names), ops, percentage (of total) and total'''
+    port_count=backend.port_counts(state)
+    total=int(port_count.sum())
+    port_count=port_count.iloc[:top]
+    return dict(port=port_count.index.tolist(),ops=port_count.values.astype("int64"),
+                percentage=port_count.values/total*100 if total else np.zeros(len(port_count)),total=total)
+
+def barge_ages(backend,state,width=2):
+    '''Operations per barge age bin
+    Input:
+        backend; query backend
+        state; FilterState
+        width; bin width in years
+    Returns. Dict with start (bin starts, years) and ops'''
+    starts,ops=backend.age_histogram(state,width)
+    return dict(start=np.asarray(starts),ops=np.asarray(ops))
+
+def summary(backend,state,q=TRIM):
+    '''Summary of the top port. The top port is picked on the dates and ports only, then
+    the vessel type and GT filters apply
+    Input:
+        backend; query backend
+        state; FilterState
+        q; quantile of the trimmed service and waiting means
+    Returns. Dict with code, name, ops, age (mean barge age, years), service and waiting (hours).
+        code None without operations'''
+    count=backend.code_counts(state._replace(type_vessel=("full",),size=("full",)))
+    if not len(count):
+        return dict(code=None,name=None,ops=0,age=np.nan,service=np.nan,waiting=np.nan)
+    code=count.idxmax()
+    return dict(backend.port_stats(state,code,q),code=code)
+
+def distribution(backend,state,graph="service",q=TRIM):
+    '''Densities of the service or waiting times of every port of a selection, each port trimmed
+    to its q quantile. Waiting times above WAITING_CLIP hours count at WAITING_CLIP
+    Input:
+        backend; query backend
+        state; FilterState
+        graph; service or waiting
+        q; quantile kept
+    Returns. Dict with port (names with at least MIN_SAMPLE operations, most operations first), x and y
+        (hours and density of every port, over the range of its times) and excluded (names with fewer)'''
+    if graph not in ("service","waiting"):
+        raise ValueError("graph is service or waiting")
+    port_count=backend.port_counts(state)
+    labels=port_count.index[port_count.values>=MIN_SAMPLE].tolist()
+    excluded=port_count.index[port_count.values<MIN_SAMPLE].tolist()
+    if not labels:
+        return dict(port=[],x=[],y=[],excluded=excluded)
+    grid,density,bounds=backend.grouped_kde(state,graph+"_time",labels,q,WAITING_CLIP if graph=="waiting" else None)
+    return dict(port=labels,x=[grid[lo:hi] for lo,hi in bounds],
+                y=[density[i,lo:hi] for i,(lo,hi) in enumerate(bounds)],excluded=excluded)
+
+def brent(series,state):
+    '''Daily Brent prices of the dates of a selection
+    Input:
+        series; SeriesStore (series.py)
+        state; FilterState
+    Returns. Dict with date (datetime64[D]) and price'''
+    table=series.brent(state.date_from,state.date_to,"D")
+    return dict(date=table.index.values.astype("datetime64[D]"),price=table.close.values)
+
+def rollup(series,state,resolution="W"):
+    '''Operations, mean service and waiting times and Brent prices per period of the dates of a selection
+    Input:
+        series; SeriesStore
+        state; FilterState
+        resolution; D, W or M
+    Returns. Dict of columns, period (start days) first'''
+    table=series.table(state.date_from,state.date_to,resolution)
+    return dict(period=table.index.values.astype("datetime64[D]"),**{col:table[col].values for col in table})
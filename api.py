@@ -0,0 +1,171 @@
+"""
+Versioned JSON API of the analytics (analytics.py), for other services.
+
+    GET  /api/v1                    queries, their parameters and the dataset version
+    GET  /api/v1/<query>?<filters>  one query
+    POST /api/v1/batch              {"queries": [{"query": <name>, <filters>}, ...]}, answered in order
+
+The filters are those of /export (fr, to, port, type, size, see
+filters.query_filters) plus the parameters of every query. An answer only
+depends on the dataset version and the normalized query, so its ETag is known
+before anything is computed: a client sending it back in If-None-Match gets a
+304 Not Modified until new operations are appended. Identical queries arriving
+together are computed once (coalesce.SingleFlight). Arrays are JSON lists,
+dates YYYY-MM-DD strings and missing numbers null.
+"""
+import hashlib
+import json
+import flask
+import numpy as np
+import analytics
+from coalesce import SingleFlight
+from figcache import FigureCache
+from series import RESOLUTIONS
+
+VERSION="v1"
+##Queries of one batch at most
+MAX_BATCH=32
+
+def _positive(value):
+    value=int(value)
+    if value<1:
+        raise ValueError("{} is not a positive integer".format(value))
+    return value
+
+def _choice(values):
+    def parse(value):
+        if value not in values:
+            raise ValueError("{} is one of {}".format(value,", ".join(values)))
+        return value
+    return parse
+
+##Query: function of (dataset, FilterState, parameters), parameters {name: (parse, default)}
+QUERIES={"ranking":(lambda data,state,top: analytics.ranking(data.backend,state,top),dict(top=(_positive,5))),
+         "summary":(lambda data,state: analytics.summary(data.backend,state),{}),
+         "barge_ages":(lambda data,state,width: analytics.barge_ages(data.backend,state,width),dict(width=(_positive,2))),
+         "distribution":(lambda data,state,graph: analytics.distribution(data.backend,state,graph),
+                         dict(graph=(_choice(["service","waiting"]),"service"))),
+         "brent":(lambda data,state: analytics.brent(data.series,state),{}),
+         "rollup":(lambda data,state,resolution: analytics.rollup(data.series,state,resolution),
+                   dict(resolution=(_choice(list(RESOLUTIONS)),"W")))}
+
+def plain(value):
+    '''JSON ready copy of an analytics answer: lists for arrays, dates as days, None for NaN'''
+    if isinstance(value,dict):
+        return {str(k):plain(v) for k,v in value.items()}
+    if isinstance(value,(list,tuple)):
+        return [plain(i) for i in value]
+    if isinstance(value,np.ndarray):
+        if np.issubdtype(value.dtype,np.datetime64):
+            return np.datetime_as_string(value.astype("datetime64[D]")).tolist()
+        return plain(value.tolist())
+    if isinstance(value,np.generic):
+        return plain(value.item())
+    if isinstance(value,float) and not np.isfinite(value):
+        return None
+    return value
+
+def etag(version,keys):
+    '''ETag of the answers of queries on a dataset version'''
+    return hashlib.sha1("|".join([VERSION,version]+keys).encode()).hexdigest()[:24]
+
+class Api:
+    '''Query parsing and coalescing of the API
+    Input:
+        filters; function of an argument getter returning a FilterState (filters.query_filters)'''
+    def __init__(self,filters):
+        self.filters=filters
+        self._flight=SingleFlight()
+
+    def parse(self,name,values):
+        '''Normalized query
+        Input:
+            name; query name
+            values; function of an argument name returning its list of strings
+        Returns. (name, FilterState, parameters, key). KeyError for an unknown query, ValueError
+            for wrong filters or parameters'''
+        if name not in QUERIES:
+            raise KeyError(name)
+        state=self.filters(values)
+        params={}
+        for param,(parse,default) in QUERIES[name][1].items():
+            given=values(param)
+            params[param]=parse(given[0]) if given else default
+        key=FigureCache.key("{}:{}".format(name,sorted(params.items())),state)
+        return name,state,params,key
+
+    def answer(self,data,query):
+        '''Answer of a parsed query on a dataset, computed once for concurrent requests'''
+        name,state,params,key=query
+        value,_=self._flight.do(data.version+"|"+key,lambda: plain(QUERIES[name][0](data,state,**params)))
+        return value
+
+def _respond(tag,body=None):
+    ##JSON response with its ETag, 304 Not Modified without a body
+    if body is None:
+        response=flask.Response(status=304)
+    else:
+        response=flask.Response(json.dumps(body,separators=(",",":")),mimetype="application/json")
+    response.set_etag(tag)
+    response.headers["Cache-Control"]="no-cache"
+    return response
+
+def _error(message,status):
+    return flask.jsonify(error=message),status
+
+def install(server,pin,filters):
+    '''Adds the /api/v1 routes to a Flask server
+    Input:
+        server; Flask app
+        pin; context manager giving the dataset of a request (app.pin)
+        filters; function of an argument getter returning a FilterState'''
+    api=Api(filters)
+    prefix="/api/"+VERSION
+
+    @server.route(prefix)
+    def api_index():
+        with pin() as data:
+            return flask.jsonify(version=VERSION,dataset=data.version,batch=MAX_BATCH,
+                                 queries={name:sorted(params) for name,(_,params) in QUERIES.items()})
+
+    @server.route(prefix+"/<name>")
+    def api_query(name):
+        try:
+            query=api.parse(name,flask.request.args.getlist)
+        except KeyError:
+            return _error("unknown query {}".format(name),404)
+        except ValueError as error:
+            return _error(str(error),400)
+        with pin() as data:
+            tag=etag(data.version,[query[3]])
+            if flask.request.if_none_match.contains_weak(tag):
+                return _respond(tag)
+            return _respond(tag,dict(dataset=data.version,query=name,data=api.answer(data,query)))
+
+    @server.route(prefix+"/batch",methods=["POST"])
+    def api_batch():
+        body=flask.request.get_json(silent=True)
+        queries=body.get("queries") if isinstance(body,dict) else None
+        if not isinstance(queries,list) or not all(isinstance(i,dict) for i in queries):
+            return _error("body is {\"queries\": [{\"query\": <name>, <filters>}, ...]}",400)
+        if len(queries)>MAX_BATCH:
+            return _error("at most {} queries".format(MAX_BATCH),400)
+        parsed=[]
+        for values in queries:
+            def getlist(name,values=values):
+                value=values.get(name)
+                return [] if value is None else (value if isinstance(value,list) else [value])
+            try:
+                parsed.append(api.parse(str(values.get("query")),getlist))
+            except KeyError as error:
+                parsed.append("unknown query {}".format(error.args[0]))
+            except ValueError as error:
+                parsed.append(str(error))
+        with pin() as data:
+            tag=etag(data.version,[i[3] if isinstance(i,tuple) else "error:"+i for i in parsed])
+            if flask.request.if_none_match.contains_weak(tag):
+                return _respond(tag)
+            results=[dict(query=i[0],data=api.answer(data,i)) if isinstance(i,tuple) else dict(error=i)
+                     for i in parsed]
+            return _respond(tag,dict(dataset=data.version,results=results))
+    return api
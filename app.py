@@ -1,721 +1,1061 @@
-"""
-Created on Tue May 26 21:58:04 2020
-
-Author: Gabriel Fuentes Lezcano
-"""
-import pandas as pd
-import dash
-import dash_html_components as html
-import dash_core_components as dcc
-from dash.dependencies import Input, Output
-import plotly.figure_factory as ff
-import plotly.graph_objects as go
-from datetime import datetime as dt
-import numpy as np
-from random import shuffle
-import os
-import math
-
-MAPBOX_TOKEN=os.environ.get('MAPBOX_TOKEN', None)
-
-valid_colors=["#CF5C60","#717ECD","#4AB471","#F3AE4E","#D96383","#4EB1CB"]
-shuffle(valid_colors)
-
-##Databases
-####
-df = pd.read_csv('data/bunkering_ops_mediterranean.csv', parse_dates=True)
-df["start_of_service"]=pd.to_datetime(df["start_of_service"])
-df["vessel_inside_port"]=pd.to_datetime(df["vessel_inside_port"])
-##Sentence case
-df["bunkering_port"]=df.bunkering_port.str.title()
-# ##Remove the ports with less than 30 observations
-test=df.bunkering_port.value_counts().reset_index()
-df=df[df.bunkering_port.isin(test["index"][test.bunkering_port>30])].reset_index(drop=True)
-
-
-brent_df=pd.read_csv("data/brent-daily.csv")
-brent_df["Date"]=pd.to_datetime(brent_df["Date"])
-
-ports_positions=pd.read_csv('data/ports_positions.csv')
-
-##Waiting time generation and barge age
-df=df.assign(waiting_time=df.start_of_service-df.vessel_inside_port,
-              barge_age_at_op=df.start_of_service[0].year-df.BargeBuilt)
-##False values
-df=df[df.barge_age_at_op>0]
-
-df["waiting_time"]=df.waiting_time/np.timedelta64(1,"h")
-
-barges=df.sort_values(by=["start_of_service"]).drop_duplicates(subset=["barge_imo"],keep="last").copy()
-
-##Service time and Waiting time function
-def stats_graph(graph="service",fr="01-01-2014",to="01-06-2019",port=["full"],
-                type_vessel=["full"],size=["full"],*args):  
-    '''Generates a plotly graph to be used in dash
-    Input: 
-        fr; From date (datetime dd-mm-YYYY). Default 01-01-2014
-        to; To date (datetime dd-mm-YYYY)
-        graph; type of graph, from service or waiting
-        port; ports filter. Full has all the ports higher than 100 observations
-        Returns. Plotly Graph'''
-    date_from=pd.to_datetime(fr)
-    date_to=pd.to_datetime(to)
-    
-    df_in=df[df.start_of_service.between(date_from,date_to)].copy()
-    if "full" not in type_vessel:
-        df_in=df_in[df_in.ConType.isin(type_vessel)]
-    if "full" not in size:
-        df_in=df_in[(df_in.VesselGT>size[0])&(df_in.VesselGT<=size[1])]
-        
-    if "full" in port:
-        summary=df_in.bunkering_port.value_counts().reset_index().rename(columns={"index":"bunkering_port","bunkering_port":"count"})
-    else:
-        summary=df_in.bunkering_port[df_in.code.isin(port)].value_counts().reset_index().rename(columns={"index":"bunkering_port","bunkering_port":"count"})
-      
-    not_valid=summary[summary["count"]<30]
-    summary=summary[summary["count"]>=30]    
-    
-    if summary.shape[0]==0:
-        if graph=="service":
-            modal_ex=html.Div([# modal div
-                          html.Div([html.H4("Not enough sample to build distributions. Adjust your selection.",
-                                            style={"margin-top":"12vh","color":"black",'textAlign': 'center',"font-size":"20px","top":"20%" })],className='modal-content'),
-                          html.Button('Close', id='modal-close-button',className="button-modal")
-                          ],id='modal',className='modal')
-            return [modal_ex]
-    else:
-        hist_times=[]
-        times_labels=[]
-        for n in summary["bunkering_port"].unique().tolist():
-            df_iter=df_in[df_in.bunkering_port=="{}".format(n)].copy()
-            if graph=="service":
-                #Outliers remove
-                df_iter=df_iter[df_iter.service_time<=df_iter.service_time.quantile(0.95)]
-                hist_times.append(df_iter.service_time.tolist())
-            elif graph=="waiting":
-                ##Outlier remove
-                df_iter=df_iter[df_iter.waiting_time<=df_iter.waiting_time.quantile(0.95)]
-                ##After 12 hours for waiting time replaced by 12 hours
-                df_iter["waiting_time"]=np.where(df_iter.waiting_time>13,13,df_iter.waiting_time)
-                hist_times.append(df_iter.waiting_time.tolist())          
-            times_labels.append(n)
-            
-        fig_service= ff.create_distplot(hist_times, times_labels, colors=valid_colors[0:summary.shape[0]],histnorm='kde',show_rug=False, show_hist=False)
-        
-        ##Dict of annotations change for value of >9
-        annotations_variable={"service":dict(x=0.93,y=-0.19,showarrow=False,text="Hours",xref="paper",yref="paper"),
-                                  "waiting":dict(x=1.0,y=-0.19,showarrow=False,text=">13",xref="paper",yref="paper")}
-                
-        if graph=="service":
-            annotations_variable=[annotations_variable.get("service")]
-        elif graph=="waiting":
-            annotations_variable=[annotations_variable.get("service"),annotations_variable.get("waiting")]
-        ##Graphs layout + axis title as annotation
-        fig_service.update_layout({"plot_bgcolor": "rgba(0, 0, 0, 0)",
-                                    "paper_bgcolor": "rgba(0, 0, 0, 0)"},
-                                      showlegend=False,
-                                      margin=dict(l=0,r=0,b=0,t=0),
-                                      font=dict(family="Open Sans Light",size=12,color="#d8d8d8"),
-                                      annotations=annotations_variable)         
-        ##Axes colors                          
-        fig_service.update_xaxes(showline=True, zerolinewidth=1, zerolinecolor='white',gridcolor="rgba(255,255,255,0.05)")
-        fig_service.update_yaxes(automargin=True,rangemode="tozero",showline=True, zerolinewidth=1, zerolinecolor='white',gridcolor="rgba(255,255,255,0.05)")     
-        ##Line colors and plot 
-        ##Layout for 1 record
-        if summary.shape[0]==1:
-            fig_service.update_layout({'hoverlabel':{'bgcolor':'rgb(223, 232, 243)'}})
-                                       
-            if graph=="service":   
-                fig_service.update_traces(hovertemplate='Hours: %{x:.1f}<extra></extra>',marker=dict(color="#F3AE4E"),fill="tozeroy",line=dict(width=3))               
-            elif graph=="waiting":
-                fig_service.update_traces(hovertemplate='Hours: %{x:.1f}<extra></extra>',marker=dict(color="#4ABA71"),fill="tozeroy",line=dict(width=3))
-        
-        ##Layout for more than 1 record
-        elif summary.shape[0]>1 and summary.shape[0]<=5:      
-            fig_service.update_layout({'hoverlabel':{'bgcolor':'rgb(223, 232, 243)'}},
-                                      showlegend=True)
-            ##Hovertext and hovertemplate
-            fig_service.update_traces(hovertemplate='Hours: %{x}<extra></extra>')
-            if graph=="service":                  
-                fig_service.update_traces(fill="tozeroy",line=dict(width=1))               
-            elif graph=="waiting":
-                fig_service.update_traces(fill="tozeroy",line=dict(width=1))
-        
-        ##Separate returns as to provide differents id's, Header and modal if needed.
-        if graph=="service":                                           
-            fig_service_ex=dcc.Graph(id='service',
-                                      config={'displayModeBar': False},
-                                      animate=False,
-                                      figure=fig_service,
-                                      style={"height": "22vh","width" : "100%","display": "block",'align-items': 'stretch'})
-            ##If a port was removed from selectin then inform user
-            if not_valid.shape[0]!=0:
-                ##Ordered list of div for modal.
-                ports_list_div=[html.H4("{};".format(i),style={"color":"black",'textAlign': 'center',"font-size":"16px","top":"20%" }) for i in not_valid.bunkering_port]
-                header_mod=[html.H3('The following port(s) are not included to the graph (small sample):',
-                                    style={"color":"black",'textAlign': 'center',"font-size":"20px","top":"20%" })]
-                not_valid_list=header_mod+ports_list_div
-                modal_ex=html.Div([# modal div
-                               html.Div(not_valid_list,className='modal-content'),
-                               html.Button('Close', id='modal-close-button',className="button-modal")
-                                ],id='modal',style={'textAlign': 'center', },className='modal')
-                return [html.H2("Service time"),fig_service_ex, modal_ex]
-            else:
-                modal_ex=html.Div([html.Button('Close', id='modal-close-button',className="button-modal")
-                                ],id='modal',className='modal-fake')
-    
-                return [html.H2("Service time"),fig_service_ex,modal_ex]
-               
-        elif graph=="waiting":
-            fig_service_ex=dcc.Graph(id='waiting',
-                                      config={'displayModeBar': False},
-                                      animate=False,
-                                      figure=fig_service,
-                                      style={"height": "22vh","width" :"100%","display": "block",'align-items': 'stretch'})
-                   
-            return [html.H2("Waiting time"),fig_service_ex]
-        
-def ranking(fr="01-01-2014",to="01-06-2019",port=["full"],type_vessel=["full"],
-            size=["full"],*args): 
-    '''Generates a ranking of ports to be used in dash
-    Input: 
-        fr; From date (datetime dd-mm-YYYY). Default 01-01-2014
-        to; To date (datetime dd-mm-YYYY)
-        port; ports filter. Full has all the ports higher than 100 observations
-        type_vessel. Full as it includes all the vessel
-        Returns. Plotly Graph'''
-        
-        ##Datetime
-    date_from=pd.to_datetime(fr)
-    date_to=pd.to_datetime(to)
-        
-    df_in=df[df.start_of_service.between(date_from,date_to)].copy()
-    
-    #Filters
-    if "full" not in port:
-        df_in=df_in[df_in.code.isin(port)]
-    if "full" not in type_vessel:
-        df_in=df_in[df_in.ConType.isin(type_vessel)]
-        
-    if "full" not in size:
-        df_in=df_in[(df_in.VesselGT>size[0])&(df_in.VesselGT<=size[1])]
-    
-    port_count=df_in.bunkering_port.value_counts().reset_index().rename(columns={"index":'bunkering_port',"bunkering_port":"ops"})
-    ##Percentage
-    port_count=port_count.assign(percentage=(port_count.ops/df_in.shape[0])*100).reset_index().rename(columns={"index":'number'})
-    port_count["number"]=port_count["number"]+1
-    
-    ##Get top 5
-    port_count=port_count[port_count.number<=5]
-    
-    ##Graph construction and hovertext
-    fig_ranking = go.Figure(go.Bar(
-            x=port_count.percentage,
-            y=port_count.number,
-            text=port_count.bunkering_port.str.title(),
-            hovertext=port_count.ops,
-            hovertemplate='Operations: %{hovertext}. Perc: %{x:.2f}<extra></extra>',
-            orientation='h'))
-    
-    ##Graphs layout
-    fig_ranking.update_layout({"plot_bgcolor": "rgba(0, 0, 0, 0)",
-                                "paper_bgcolor": "rgba(0, 0, 0, 0)",
-                                'hoverlabel':{'bgcolor':'rgb(223, 232, 243)'}},
-                              showlegend=False,
-                              margin=dict(l=0,r=0,b=0,t=0),
-                              font=dict(family="Open Sans Light",size=12,color="#d8d8d8"),
-                              annotations=[dict(x=0.93,y=-0.1,showarrow=False,text="%",xref="paper",yref="paper")])
-    
-    #X axis
-    fig_ranking.update_xaxes(showline=True,gridcolor="rgba(255,255,255,0.05)")
-    ##Y axis
-    fig_ranking.update_xaxes(showline=False)
-    ##Plots + text
-    fig_ranking.update_traces(marker_color="#717ecd", marker_line_color='black',
-                  marker_line_width=0.5,textposition='auto',
-                  textfont_family="Open Sans Light",textfont_color="#d8d8d8")
-    ##Axes colors                          
-    fig_ranking.update_yaxes(autorange="reversed")    
-    ##DCC Graph
-    fig_ranking_ex=dcc.Graph(id='ranking',
-                              config={'displayModeBar': False},
-                              animate=False,
-                              figure=fig_ranking,
-                              style={"height": "37vh","width" : "100%","display": "block",'align-items': 'stretch'})
-    
-    return [html.H2("Top 5 ports"),fig_ranking_ex]
-      
-def barges(fr="01-01-2014",to="01-06-2019",port=["full"],type_vessel=["full"],
-           size=["full"],*args):  
-    '''Works the age at ops density of barges
-    Input: 
-        fr; From date (datetime dd-mm-YYYY). Default 01-01-2014
-        to; To date (datetime dd-mm-YYYY)
-        port; ports filter. Full has all the ports higher than 100 observations
-        type_vessel. Full as it includes all the vessel
-        Returns. Plotly Graph'''
-        
-    ##Datetime
-    date_from=pd.to_datetime(fr)
-    date_to=pd.to_datetime(to)
-        
-    df_in=df[df.start_of_service.between(date_from,date_to)].copy()
-
-    #Filters
-    if "full" not in port:
-        df_in=df_in[df_in.code.isin(port)]
-    if "full" not in type_vessel:
-        df_in=df_in[df_in.ConType.isin(type_vessel)]
-        
-    if "full" not in size:
-        df_in=df_in[(df_in.VesselGT>size[0])&(df_in.VesselGT<=size[1])]   
-        
-    ##Graph construction, hovertext and bin setting
-    fig_barges = go.Figure(data=[go.Histogram(x=df_in.barge_age_at_op,xbins=dict(size=2),
-                                              marker_color="#CF5C60",marker_line_width=1,
-                                              hovertemplate='Age: %{x}. Observations: %{y}<extra></extra>')])
-    
-    ##Graphs layout
-    fig_barges.update_layout({"plot_bgcolor": "rgba(0, 0, 0, 0)",
-                                "paper_bgcolor": "rgba(0, 0, 0, 0)",
-                                'hoverlabel':{'bgcolor':'rgb(223, 232, 243)'}},
-                              showlegend=False,
-                              margin=dict(l=0,r=0,b=0,t=0),
-                              font=dict(family="Open Sans Light",size=12,color="#d8d8d8"),
-                              annotations=[dict(x=0.93,y=-0.09,showarrow=False,text="Years",xref="paper",yref="paper")])
-    #Y axis
-    fig_barges.update_yaxes(showline=True,gridcolor="rgba(255,255,255,0.05)")
-    ##DCC Graph
-    fig_barges_ex=dcc.Graph(id='barges_age',
-                              config={'displayModeBar': False},
-                              animate=False,
-                              figure=fig_barges,
-                              style={"height": "37vh","width" : "100%","display": "block",'align-items': 'stretch'})
-    
-    return [html.H2("Barge age at operation"),fig_barges_ex]
-
-def brent(fr="01-01-2014",to="01-06-2019"):
-    '''Brent graph
-    Input: 
-        fr; From date (datetime dd-mm-YYYY). Default 01-01-2014
-        to; To date (datetime dd-mm-YYYY)
-        Returns. Plotly Graph'''
-        
-    ##Datetime
-    date_from=pd.to_datetime(fr)
-    date_to=pd.to_datetime(to)
-        
-    df_in=brent_df[brent_df.Date.between(date_from,date_to)].copy()  
-    #Graph construction
-    figure_brent=go.Figure([go.Scatter(x=df_in['Date'], y=df_in['Price'],
-                                        marker_color="#2A94D6")])
-      ##Graphs layout
-    figure_brent.update_layout({"plot_bgcolor": "rgba(0, 0, 0, 0)",
-                                "paper_bgcolor": "rgba(0, 0, 0, 0)",
-                                'hoverlabel':{'bgcolor':'rgb(223, 232, 243)'}},
-                              showlegend=False,
-                              margin=dict(l=0,r=0,b=0,t=0),
-                              font=dict(family="Open Sans Light",size=12,color="#d8d8d8"))
-    
-    
-    #Y axis
-    figure_brent.update_yaxes(gridcolor="rgba(255,255,255,0.05)")
-    #X axis
-    figure_brent.update_xaxes(gridcolor="rgba(255,255,255,0.05)")
-    
-    ##DCC Graph
-    fig_brent_ex=dcc.Graph(id='brent',
-                              config={'displayModeBar': False},
-                              animate=False,
-                              figure=figure_brent,
-                              style={"height": "22vh","width" : "100%","display": "block",'align-items': 'stretch'})
-    
-    return [html.H2("Brent price"),fig_brent_ex]
-
-def bunker_map(port=["full"],*args):
-    ports_positions_in=ports_positions[ports_positions.PortCode.isin(df.code.unique())][["BE PORT_NA","PortCode","Lat","Long"]].reset_index(drop=True).copy()
-    ports_positions_in=ports_positions_in.assign(colors='#CF5C60')
-    if "full" not in port:
-        ports_positions_in["colors"]=np.where(ports_positions_in.PortCode.isin(port),"#F3AE43",
-                                              ports_positions_in["colors"])  
-
-    ##Maps construction
-    map_data=go.Figure(go.Scattermapbox(lat=ports_positions_in.Lat, lon=ports_positions_in.Long,
-                        mode="markers",hovertext=ports_positions_in["BE PORT_NA"],selectedpoints=[],
-                        selected={'marker':{'color': '#F3AE4E'}},
-                        text=ports_positions_in.PortCode,hovertemplate='%{hovertext}<extra></extra>',
-                        marker=go.scattermapbox.Marker(size=12,color=ports_positions_in.colors,opacity=None))) 
-       
-    center_map=dict(lat=37.00,lon=18.00)
-    zoom_map=3
-    
-    ##Map prueba
-    #map_data.update_layout({"plot_bgcolor": "rgba(0, 0, 0, 0)",
-    #                           "paper_bgcolor": "rgba(0, 0, 0, 0)",
-     #                           'hoverlabel':{'bgcolor':'rgb(223, 232, 243)'}},
-      #                      margin=dict(l=0,r=0,b=0,t=0),
-       #                     autosize=True,hovermode='closest',
-        #                    mapbox_style="white-bg",clickmode="event+select",
-         #                   mapbox=dict(bearing=0,
-          #                              center=center_map,zoom=zoom_map))
-     #Map layout 
-    map_data.update_layout({"plot_bgcolor": "rgba(0, 0, 0, 0)",
-                                 "paper_bgcolor": "rgba(0, 0, 0, 0)",
-                                 'hoverlabel':{'bgcolor':'rgb(223, 232, 243)'}},
-                             margin=dict(l=0,r=0,b=0,t=0),
-                             autosize=True,hovermode='closest',clickmode="event+select",
-                             mapbox_style='mapbox://styles/gabrielfuenmar/ckaocvlug34up1iqvowltgs5p',
-                             mapbox=dict(bearing=0,accesstoken=MAPBOX_TOKEN,
-                                         center=center_map,zoom=zoom_map))
-
-
-    #DCC Graph
-    map_data_ex=dcc.Graph(id='map',                            
-                              animate=True,
-                              figure=map_data,
-                              style={"height": "55vh","width" : "100%","display": "block",'align-items': 'stretch'})
-    
-    return [map_data_ex]
-    
-
-##Dropdown and filters
-def header_dropdown():
-        port_dropdown=dcc.Dropdown(id='ports-dropdown',
-        options=[{'label': row["bunkering_port"].title(),'value': row["code"]} \
-        for index,row in df.drop_duplicates(subset=["bunkering_port"]).iterrows()],
-        placeholder="Port/s (max 5)",multi=True)
-        
-    
-        type_dropdown=dcc.Dropdown(id='types-dropdown',
-        options=[{'label': row.title(),'value': row} \
-        for row in df.dropna(subset=["ConType"]).ConType.unique()],
-        placeholder="Vessel type(s)",multi=True)
-    
-        date_start=dcc.DatePickerSingle(
-        id='date-picker-start',
-        min_date_allowed=dt(2014, 1, 1),
-        max_date_allowed=dt(2019, 6, 1),
-        initial_visible_month=dt(2014, 1, 1),
-        display_format='DD-MM-YYYY',
-        placeholder="01-01-2014")
-
-        date_end=dcc.DatePickerSingle(
-        id='date-picker-end',
-        min_date_allowed=dt(2014, 1, 1),
-        max_date_allowed=dt(2019, 6, 1),
-        initial_visible_month=dt(2019, 6, 1),
-        display_format='DD-MM-YYYY',
-        placeholder="01-06-2019")
-        
-        return [html.H1("BUNKER ANALYTICS"),html.Div([date_start,date_end,
-                                                      port_dropdown,type_dropdown],className="box"),               
-                                              html.Div([html.Button("Refresh",id="update-button"),
-                                              html.A(html.Button("Home",id="home-button"),
-                                                       href="http://gabrielfuentes.org")])]
-
-
-
-##Summary container. Expected in a future to be the real time prices from API
-def summary(fr="01-01-2014",to="01-06-2019",port=["full"],type_vessel=["full"],
-            size=["full"],*args):
-        '''Summary of top port
-    Input: 
-        fr; From date (datetime dd-mm-YYYY). Default 01-01-2014
-        to; To date (datetime dd-mm-YYYY)
-        port: top port code
-        type_vessel: type of vessel
-    Returns. 
-        Plotly Graph + slider'''
-        
-        ##Datetime
-        
-        date_from=pd.to_datetime(fr)
-        date_to=pd.to_datetime(to)
-        df_in=df[df.start_of_service.between(date_from,date_to)].copy()
-        
-        if "full" not in port:
-            df_in=df_in[df_in.code.isin(port)]
-            top_port=df_in.code.value_counts().idxmax()
-            df_in=df_in[df_in.code==top_port]
-            
-        else:
-            top_port=df_in.code.value_counts().idxmax()
-            df_in=df_in[df_in.code==top_port]
-        
-        if "full" not in type_vessel:
-            df_in=df_in[df_in.ConType.isin(type_vessel)]
-        
-        if "full" not in size:
-            df_in=df_in[(df_in.VesselGT>size[0])&(df_in.VesselGT<=size[1])]
-                      
-        port_name=df_in.bunkering_port.iloc[0]
-        
-        ###Summary filter
-        operations="{:,}".format(df_in.shape[0])
-        age="{:,.1f} years".format(df_in.barge_age_at_op.mean())
-        waiting="{:,.1f} hours".format(df_in[df_in.waiting_time<=df_in.waiting_time.quantile(0.95)].waiting_time.mean())
-        service="{:,.1f} hours".format(df_in[df_in.service_time<=df_in.service_time.quantile(0.95)].service_time.mean())
-                
-        return html.Div([html.Div(html.H5("{}".format(port_name))),
-                     html.Div([html.Div([html.H3("Operations"),html.H4(operations)]),
-                     html.Div([html.H3("Service Time"),html.H4(service)]),
-                     html.Div([html.H3("WaitingTime"),html.H4(waiting)]),
-                     html.Div([html.H3("Barges Age"),html.H4(age)])],className="box-summary2")]
-                    ,className="box-summary",id="summary")
-                
-                
-##At the top we put another filter, the GT slider
-##Rounded to the closest 20
-min_val=1000
-max_val=220000
-step=int((max_val-min_val)/10)
-list_of_marks=list(range(min_val,max_val,step))
-marks={i:{"label":"{:,}".format(i),'style': {'color': '#d8d8d8'}} for i in list_of_marks}
-slider=dcc.RangeSlider(id="range-slider",min=list_of_marks[0],max=list_of_marks[-1],marks=marks,
-                step=step,value=[min_val,max_val],allowCross=False)       
-
- 
-# Initialise the app
-app = dash.Dash(__name__,
-                meta_tags=[{"name": "viewport", "content": "width=device-width, initial-scale=1"}])
-
-app.title="Bunker Analytics"
-server=app.server
-
-# Define the app
-app.layout = html.Div("Bunker Dash")
-
-
-app.layout = html.Div(children=[dcc.ConfirmDialog(id='date-error',message='Wrong date range'),
-                      html.Div(id="main-header",className="container-row twelve columns",
-                                children=[
-                                  html.Div(id="header",className="div-header bg-navy",##Header
-                                      children=header_dropdown())
-                                                        ]),
-                      html.Div(id="main-rank",className='container three columns',
-                                children=[
-                                  html.Div(id="ranking-container",children=ranking()
-                                           ,className='div-ranking bg-navy'),
-                                  html.Div(id="age-container",children=barges(),className='div-ops bg-navy')
-                                  ]),
-                      html.Div(id="main-map",className="container five columns",
-                                children=[
-                                    html.Div(id="map-container",children=bunker_map(),##Map
-                                             className='div-for-maps bg-navy'),
-                                    html.Div([html.Div([html.H2("Vessel size (GT)"),slider],id="slider"),
-                                              summary()],                                              
-                                             className="div-for-prices bg-navy")
-                                  ],style={"margin-left":"0px","margin-right":"0px"}),
-                      html.Div(id="main-stats-price",className="container four columns",
-                                children=[
-                                    html.Div(id="service-container",children=stats_graph(),className="div-for-service bg-navy"),
-                                    html.Div(id="waiting-container",children=stats_graph(graph="waiting"),##Waiting time
-                                             className="div-for-waiting bg-navy"),
-                                    html.Div(id="brent-container",children=brent(),#Brent Price
-                                             className="div-for-brent bg-navy")])
-                                   ],className="main-box")
-
-###############Callbacks
-##Modal for missing ports
-@app.callback(Output('modal', 'style'),
-            [Input('modal-close-button', 'n_clicks')])
-def close_modal(n):
-    if (n is not None) and (n > 0):
-        return {"display": "none"}
-        
-##Callback for error in date     
-@app.callback(Output(component_id='date-error', component_property='displayed'),
-              [Input('date-picker-start', 'date'),Input('date-picker-end', 'date')])
-
-def date_check(value_start,value_end):
-    if value_start is not None and value_end is not None:
-        if pd.to_datetime(value_start)>pd.to_datetime(value_end):
-            return True
-    return False
-
-##Refresh button
-@app.callback(Output('map-container', 'children'),
-              [Input('update-button', 'n_clicks')])    
-
-def clearMap(n_clicks):
-    if n_clicks !=0:
-        return bunker_map()
-    
-@app.callback(Output('header', 'children'),
-              [Input('update-button', 'n_clicks')])
-    
-def clearDropDown1(n_clicks):
-    if n_clicks !=0: #Don't clear options when loading page for the first time
-        return header_dropdown() #Return an empty list of options
-
-##Service callback
-@app.callback(Output("service-container","children"),
-              [Input('update-button',"n_clicks"),
-              Input('ports-dropdown', 'value'),
-                     Input("types-dropdown", "value"),
-                     Input('date-picker-start', 'date'),
-                     Input('date-picker-end', 'date'),
-                     Input('range-slider','value')])
-
-def service_update(click,ports_val,types_val,date_s,date_e,size):
-    ##If no value is entered then keep default
-    if not ports_val:
-        ports_val=["full"]
-    if not types_val:
-        types_val=["full"]
-    if not date_s:
-        date_s="01-01-2014"
-    if not date_e:
-        date_e="01-06-2019"
-    if not size:
-        size=["full"]
-    ##Click trigger
-    if click is not None and len(ports_val)<=5:
-        return stats_graph()
-    elif len(ports_val)<=5:
-        return stats_graph(port=ports_val,type_vessel=types_val,fr=date_s,
-                           to=date_e,size=size)
-    else:
-        return stats_graph()
-    
-##Waiting callback
-@app.callback(Output("waiting-container","children"),
-              [Input('update-button',"n_clicks"),
-              Input('ports-dropdown', 'value'),
-                      Input("types-dropdown", "value"),
-                      Input('date-picker-start', 'date'),
-                      Input('date-picker-end', 'date'),
-                      Input('range-slider','value')])   
-
-def waiting_update(click,ports_val,types_val,date_s,date_e,size):
-    ##If no value is entered then keep default
-    if not ports_val:
-        ports_val=["full"]
-    if not types_val:
-        types_val=["full"]
-    if not date_s:
-        date_s="01-01-2014"
-    if not date_e:
-        date_e="01-06-2019"
-    if not size:
-        size=["full"]
-    ##Click trigger
-    if click is not None:
-        return stats_graph(graph="waiting")
-    elif len(ports_val)<=5:
-        return stats_graph(graph="waiting",port=ports_val,type_vessel=types_val,
-                           fr=date_s,to=date_e,size=size)
-    else:
-        return stats_graph(graph="waiting")
-
-##Brent update
-@app.callback(Output("brent-container","children"),
-              [Input('update-button',"n_clicks"),
-              Input('date-picker-start', 'date'),
-                      Input('date-picker-end', 'date')])   
-
-def brent_update(click,date_s,date_e):
-    if not date_s:
-        date_s="01-01-2014"
-    if not date_e:
-        date_e="01-06-2019"
-    if click is not None:
-        return brent()       
-    else:
-        return brent(fr=date_s,to=date_e)
-
-##Ages update
-@app.callback(Output("age-container","children"),
-              [Input('update-button',"n_clicks"),
-               Input('ports-dropdown', 'value'),
-                      Input("types-dropdown", "value"),
-                      Input('date-picker-start', 'date'),
-                      Input('date-picker-end', 'date'),
-                      Input('range-slider','value')])   
-
-def age_update(click,ports_val,types_val,date_s,date_e,size):
-    if not ports_val:
-        ports_val=["full"]
-    if not types_val:
-        types_val=["full"]
-    if not date_s:
-        date_s="01-01-2014"
-    if not date_e:
-        date_e="01-06-2019"
-    if not size:
-        size=["full"]
-    if click is not None:
-        return barges()
-    else:
-        return barges(fr=date_s,to=date_e,port=ports_val,
-                      type_vessel=types_val,size=size)
-
-##Ranking update
-@app.callback(Output("ranking-container","children"),
-              [Input('update-button',"n_clicks"),
-               Input('ports-dropdown', 'value'),
-                      Input("types-dropdown", "value"),
-                      Input('date-picker-start', 'date'),
-                      Input('date-picker-end', 'date'),
-                      Input('range-slider','value')])   
-
-def ranking_update(click,ports_val,types_val,date_s,date_e,size):
-    if not ports_val:
-        ports_val=["full"]
-    if not types_val:
-        types_val=["full"]
-    if not date_s:
-        date_s="01-01-2014"
-    if not date_e:
-        date_e="01-06-2019"
-    if not size:
-        size=["full"]
-    if click is not None:
-        return ranking()
-    else:
-        return ranking(fr=date_s,to=date_e,port=ports_val,
-                       type_vessel=types_val,size=size)      
-
-
-##Summary update
-@app.callback(Output("summary","children"),
-              [Input('update-button',"n_clicks"),
-               Input('ports-dropdown', 'value'),
-                      Input("types-dropdown", "value"),
-                      Input('date-picker-start', 'date'),
-                      Input('date-picker-end', 'date'),
-                      Input('range-slider','value')])   
-
-def summary_update(click,ports_val,types_val,date_s,date_e,size):
-    if not ports_val:
-        ports_val=["full"]
-    if not types_val:
-        types_val=["full"]
-    if not date_s:
-        date_s="01-01-2014"
-    if not date_e:
-        date_e="01-06-2019"
-    if not size:
-        size=["full"]
-    if click is not None:
-        return summary()
-    else:
-        return summary(fr=date_s,to=date_e,port=ports_val,
-                       type_vessel=types_val,size=size)      
-     
-##Map selection
-
-@app.callback(Output("ports-dropdown","value"),
-              [Input("map","selectedData")])
-
-def display_selected_data(geo_select):
-    if geo_select is not None:
-        port=[]
-        for point in geo_select["points"]:
-            port.append(point["text"])
-        return port
-        
-
-# Run the app
-if __name__ == '__main__':
-    app.run_server(debug=True)
+"""
+Created on Tue May 26 21:58:04 2020
+
+Author: Gabriel Fuentes Lezcano
+"""
+import pandas as pd
+import dash
+import flask
+import json
+import plotly
+import dash_html_components as html
+import dash_core_components as dcc
+from dash.dependencies import ClientsideFunction, Input, Output, State
+from dash.exceptions import PreventUpdate
+import plotly.graph_objects as go
+from datetime import datetime as dt
+import numpy as np
+from random import shuffle
+import os
+import threading
+import uuid
+from urllib.parse import urlencode
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from functools import wraps
+import analytics
+import api
+import instrument
+import memory
+import store
+from payload import PLOT_WIDTH, compact_line
+from coalesce import Latest
+from export import FORMATS, available, export_stream
+from cube import LogSketch, OpsCube
+from figcache import FigureCache
+from ingest import Ingestor
+from jobs import JobQueue
+from backends import FrameBackend
+from partitions import PartitionedOps
+from sqlbackend import SQLiteOps
+from series import RESOLUTIONS, SeriesStore
+from spatial import PortIndex, viewport
+from filters import normalize_filters, query_filters
+
+MAPBOX_TOKEN=os.environ.get('MAPBOX_TOKEN', None)
+
+valid_colors=["#CF5C60","#717ECD","#4AB471","#F3AE4E","#D96383","#4EB1CB"]
+shuffle(valid_colors)
+
+##Databases
+####
+##Cleaned tables, memory-mapped from the binary store written by `python store.py`
+##when present, parsed from the CSV files otherwise. The panels query the ops through
+##a backend (backends.py): this table in memory, or without loading it the partitions
+##of BUNKER_PARTITIONS (`python partitions.py`) or the SQLite file of BUNKER_SQLITE
+##(`python sqlbackend.py`)
+DATA_DIR=os.environ.get('BUNKER_DATA_DIR','data')
+PARTITIONS_DIR=os.environ.get('BUNKER_PARTITIONS',None)
+SQLITE_PATH=os.environ.get('BUNKER_SQLITE',None)
+df=None if (PARTITIONS_DIR or SQLITE_PATH) else store.load("ops",DATA_DIR)
+brent_df=store.load("brent",DATA_DIR)
+ports_positions=store.load("ports",DATA_DIR)
+
+##Panel outputs memoized on the normalized selection and the dataset version.
+##BUNKER_FIGURE_CACHE is an optional SQLite file shared by all the workers
+figure_cache=FigureCache(maxsize=int(os.environ.get('BUNKER_FIGURE_CACHE_SIZE',128)),
+                         path=os.environ.get('BUNKER_FIGURE_CACHE',None),
+                         version=lambda: current().version)
+
+##Service time and Waiting time function
+@instrument.traced
+@figure_cache.cached
+def stats_graph(graph="service",fr="01-01-2014",to="01-06-2019",port=["full"],
+                type_vessel=["full"],size=["full"],*args):  
+    '''Generates a plotly graph to be used in dash
+    Input: 
+        fr; From date (datetime dd-mm-YYYY). Default 01-01-2014
+        to; To date (datetime dd-mm-YYYY)
+        graph; type of graph, from service or waiting
+        port; ports filter. Full has all the ports higher than 100 observations
+        Returns. Plotly Graph'''
+    ##Densities of the ports with enough operations (analytics.py)
+    dist=analytics.distribution(current().backend,normalize_filters(fr,to,port,type_vessel,size),graph)
+    instrument.lap("aggregate")
+    times_labels=dist["port"]
+    
+    if not times_labels:
+        if graph=="service":
+            modal_ex=html.Div([# modal div
+                          html.Div([html.H4("Not enough sample to build distributions. Adjust your selection.",
+                                            style={"margin-top":"12vh","color":"black",'textAlign': 'center',"font-size":"20px","top":"20%" })],className='modal-content'),
+                          html.Button('Close', id='modal-close-button',className="button-modal")
+                          ],id='modal',className='modal')
+            return [modal_ex]
+    else:
+        colors=valid_colors[0:len(times_labels)]
+        ##Smooth curves, one point every two pixels
+        curves=[compact_line(x,y,PLOT_WIDTH//2) for x,y in zip(dist["x"],dist["y"])]
+        fig_service=go.Figure([go.Scatter(x=x,y=y,mode="lines",name=label,legendgroup=label,
+                                          marker=dict(color=colors[i%len(colors)]))
+                               for i,(label,(x,y)) in enumerate(zip(times_labels,curves))],
+                              layout=dict(hovermode="closest",legend=dict(traceorder="reversed"),
+                                          xaxis=dict(zeroline=False)))
+        
+        ##Dict of annotations change for value of >9
+        annotations_variable={"service":dict(x=0.93,y=-0.19,showarrow=False,text="Hours",xref="paper",yref="paper"),
+                                  "waiting":dict(x=1.0,y=-0.19,showarrow=False,text=">13",xref="paper",yref="paper")}
+                
+        if graph=="service":
+            annotations_variable=[annotations_variable.get("service")]
+        elif graph=="waiting":
+            annotations_variable=[annotations_variable.get("service"),annotations_variable.get("waiting")]
+        ##Graphs layout + axis title as annotation
+        fig_service.update_layout({"plot_bgcolor": "rgba(0, 0, 0, 0)",
+                                    "paper_bgcolor": "rgba(0, 0, 0, 0)"},
+                                      showlegend=False,
+                                      margin=dict(l=0,r=0,b=0,t=0),
+                                      font=dict(family="Open Sans Light",size=12,color="#d8d8d8"),
+                                      annotations=annotations_variable)         
+        ##Axes colors                          
+        fig_service.update_xaxes(showline=True, zerolinewidth=1, zerolinecolor='white',gridcolor="rgba(255,255,255,0.05)")
+        fig_service.update_yaxes(automargin=True,rangemode="tozero",showline=True, zerolinewidth=1, zerolinecolor='white',gridcolor="rgba(255,255,255,0.05)")     
+        ##Line colors and plot 
+        ##Layout for 1 record
+        if len(times_labels)==1:
+            fig_service.update_layout({'hoverlabel':{'bgcolor':'rgb(223, 232, 243)'}})
+                                       
+            if graph=="service":   
+                fig_service.update_traces(hovertemplate='Hours: %{x:.1f}<extra></extra>',marker=dict(color="#F3AE4E"),fill="tozeroy",line=dict(width=3))               
+            elif graph=="waiting":
+                fig_service.update_traces(hovertemplate='Hours: %{x:.1f}<extra></extra>',marker=dict(color="#4ABA71"),fill="tozeroy",line=dict(width=3))
+        
+        ##Layout for more than 1 record
+        elif len(times_labels)>1 and len(times_labels)<=5:      
+            fig_service.update_layout({'hoverlabel':{'bgcolor':'rgb(223, 232, 243)'}},
+                                      showlegend=True)
+            ##Hovertext and hovertemplate
+            fig_service.update_traces(hovertemplate='Hours: %{x}<extra></extra>')
+            if graph=="service":                  
+                fig_service.update_traces(fill="tozeroy",line=dict(width=1))               
+            elif graph=="waiting":
+                fig_service.update_traces(fill="tozeroy",line=dict(width=1))
+        
+        instrument.lap("figure")
+        ##Separate returns as to provide differents id's, Header and modal if needed.
+        if graph=="service":                                           
+            fig_service_ex=dcc.Graph(id='service',
+                                      config={'displayModeBar': False},
+                                      animate=False,
+                                      figure=fig_service,
+                                      style={"height": "22vh","width" : "100%","display": "block",'align-items': 'stretch'})
+            ##If a port was removed from selectin then inform user
+            if dist["excluded"]:
+                ##Ordered list of div for modal.
+                ports_list_div=[html.H4("{};".format(i),style={"color":"black",'textAlign': 'center',"font-size":"16px","top":"20%" }) for i in dist["excluded"]]
+                header_mod=[html.H3('The following port(s) are not included to the graph (small sample):',
+                                    style={"color":"black",'textAlign': 'center',"font-size":"20px","top":"20%" })]
+                not_valid_list=header_mod+ports_list_div
+                modal_ex=html.Div([# modal div
+                               html.Div(not_valid_list,className='modal-content'),
+                               html.Button('Close', id='modal-close-button',className="button-modal")
+                                ],id='modal',style={'textAlign': 'center', },className='modal')
+                return [html.H2("Service time"),fig_service_ex, modal_ex]
+            else:
+                modal_ex=html.Div([html.Button('Close', id='modal-close-button',className="button-modal")
+                                ],id='modal',className='modal-fake')
+    
+                return [html.H2("Service time"),fig_service_ex,modal_ex]
+               
+        elif graph=="waiting":
+            fig_service_ex=dcc.Graph(id='waiting',
+                                      config={'displayModeBar': False},
+                                      animate=False,
+                                      figure=fig_service,
+                                      style={"height": "22vh","width" :"100%","display": "block",'align-items': 'stretch'})
+                   
+            return [html.H2("Waiting time"),fig_service_ex]
+        
+@instrument.traced
+@figure_cache.cached
+def ranking(fr="01-01-2014",to="01-06-2019",port=["full"],type_vessel=["full"],
+            size=["full"],*args): 
+    '''Generates a ranking of ports to be used in dash
+    Input: 
+        fr; From date (datetime dd-mm-YYYY). Default 01-01-2014
+        to; To date (datetime dd-mm-YYYY)
+        port; ports filter. Full has all the ports higher than 100 observations
+        type_vessel. Full as it includes all the vessel
+        Returns. Plotly Graph'''
+        
+    #Top 5 ports and their share of the operations
+    top=analytics.ranking(current().backend,normalize_filters(fr,to,port,type_vessel,size),5)
+    instrument.lap("aggregate")
+    port_count=pd.DataFrame({"bunkering_port":top["port"],"ops":top["ops"],"percentage":top["percentage"],
+                             "number":np.arange(1,len(top["port"])+1)})
+    
+    ##Graph construction and hovertext
+    fig_ranking = go.Figure(go.Bar(
+            x=port_count.percentage,
+            y=port_count.number,
+            text=port_count.bunkering_port.str.title(),
+            hovertext=port_count.ops,
+            hovertemplate='Operations: %{hovertext}. Perc: %{x:.2f}<extra></extra>',
+            orientation='h'))
+    
+    ##Graphs layout
+    fig_ranking.update_layout({"plot_bgcolor": "rgba(0, 0, 0, 0)",
+                                "paper_bgcolor": "rgba(0, 0, 0, 0)",
+                                'hoverlabel':{'bgcolor':'rgb(223, 232, 243)'}},
+                              showlegend=False,
+                              margin=dict(l=0,r=0,b=0,t=0),
+                              font=dict(family="Open Sans Light",size=12,color="#d8d8d8"),
+                              annotations=[dict(x=0.93,y=-0.1,showarrow=False,text="%",xref="paper",yref="paper")])
+    
+    #X axis
+    fig_ranking.update_xaxes(showline=True,gridcolor="rgba(255,255,255,0.05)")
+    ##Y axis
+    fig_ranking.update_xaxes(showline=False)
+    ##Plots + text
+    fig_ranking.update_traces(marker_color="#717ecd", marker_line_color='black',
+                  marker_line_width=0.5,textposition='auto',
+                  textfont_family="Open Sans Light",textfont_color="#d8d8d8")
+    ##Axes colors                          
+    fig_ranking.update_yaxes(autorange="reversed")    
+    instrument.lap("figure")
+    ##DCC Graph
+    fig_ranking_ex=dcc.Graph(id='ranking',
+                              config={'displayModeBar': False},
+                              animate=False,
+                              figure=fig_ranking,
+                              style={"height": "37vh","width" : "100%","display": "block",'align-items': 'stretch'})
+    
+    return [html.H2("Top 5 ports"),fig_ranking_ex]
+      
+@instrument.traced
+@figure_cache.cached
+def barges(fr="01-01-2014",to="01-06-2019",port=["full"],type_vessel=["full"],
+           size=["full"],*args):  
+    '''Works the age at ops density of barges
+    Input: 
+        fr; From date (datetime dd-mm-YYYY). Default 01-01-2014
+        to; To date (datetime dd-mm-YYYY)
+        port; ports filter. Full has all the ports higher than 100 observations
+        type_vessel. Full as it includes all the vessel
+        Returns. Plotly Graph'''
+        
+    ##Datetime
+    #Filters
+    ages=analytics.barge_ages(current().backend,normalize_filters(fr,to,port,type_vessel,size),2)
+    starts,ops=ages["start"],ages["ops"]
+    instrument.lap("aggregate")
+        
+    ##Graph construction, hovertext and bin setting. 2 years bins counted by the backend
+    fig_barges = go.Figure(data=[go.Bar(x=starts+1,y=ops,width=2,
+                                        marker_color="#CF5C60",marker_line_width=1,
+                                        hovertemplate='Age: %{x}. Observations: %{y}<extra></extra>')])
+    
+    ##Graphs layout
+    fig_barges.update_layout({"plot_bgcolor": "rgba(0, 0, 0, 0)",
+                                "paper_bgcolor": "rgba(0, 0, 0, 0)",
+                                'hoverlabel':{'bgcolor':'rgb(223, 232, 243)'}},
+                              showlegend=False,
+                              margin=dict(l=0,r=0,b=0,t=0),
+                              font=dict(family="Open Sans Light",size=12,color="#d8d8d8"),
+                              annotations=[dict(x=0.93,y=-0.09,showarrow=False,text="Years",xref="paper",yref="paper")])
+    #Y axis
+    fig_barges.update_yaxes(showline=True,gridcolor="rgba(255,255,255,0.05)")
+    instrument.lap("figure")
+    ##DCC Graph
+    fig_barges_ex=dcc.Graph(id='barges_age',
+                              config={'displayModeBar': False},
+                              animate=False,
+                              figure=fig_barges,
+                              style={"height": "37vh","width" : "100%","display": "block",'align-items': 'stretch'})
+    
+    return [html.H2("Barge age at operation"),fig_barges_ex]
+
+@instrument.traced
+@figure_cache.cached
+def brent(fr="01-01-2014",to="01-06-2019"):
+    '''Brent graph
+    Input: 
+        fr; From date (datetime dd-mm-YYYY). Default 01-01-2014
+        to; To date (datetime dd-mm-YYYY)
+        Returns. Plotly Graph'''
+        
+    ##Daily prices of the dates, from the time series of the dataset
+    prices=analytics.brent(current().series,normalize_filters(fr,to))
+    instrument.note(rows=len(prices["date"]))
+    instrument.lap("filter")
+    ##Downsampled to the graph width
+    dates,prices=compact_line(prices["date"],prices["price"])
+    #Graph construction
+    figure_brent=go.Figure([go.Scatter(x=dates, y=prices,
+                                        marker_color="#2A94D6")])
+      ##Graphs layout
+    figure_brent.update_layout({"plot_bgcolor": "rgba(0, 0, 0, 0)",
+                                "paper_bgcolor": "rgba(0, 0, 0, 0)",
+                                'hoverlabel':{'bgcolor':'rgb(223, 232, 243)'}},
+                              showlegend=False,
+                              margin=dict(l=0,r=0,b=0,t=0),
+                              font=dict(family="Open Sans Light",size=12,color="#d8d8d8"))
+    
+    
+    #Y axis
+    figure_brent.update_yaxes(gridcolor="rgba(255,255,255,0.05)")
+    #X axis
+    figure_brent.update_xaxes(gridcolor="rgba(255,255,255,0.05)")
+    instrument.lap("figure")
+    
+    ##DCC Graph
+    fig_brent_ex=dcc.Graph(id='brent',
+                              config={'displayModeBar': False},
+                              animate=False,
+                              figure=figure_brent,
+                              style={"height": "22vh","width" : "100%","display": "block",'align-items': 'stretch'})
+    
+    return [html.H2("Brent price"),fig_brent_ex]
+
+##Operations vs Brent price, from the time series of the dataset (series.py). The whole
+##ops table, only the dates apply
+SERIES_RESOLUTION="W"
+
+@instrument.traced
+def series_graph(fr="01-01-2014",to="01-06-2019",resolution=SERIES_RESOLUTION):
+    '''Operations and Brent close per period
+    Input:
+        fr; From date (datetime dd-mm-YYYY). Default 01-01-2014
+        to; To date (datetime dd-mm-YYYY)
+        resolution; D, W or M (series.RESOLUTIONS)
+        Returns. Plotly figure'''
+    table=analytics.rollup(current().series,normalize_filters(fr,to),resolution)
+    instrument.note(rows=len(table["period"]))
+    instrument.lap("filter")
+    periods=np.datetime_as_string(table["period"])
+    figure_series=go.Figure([go.Bar(x=periods,y=table["ops"],name="Operations",marker_color="#4AB471",
+                                    customdata=np.round(np.column_stack([table["service"],table["waiting"]]),2),
+                                    hovertemplate="%{y} ops<br>service %{customdata[0]} h<br>waiting %{customdata[1]} h")])
+    ##Periods with prices
+    priced=~np.isnan(table["close"])
+    if resolution=="D":
+        ##Downsampled to the graph width
+        dates,close=compact_line(table["period"][priced],table["close"][priced])
+        figure_series.add_trace(go.Scatter(x=dates,y=close,name="Brent",yaxis="y2",marker_color="#2A94D6"))
+    else:
+        figure_series.add_trace(go.Candlestick(x=periods[priced],open=table["open"][priced],high=table["high"][priced],
+                                               low=table["low"][priced],close=table["close"][priced],name="Brent",yaxis="y2",
+                                               increasing_line_color="#2A94D6",decreasing_line_color="#CF5C60"))
+    figure_series.update_layout({"plot_bgcolor": "rgba(0, 0, 0, 0)",
+                                 "paper_bgcolor": "rgba(0, 0, 0, 0)",
+                                 'hoverlabel':{'bgcolor':'rgb(223, 232, 243)'}},
+                                showlegend=False,bargap=0.1,
+                                margin=dict(l=0,r=0,b=0,t=0),
+                                font=dict(family="Open Sans Light",size=12,color="#d8d8d8"),
+                                xaxis=dict(gridcolor="rgba(255,255,255,0.05)",rangeslider=dict(visible=False)),
+                                yaxis=dict(title="Operations",gridcolor="rgba(255,255,255,0.05)"),
+                                yaxis2=dict(title="Brent (USD)",overlaying="y",side="right",showgrid=False))
+    instrument.lap("figure")
+    return figure_series
+
+def series_link(fr="01-01-2014",to="01-06-2019",resolution=SERIES_RESOLUTION):
+    '''Address of the CSV of the series'''
+    return "/series.csv?"+urlencode(dict(fr=fr,to=to,resolution=resolution))
+
+def series_panel(fr="01-01-2014",to="01-06-2019"):
+    '''Series panel: resolution picker, CSV link and graph'''
+    return [html.Div([html.H2("Operations and Brent price"),
+                      dcc.RadioItems(id="series-resolution",value=SERIES_RESOLUTION,
+                                     options=[{"label":v,"value":k} for k,v in RESOLUTIONS.items()],
+                                     labelStyle={"display":"inline-block","margin-right":"10px"}),
+                      html.A("CSV",id="series-download",href=series_link(fr,to),download="bunker_series.csv")],
+                     className="series-header"),
+            dcc.Graph(id='series',
+                      config={'displayModeBar': False},
+                      animate=False,
+                      figure=series_graph(fr,to),
+                      style={"height": "28vh","width" : "100%","display": "block",'align-items': 'stretch'})]
+
+##Map view of the layout. Ports beyond BUNKER_MAP_MAX_MARKERS in a view are clustered
+CENTER_MAP=dict(lat=37.00,lon=18.00)
+ZOOM_MAP=3
+MAP_MAX_MARKERS=int(os.environ.get('BUNKER_MAP_MAX_MARKERS',500))
+
+def map_markers(relayout=None):
+    '''Ports of every marker of a map view (spatial.PortIndex.markers)'''
+    index=current().port_index
+    bounds,zoom=viewport(relayout,CENTER_MAP,ZOOM_MAP)
+    return index.markers(bounds,zoom,max_markers=MAP_MAX_MARKERS)
+
+@instrument.traced
+def bunker_map(port=["full"],relayout=None,*args):
+    index=current().port_index
+    markers=map_markers(relayout)
+    first=np.array([i[0] for i in markers],dtype="int64")
+    size=np.array([len(i) for i in markers])
+    ##One port per marker, or a cluster at the mean position of its ports
+    ports_positions_in=pd.DataFrame({"BE PORT_NA":np.where(size==1,index.names[first],
+                                                         ["{} ports".format(n) for n in size]),
+                                     "PortCode":np.where(size==1,index.codes[first],""),
+                                     "Lat":[index.lat[i].mean() for i in markers],
+                                     "Long":[index.lon[i].mean() for i in markers],
+                                     "ports":[" ".join(index.codes[i]) for i in markers]})
+    ports_positions_in=ports_positions_in.assign(colors='#CF5C60')
+    if "full" not in port:
+        ports_positions_in["colors"]=np.where(ports_positions_in.PortCode.isin(port),"#F3AE43",
+                                              ports_positions_in["colors"])  
+
+    ##Maps construction
+    map_data=go.Figure(go.Scattermapbox(lat=ports_positions_in.Lat, lon=ports_positions_in.Long,
+                        mode="markers",hovertext=ports_positions_in["BE PORT_NA"],selectedpoints=[],
+                        selected={'marker':{'color': '#F3AE4E'}},
+                        text=ports_positions_in.PortCode,hovertemplate='%{hovertext}<extra></extra>',
+                        customdata=ports_positions_in.ports,
+                        marker=go.scattermapbox.Marker(size=12 if (size==1).all() else (12+4*np.log2(size)).tolist(),
+                                                       color=ports_positions_in.colors,opacity=None))) 
+       
+    center_map=CENTER_MAP
+    zoom_map=ZOOM_MAP
+    
+    ##Map prueba
+    #map_data.update_layout({"plot_bgcolor": "rgba(0, 0, 0, 0)",
+    #                           "paper_bgcolor": "rgba(0, 0, 0, 0)",
+     #                           'hoverlabel':{'bgcolor':'rgb(223, 232, 243)'}},
+      #                      margin=dict(l=0,r=0,b=0,t=0),
+       #                     autosize=True,hovermode='closest',
+        #                    mapbox_style="white-bg",clickmode="event+select",
+         #                   mapbox=dict(bearing=0,
+          #                              center=center_map,zoom=zoom_map))
+     #Map layout 
+    map_data.update_layout({"plot_bgcolor": "rgba(0, 0, 0, 0)",
+                                 "paper_bgcolor": "rgba(0, 0, 0, 0)",
+                                 'hoverlabel':{'bgcolor':'rgb(223, 232, 243)'}},
+                             margin=dict(l=0,r=0,b=0,t=0),
+                             autosize=True,hovermode='closest',clickmode="event+select",uirevision="map",
+                             mapbox_style='mapbox://styles/gabrielfuenmar/ckaocvlug34up1iqvowltgs5p',
+                             mapbox=dict(bearing=0,accesstoken=MAPBOX_TOKEN,
+                                         center=center_map,zoom=zoom_map))
+
+
+    #DCC Graph
+    map_data_ex=dcc.Graph(id='map',                            
+                              animate=True,
+                              figure=map_data,
+                              style={"height": "55vh","width" : "100%","display": "block",'align-items': 'stretch'})
+    
+    return [map_data_ex]
+    
+
+##Dropdown and filters
+def header_dropdown():
+        data=current()
+        port_dropdown=dcc.Dropdown(id='ports-dropdown',
+        options=[{'label': name.title(),'value': code} for name,code in data.backend.port_options],
+        placeholder="Port/s (max 5)",multi=True)
+        
+    
+        type_dropdown=dcc.Dropdown(id='types-dropdown',
+        options=[{'label': row.title(),'value': row} for row in data.backend.type_options],
+        placeholder="Vessel type(s)",multi=True)
+    
+        date_start=dcc.DatePickerSingle(
+        id='date-picker-start',
+        min_date_allowed=dt(2014, 1, 1),
+        max_date_allowed=data.date_max,
+        initial_visible_month=dt(2014, 1, 1),
+        display_format='DD-MM-YYYY',
+        placeholder="01-01-2014")
+
+        date_end=dcc.DatePickerSingle(
+        id='date-picker-end',
+        min_date_allowed=dt(2014, 1, 1),
+        max_date_allowed=data.date_max,
+        initial_visible_month=data.date_max,
+        display_format='DD-MM-YYYY',
+        placeholder=data.date_label)
+        
+        return [html.H1("BUNKER ANALYTICS"),html.Div([date_start,date_end,
+                                                      port_dropdown,type_dropdown],className="box"),               
+                                              html.Div([html.Button("Refresh",id="update-button"),
+                                              html.A(html.Button("Home",id="home-button"),
+                                                       href="http://gabrielfuentes.org")])]
+
+
+
+##Summary container. Expected in a future to be the real time prices from API
+@instrument.traced
+@figure_cache.cached
+def summary(fr="01-01-2014",to="01-06-2019",port=["full"],type_vessel=["full"],
+            size=["full"],*args):
+        '''Summary of top port
+    Input: 
+        fr; From date (datetime dd-mm-YYYY). Default 01-01-2014
+        to; To date (datetime dd-mm-YYYY)
+        port: top port code
+        type_vessel: type of vessel
+    Returns. 
+        Plotly Graph + slider'''
+        
+        ##Top port is picked on dates and ports only, then type and size filters apply
+        stats=analytics.summary(current().backend,normalize_filters(fr,to,port,type_vessel,size),0.95)
+        port_name,operations,age=stats["name"],stats["ops"],stats["age"]
+        waiting,service=stats["waiting"],stats["service"]
+        instrument.lap("aggregate")
+        
+        ###Summary filter
+        operations="{:,}".format(operations)
+        age="{:,.1f} years".format(age)
+        waiting="{:,.1f} hours".format(waiting)
+        service="{:,.1f} hours".format(service)
+                
+        return html.Div([html.Div(html.H5("{}".format(port_name))),
+                     html.Div([html.Div([html.H3("Operations"),html.H4(operations)]),
+                     html.Div([html.H3("Service Time"),html.H4(service)]),
+                     html.Div([html.H3("WaitingTime"),html.H4(waiting)]),
+                     html.Div([html.H3("Barges Age"),html.H4(age)])],className="box-summary2")]
+                    ,className="box-summary",id="summary")
+                
+                
+##At the top we put another filter, the GT slider
+##Rounded to the closest 20
+min_val=1000
+max_val=220000
+step=int((max_val-min_val)/10)
+list_of_marks=list(range(min_val,max_val,step))
+marks={i:{"label":"{:,}".format(i),'style': {'color': '#d8d8d8'}} for i in list_of_marks}
+##The slider applies on release by default, BUNKER_SLIDER_UPDATEMODE=drag sends every step
+slider=dcc.RangeSlider(id="range-slider",min=list_of_marks[0],max=list_of_marks[-1],marks=marks,
+                step=step,value=[min_val,max_val],allowCross=False,
+                updatemode=os.environ.get('BUNKER_SLIDER_UPDATEMODE','mouseup'))       
+
+##Aggregate cube for ranking, summary and the 95th percentile cutoffs, GT buckets on the slider steps.
+##Set BUNKER_CUBE to a .npz path to persist it between restarts
+CUBE_PATH=os.environ.get('BUNKER_CUBE',None)
+##Relative accuracy of the quantile sketches. BUNKER_SKETCH_EXACT=1 takes the quantiles
+##and trimmed means from the rows instead, to validate the sketches
+SKETCH=LogSketch(float(os.environ.get('BUNKER_SKETCH_ALPHA',0.01)))
+SKETCH_EXACT=os.environ.get('BUNKER_SKETCH_EXACT','0') not in ("","0")
+if SQLITE_PATH:
+    backend=SQLiteOps(SQLITE_PATH)
+elif PARTITIONS_DIR:
+    backend=PartitionedOps(PARTITIONS_DIR,sketch=SKETCH)
+else:
+    try:
+        ops_cube=OpsCube.load(CUBE_PATH,df) if CUBE_PATH else None
+    except (OSError,ValueError):
+        ops_cube=None
+    if ops_cube is not None and ops_cube.sketch.alpha!=SKETCH.alpha:
+        ops_cube=None
+    if ops_cube is None:
+        ops_cube=OpsCube.from_frame(df,gt_edges=list_of_marks+[max_val],sketch=SKETCH)
+        if CUBE_PATH:
+            ops_cube.save(CUBE_PATH)
+    backend=FrameBackend(df,ops_cube,exact=SKETCH_EXACT)
+
+##Dates of the default selection. The end moves with the ops appended after the base table
+DATE_FROM="01-01-2014"
+DATE_TO="01-06-2019"
+BASE_END=backend.end
+
+class Dataset:
+    '''Query backend of the ops and everything derived from it: date bounds and default
+    panels. Appended rows make a new Dataset, swapped in with one assignment'''
+    def __init__(self,backend,series=None):
+        self.backend=backend
+        ##Daily, weekly and monthly rollups, added to when rows are appended
+        self.series=series or SeriesStore.build(backend.time_chunks(),brent_df.Date.values,brent_df.Price.values)
+        end=backend.end
+        self.version="{}.{}".format(backend.rows,end.value)
+        self.date_to=DATE_TO if end<=BASE_END else end.strftime("%Y-%m-%d")
+        self.date_label=DATE_TO if end<=BASE_END else end.strftime("%d-%m-%Y")
+        self.date_max=max(dt(2019,6,1),end.to_pydatetime())
+        ##Positions of the ports with operations, indexed once per dataset
+        positions=ports_positions[ports_positions.PortCode.isin(backend.codes)].reset_index(drop=True)
+        self.port_index=PortIndex(positions.PortCode,positions["BE PORT_NA"],positions.Lat,positions.Long)
+        self.panels=None
+
+    def build_panels(self):
+        ##Default state of every panel, built once. Used by the layout and as the
+        ##callbacks response to the default inputs
+        dates=dict(fr=DATE_FROM,to=self.date_to)
+        with pin(self):
+            self.panels=dict(header=header_dropdown(),ranking=ranking(**dates),age=barges(**dates),map=bunker_map(),
+                             summary=summary(**dates),service=stats_graph(**dates),
+                             waiting=stats_graph(graph="waiting",**dates),brent=brent(**dates),
+                             series=series_panel(**dates))
+        ##Map and header restored by the refresh button in the browser, kept as plain JSON in the layout
+        self.static={name:json.loads(json.dumps(self.panels[name],cls=plotly.utils.PlotlyJSONEncoder))
+                     for name in ["map","header"]}
+        return self
+
+dataset=None
+_pinned=threading.local()
+
+def current():
+    '''Dataset of the running callback, the latest one outside the callbacks'''
+    return getattr(_pinned,"data",None) or dataset
+
+@contextmanager
+def pin(data=None):
+    '''Keeps current() on one dataset (the latest by default) while rows are appended'''
+    before=getattr(_pinned,"data",None)
+    _pinned.data=data or before or dataset
+    try:
+        yield _pinned.data
+    finally:
+        _pinned.data=before
+
+def publish(data):
+    '''Builds the default panels of a dataset and makes it the current one'''
+    global dataset
+    dataset=data.build_panels()
+
+def append_ops(frame,rows):
+    '''Swaps in the table with appended rows, the cube merged with the cube of the rows'''
+    ops_cube=dataset.backend.cube
+    cube=ops_cube.merge(OpsCube.from_frame(rows,gt_edges=ops_cube.gt_edges,sketch=ops_cube.sketch),frame)
+    series=dataset.series.add(rows.start_of_service.values,rows.service_time.values,rows.waiting_time.values)
+    publish(Dataset(FrameBackend(frame,cube,exact=SKETCH_EXACT),series))
+
+publish(Dataset(backend))
+
+##New ops dropped in BUNKER_INGEST_DIR (or uploaded to /ingest) are appended without a restart.
+##Only on the table in memory, the partitions and the SQLite file are written by their commands
+INGEST_DIR=os.environ.get('BUNKER_INGEST_DIR',None) if df is not None else None
+ingestor=Ingestor(df,INGEST_DIR,append_ops) if df is not None else None
+if ingestor is not None:
+    ingestor.scan()
+
+##Key of the content of a panel, kept by the browser in a dcc.Store so a panel
+##it already shows is answered with no_update
+PANELS=["service","waiting","age","ranking","summary"]
+
+def panel_key(name,state=None):
+    '''Key of a panel for a FilterState, its default content when state is None'''
+    return current().version+"|"+(name+":default" if state is None else FigureCache.key(name,state))
+
+##Panels of one request built in parallel by BUNKER_PANEL_THREADS threads (default 0, one after
+##another). The threads share the filtered frame of the selection (FilterStore), numpy releases the GIL
+PANEL_THREADS=int(os.environ.get('BUNKER_PANEL_THREADS',0))
+panel_pool=ThreadPoolExecutor(PANEL_THREADS,thread_name_prefix="panels") if PANEL_THREADS>1 else None
+
+def build_all(data,tasks,ticket=None):
+    '''Outputs of panel builders (functions without arguments), on panel_pool when set
+    Input:
+        data; Dataset of the request
+        tasks; panel builders
+        ticket; ticket of the request (latest.begin), PreventUpdate once it is superseded
+    Returns. List of the outputs, in the order of tasks'''
+    if panel_pool is None or len(tasks)<2:
+        output=[]
+        for task in tasks:
+            ##A newer selection of the page is on its way, its response replaces this one
+            if latest.superseded(ticket):
+                raise PreventUpdate
+            output.append(task())
+        return output
+    context=instrument.context()
+
+    def run(task):
+        with pin(data),instrument.attach(context):
+            return task()
+    futures=[panel_pool.submit(run,task) for task in tasks]
+    pending=set(futures)
+    while pending:
+        _,pending=wait(pending,return_when=FIRST_COMPLETED)
+        ##Builders not started yet are cancelled, the running ones finish in the pool
+        if pending and latest.superseded(ticket):
+            for future in pending:
+                future.cancel()
+            raise PreventUpdate
+    return [future.result() for future in futures]
+
+##Distributions built in the background (jobs.py) when BUNKER_JOBS is a SQLite file shared by
+##the workers, at most BUNKER_HEAVY_JOBS at a time. The pool is forked by gunicorn post_fork
+JOBS_PATH=os.environ.get('BUNKER_JOBS',None)
+HEAVY=["service","waiting"]
+job_queue=JobQueue(JOBS_PATH,dict(stats_graph=stats_graph.builder),lambda: current().version,
+                   limit=int(os.environ.get('BUNKER_HEAVY_JOBS',2))) if JOBS_PATH else None
+
+def placeholder(name):
+    '''Distribution panel shown while its job runs'''
+    children=[html.H2({"service":"Service time","waiting":"Waiting time"}[name]),
+              html.Div(html.H4("Computing..."),style={"height": "22vh","width" : "100%","display": "block"})]
+    if name=="service":
+        children.append(html.Div([html.Button('Close', id='modal-close-button',className="button-modal")],
+                                 id='modal',className='modal-fake'))
+    return children
+
+def background_panel(name,filters,key,before):
+    '''Distribution panel from the figure cache or its job
+    Input:
+        name; service or waiting
+        filters; builder arguments of the selection
+        key; panel key
+        before; key sent to the browser
+    Returns. Output, key sent (pending|key while the job runs)'''
+    kwargs=dict(filters,graph=name)
+    cache_key,output=stats_graph.lookup(**kwargs)
+    if output is not None:
+        return output,key
+    status,value=job_queue.result(cache_key)
+    if status=="done":
+        return figure_cache.put(cache_key,value),key
+    if status=="failed":
+        job_queue.forget(cache_key)
+        return stats_graph(**kwargs),key
+    if status is None:
+        job_queue.submit(cache_key,"stats_graph",kwargs)
+    pending="pending|"+key
+    return (dash.no_update if before==pending else placeholder(name)),pending
+
+##Page id of the layout, replaced by a new id in every layout served
+PAGE_ID_SLOT="page-id-slot"
+
+class Dashboard(dash.Dash):
+    '''Dash app serving its layout serialized once per dataset (with a new page id every time),
+    callbacks run on one dataset and traced by instrument'''
+    _layout_json=(None,None)
+
+    def serve_layout(self):
+        with pin() as data:
+            if self._layout_json[0]!=data.version:
+                layout_json=json.dumps(self._layout_value(),cls=plotly.utils.PlotlyJSONEncoder)
+                self._layout_json=(data.version,layout_json.split(PAGE_ID_SLOT))
+            return flask.Response(uuid.uuid4().hex.join(self._layout_json[1]),mimetype="application/json")
+
+    def callback(self,*args,**kwargs):
+        ##Every callback traced when BUNKER_INSTRUMENT is set
+        register=super().callback(*args,**kwargs)
+
+        def wrap(func):
+            @wraps(func)
+            def run(*args,**kwargs):
+                with pin():
+                    return func(*args,**kwargs)
+            return register(instrument.traced(run))
+        return wrap
+
+# Initialise the app
+app = Dashboard(__name__,
+                meta_tags=[{"name": "viewport", "content": "width=device-width, initial-scale=1"}])
+
+app.title="Bunker Analytics"
+server=app.server
+
+def trusted(token):
+    '''True for a request carrying the bearer token when one is set, otherwise from the host itself'''
+    if token:
+        return flask.request.headers.get("Authorization")=="Bearer {}".format(token)
+    return flask.request.remote_addr in ("127.0.0.1","::1")
+
+##Server-Timing headers, /metrics and the slow request profiler (BUNKER_INSTRUMENT=1).
+##Both routes from the host or with the BUNKER_ADMIN_TOKEN bearer token, BUNKER_METRICS_PUBLIC=1 opens /metrics
+instrument.install(server,lambda: trusted(os.environ.get('BUNKER_ADMIN_TOKEN',None)),
+                   public_metrics=os.environ.get('BUNKER_METRICS_PUBLIC','0') not in ("","0"))
+
+# Define the app. A function, so the layout follows the current dataset
+def layout():
+    default_panels=current().panels
+    return html.Div(children=[dcc.ConfirmDialog(id='date-error',message='Wrong date range'),
+                      dcc.Store(id="page-id",data=PAGE_ID_SLOT),
+                      dcc.Store(id="panels-sent",data=[panel_key(i) for i in PANELS]),
+                      dcc.Store(id="brent-sent",data=panel_key("brent")),
+                      dcc.Store(id="default-map",data=current().static["map"]),
+                      dcc.Store(id="default-header",data=current().static["header"]),
+                      dcc.Store(id="map-view",data=None),
+                      dcc.Interval(id="jobs-poll",interval=1000,disabled=True),
+                      html.Div(id="main-header",className="container-row twelve columns",
+                                children=[
+                                  html.Div(id="header",className="div-header bg-navy",##Header
+                                      children=default_panels["header"])
+                                                        ]),
+                      html.Div(id="main-rank",className='container three columns',
+                                children=[
+                                  html.Div(id="ranking-container",children=default_panels["ranking"]
+                                           ,className='div-ranking bg-navy'),
+                                  html.Div(id="age-container",children=default_panels["age"],className='div-ops bg-navy')
+                                  ]),
+                      html.Div(id="main-map",className="container five columns",
+                                children=[
+                                    html.Div(id="map-container",children=default_panels["map"],##Map
+                                             className='div-for-maps bg-navy'),
+                                    html.Div([html.Div([html.H2("Vessel size (GT)"),slider],id="slider"),
+                                              default_panels["summary"]],                                              
+                                             className="div-for-prices bg-navy")
+                                  ],style={"margin-left":"0px","margin-right":"0px"}),
+                      html.Div(id="main-stats-price",className="container four columns",
+                                children=[
+                                    html.Div(id="service-container",children=default_panels["service"],className="div-for-service bg-navy"),
+                                    html.Div(id="waiting-container",children=default_panels["waiting"],##Waiting time
+                                             className="div-for-waiting bg-navy"),
+                                    html.Div(id="brent-container",children=default_panels["brent"],#Brent Price
+                                             className="div-for-brent bg-navy")]),
+                      html.Div(id="main-series",className="container-row twelve columns",
+                                children=[
+                                  html.Div(id="series-container",children=default_panels["series"],##Ops vs Brent
+                                           className="div-for-series bg-navy")])
+                                   ],className="main-box")
+
+app.layout=layout
+
+##A panels request running when a newer one of its page (the page-id store, one per
+##layout served, so every tab has its own) arrives is dropped (the page only shows the newest)
+latest=Latest()
+
+##Figure cache, request coalescing and background job counters of this worker
+@server.route("/cache-stats")
+def cache_stats():
+    return flask.jsonify(dict(figure_cache.stats(),superseded=latest.stats(),
+                              jobs=job_queue.stats() if job_queue is not None else None))
+
+##Operations, mean service and waiting times and Brent OHLC per period, ?fr=&to=&resolution=D|W|M
+@server.route("/series.csv")
+def series_csv():
+    args=flask.request.args
+    resolution=args.get("resolution",SERIES_RESOLUTION)
+    if resolution not in RESOLUTIONS:
+        return flask.jsonify(error="resolution is one of {}".format(", ".join(RESOLUTIONS))),400
+    try:
+        state=normalize_filters(args.get("fr",DATE_FROM),args.get("to",current().date_to))
+    except (ValueError,OverflowError) as error:
+        return flask.jsonify(error=str(error)),400
+    table=current().series.table(state.date_from,state.date_to,resolution)
+    return flask.Response(table.to_csv(float_format="%.4f",date_format="%Y-%m-%d"),mimetype="text/csv",
+                          headers={"Content-Disposition":"attachment; filename=bunker_series.csv"})
+
+def request_filters(values):
+    '''FilterState of request arguments (filters.query_filters), the default range without dates.
+    The filters of /export and /api/v1
+    Input:
+        values; function of an argument name returning its list of strings (request.args.getlist)'''
+    return query_filters(values,DATE_FROM,current().date_to)
+
+##Analytics as JSON for other services, /api/v1 (api.py)
+analytics_api=api.install(server,pin,request_filters)
+
+##Ops rows of a selection, streamed. ?format=csv|parquet&compression=gzip and the filters of request_filters
+@server.route("/export")
+def export_ops():
+    args=flask.request.args
+    fmt=args.get("format","csv")
+    compression=args.get("compression") or None
+    if fmt not in FORMATS or compression not in (None,"gzip"):
+        return flask.jsonify(error="format is one of {}, compression gzip".format(", ".join(FORMATS))),400
+    if not available(fmt):
+        return flask.jsonify(error="{} needs pyarrow, not installed".format(fmt)),501
+    try:
+        state=request_filters(args.getlist)
+    except ValueError as error:
+        return flask.jsonify(error=str(error)),400
+    ##The backend of the current dataset, kept by the generator while it streams
+    chunks=current().backend.export_chunks(state,int(os.environ.get('BUNKER_EXPORT_CHUNK',50000)))
+    stream,mimetype,name=export_stream(chunks,fmt,compression)
+    return flask.Response(stream,mimetype=mimetype,
+                          headers={"Content-Disposition":"attachment; filename="+name})
+
+@server.route("/ingest",methods=["GET","POST"])
+def ingest_ops():
+    ##POST a CSV of new ops. Allowed from the host itself or with the BUNKER_INGEST_TOKEN bearer token
+    if flask.request.method=="POST":
+        if not INGEST_DIR:
+            return flask.jsonify(error="BUNKER_INGEST_DIR is not set"),404
+        if not trusted(os.environ.get('BUNKER_INGEST_TOKEN',None)):
+            return flask.jsonify(error="not allowed"),403
+        try:
+            name=ingestor.save_upload(flask.request.get_data())
+        except (ValueError,pd.errors.ParserError) as error:
+            return flask.jsonify(error=str(error)),400
+        return flask.jsonify(file=name,**ingestor.scan())
+    data=current()
+    if ingestor is None:
+        return flask.jsonify(rows=data.backend.rows,version=data.version,last=str(data.backend.end),held=0,files=[])
+    return flask.jsonify(rows=data.backend.rows,version=data.version,last=str(data.backend.end),
+                         held=int(sum(i.shape[0] for i in ingestor.held)),files=ingestor.report[-20:])
+
+@server.before_first_request
+def watch_ingest_dir():
+    ##The polling thread of every worker, threads do not survive the fork
+    if INGEST_DIR:
+        ingestor.watch(float(os.environ.get('BUNKER_INGEST_INTERVAL',30)))
+
+@server.route("/memory-stats")
+def memory_stats():
+    ##Memory of the worker serving the request, private is its delta over the preloaded master
+    return flask.jsonify(dict(memory.usage() or dict(unavailable=True),pid=os.getpid()))
+
+###############Callbacks
+##Modal, date check and refresh of the map and header run in the browser
+##(assets/clientside.js), no worker is involved
+##Modal for missing ports
+app.clientside_callback(ClientsideFunction("bunker","close_modal"),Output('modal', 'style'),
+                        [Input('modal-close-button', 'n_clicks')],prevent_initial_call=True)
+
+##Callback for error in date
+app.clientside_callback(ClientsideFunction("bunker","date_check"),
+                        Output(component_id='date-error', component_property='displayed'),
+                        [Input('date-picker-start', 'date'),Input('date-picker-end', 'date')],
+                        prevent_initial_call=True)
+
+##Refresh button, default map and header of the layout stores
+app.clientside_callback(ClientsideFunction("bunker","default_panel"),Output('map-container', 'children'),
+                        [Input('update-button', 'n_clicks')],[State('default-map','data')],
+                        prevent_initial_call=True)
+
+app.clientside_callback(ClientsideFunction("bunker","default_panel"),Output('header', 'children'),
+                        [Input('update-button', 'n_clicks')],[State('default-header','data')],
+                        prevent_initial_call=True)
+
+##Panels callback. One selection is filtered once and every panel built from it
+@app.callback([Output("service-container","children"),
+               Output("waiting-container","children"),
+               Output("age-container","children"),
+               Output("ranking-container","children"),
+               Output("summary","children"),
+               Output("panels-sent","data"),
+               Output("jobs-poll","disabled")],
+              [Input('update-button',"n_clicks"),
+               Input('ports-dropdown', 'value'),
+                      Input("types-dropdown", "value"),
+                      Input('date-picker-start', 'date'),
+                      Input('date-picker-end', 'date'),
+                      Input('range-slider','value'),
+                      Input("jobs-poll","n_intervals")],
+              [State("panels-sent","data"),
+               State("page-id","data")],
+              prevent_initial_call=True)
+
+def panels_update(click,ports_val,types_val,date_s,date_e,size,poll,sent,page):
+    ticket=latest.begin(page,"panels")
+    ##If no value is entered then keep default
+    if not ports_val:
+        ports_val=["full"]
+    if not types_val:
+        types_val=["full"]
+    data=current()
+    if not date_s:
+        date_s=DATE_FROM
+    if not date_e:
+        date_e=data.date_to
+    if not size:
+        size=["full"]
+    state=normalize_filters(date_s,date_e,ports_val,types_val,size)
+    filters=dict(fr=date_s,to=date_e,port=ports_val,type_vessel=types_val,size=size)
+    builders=dict(service=lambda: stats_graph(**filters),waiting=lambda: stats_graph(graph="waiting",**filters),
+                  age=lambda: barges(**filters),ranking=lambda: ranking(**filters),summary=lambda: summary(**filters))
+    ##Click trigger or default selection
+    if click is not None or state==normalize_filters(DATE_FROM,data.date_to):
+        keys=[panel_key(i) for i in PANELS]
+    ##Distributions are limited to 5 ports
+    elif len(ports_val)>5:
+        keys=[panel_key(i) if i in ["service","waiting"] else panel_key(i,state) for i in PANELS]
+    else:
+        keys=[panel_key(i,state) for i in PANELS]
+    
+    ##Panels already shown by the browser are not sent again
+    sent=sent or [None]*len(PANELS)
+    if keys==list(sent):
+        raise PreventUpdate
+    output=[]
+    tasks={}
+    background=job_queue is not None and job_queue.active()
+    for k,(name,key,before) in enumerate(zip(PANELS,keys,sent)):
+        if key==before:
+            output.append(dash.no_update)
+        elif key==panel_key(name):
+            output.append(data.panels[name])
+        elif latest.superseded(ticket):
+            ##A newer selection of the session is on its way, its response replaces this one
+            raise PreventUpdate
+        elif background and name in HEAVY:
+            ##Placeholder until the job is done, the browser polls with jobs-poll
+            panel,keys[k]=background_panel(name,filters,key,before)
+            output.append(panel)
+        else:
+            output.append(None)
+            tasks[k]=builders[name]
+    for k,panel in zip(tasks,build_all(data,list(tasks.values()),ticket)):
+        output[k]=panel
+    if keys==list(sent):
+        raise PreventUpdate
+    return output+[keys,not any(i.startswith("pending|") for i in keys)]
+
+##Brent update
+@app.callback([Output("brent-container","children"),
+               Output("brent-sent","data")],
+              [Input('update-button',"n_clicks"),
+              Input('date-picker-start', 'date'),
+                      Input('date-picker-end', 'date')],
+              [State("brent-sent","data")],
+              prevent_initial_call=True)
+
+def brent_update(click,date_s,date_e,sent):
+    data=current()
+    if not date_s:
+        date_s=DATE_FROM
+    if not date_e:
+        date_e=data.date_to
+    state=normalize_filters(date_s,date_e)
+    if click is not None or state==normalize_filters(DATE_FROM,data.date_to):
+        key=panel_key("brent")
+    else:
+        key=panel_key("brent",state)
+    if key==sent:
+        raise PreventUpdate
+    return [data.panels["brent"] if key==panel_key("brent") else brent(fr=date_s,to=date_e),key]
+
+##Series update, dates and resolution of the operations vs Brent panel
+@app.callback([Output("series","figure"),
+               Output("series-download","href")],
+              [Input('update-button',"n_clicks"),
+               Input('date-picker-start', 'date'),
+               Input('date-picker-end', 'date'),
+               Input('series-resolution','value')],
+              prevent_initial_call=True)
+
+def series_update(click,date_s,date_e,resolution):
+    data=current()
+    if click is not None or not date_s:
+        date_s=DATE_FROM
+    if click is not None or not date_e:
+        date_e=data.date_to
+    if resolution not in RESOLUTIONS:
+        resolution=SERIES_RESOLUTION
+    return [series_graph(date_s,date_e,resolution),series_link(date_s,date_e,resolution)]
+
+##Map selection, box and lasso resolved against the port index
+@app.callback(Output("ports-dropdown","value"),
+              [Input("map","selectedData")],prevent_initial_call=True)
+
+def display_selected_data(geo_select):
+    if geo_select is None:
+        return None
+    index=current().port_index
+    if (geo_select.get("range") or {}).get("mapbox"):
+        (lon0,lat0),(lon1,lat1)=geo_select["range"]["mapbox"]
+        codes=index.codes[index.bbox(min(lon0,lon1),min(lat0,lat1),max(lon0,lon1),max(lat0,lat1))]
+    elif (geo_select.get("lassoPoints") or {}).get("mapbox"):
+        codes=index.codes[index.lasso(geo_select["lassoPoints"]["mapbox"])]
+    else:
+        ##Clicked markers, a cluster stands for all its ports
+        codes=[code for point in geo_select["points"]
+               for code in (point.get("customdata") or point["text"]).split()]
+    return list(dict.fromkeys(codes))
+
+##Markers of the map view, sent again only when the clusters change
+@app.callback([Output("map","figure"),Output("map-view","data")],
+              [Input("map","relayoutData")],[State("map-view","data")],prevent_initial_call=True)
+
+def map_view(relayout,sent):
+    if len(current().port_index)<=MAP_MAX_MARKERS:
+        raise PreventUpdate
+    key=[" ".join(current().port_index.codes[i]) for i in map_markers(relayout)]
+    if key==sent:
+        raise PreventUpdate
+    return [bunker_map(relayout=relayout)[0].figure,key]
+
+# Run the app
+if __name__ == '__main__':
+    if job_queue is not None:
+        job_queue.start()
+    app.run_server(debug=True)
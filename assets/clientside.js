@@ -0,0 +1,29 @@
+// Browser side callbacks of the dashboard (app.clientside_callback). They only
+// toggle styles, compare the picked dates or copy values, no worker is involved.
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    bunker: {
+        // Modal for missing ports
+        close_modal: function(n) {
+            if (n !== null && n !== undefined && n > 0) {
+                return {"display": "none"};
+            }
+            return null;
+        },
+
+        // Error in date, the pickers send YYYY-MM-DD
+        date_check: function(value_start, value_end) {
+            if (value_start && value_end) {
+                return new Date(value_start) > new Date(value_end);
+            }
+            return false;
+        },
+
+        // Refresh button, the default map or header kept in a dcc.Store of the layout
+        default_panel: function(n_clicks, panel) {
+            if (!n_clicks) {
+                return window.dash_clientside.no_update;
+            }
+            return JSON.parse(JSON.stringify(panel));
+        }
+    }
+});
@@ -0,0 +1,199 @@
+"""
+Query backends of the dashboard panels.
+
+The panel builders never touch the ops rows, they ask a backend for the
+aggregates of a FilterState: operations per port, barge age bins, the summary
+of one port and the trimmed service/waiting densities. Three backends answer
+the same calls:
+
+    FrameBackend     the ops table in memory (store.load) with the aggregate cube
+    PartitionedOps   month x port partitions on disk (partitions.py, BUNKER_PARTITIONS)
+    SQLiteOps        an indexed SQLite file shared by the workers (sqlbackend.py, BUNKER_SQLITE)
+"""
+import numpy as np
+import pandas as pd
+import instrument
+from cube import AGE_WIDTH
+from density import grouped_kde, trim_groups
+from filters import FilterStore, counts, date_window, selection_mask
+
+##Columns of the exported rows, every backend yields them with these dtypes
+EXPORT_COLUMNS={"start_of_service":"datetime64[ns]","bunkering_port":object,"code":object,"ConType":object,
+                "VesselGT":"float64","barge_age_at_op":"int64","service_time":"float64","waiting_time":"float64"}
+
+def export_frame(**columns):
+    '''Dataframe of exported rows from column arrays, EXPORT_COLUMNS order and dtypes. Text as
+    plain strings, missing vessel types as None'''
+    frame=pd.DataFrame({col:np.asarray(columns[col]).astype(dtype) for col,dtype in EXPORT_COLUMNS.items()})
+    frame["ConType"]=frame.ConType.where(frame.ConType.notna(),None)
+    return frame
+
+class Backend:
+    '''Queries behind the panel builders. Subclasses set rows (operations), end (last
+    start_of_service, Timestamp), codes (port codes), port_options ((name, code) in
+    order of appearance) and type_options (vessel types in order of appearance)'''
+    rows=0
+    end=None
+    codes=()
+    port_options=()
+    type_options=()
+
+    def code_counts(self,state):
+        '''Operations per port code of a selection
+        Input:
+            state; FilterState
+        Returns. Series of counts indexed by code, sorted descending, zeros dropped'''
+        raise NotImplementedError
+
+    def port_counts(self,state):
+        '''Operations per port name of a selection, same layout as code_counts'''
+        raise NotImplementedError
+
+    def age_histogram(self,state,width=2):
+        '''Operations per barge age bin of a selection
+        Input:
+            state; FilterState
+            width; bin width in years, bins [k*width,(k+1)*width)
+        Returns. Bin starts, counts (numpy arrays)'''
+        raise NotImplementedError
+
+    def port_stats(self,state,code,q=0.95):
+        '''Summary of one port within a selection
+        Input:
+            state; FilterState
+            code; port code
+            q; quantile of the trimmed means
+        Returns. Dict with name, ops, age (mean barge age), service and waiting (means of
+            the times up to their q quantile)'''
+        raise NotImplementedError
+
+    def grouped_kde(self,state,column,labels,q=0.95,clip=None,points=500):
+        '''Kernel densities of the ports of labels, each trimmed to its q quantile
+        Input:
+            state; FilterState
+            column; service_time or waiting_time
+            labels; port names, one density each
+            q; quantile kept
+            clip; values above it replaced by it, after the trimming
+            points; grid size
+        Returns. grid (points), densities (len(labels) x points), [lo,hi) grid slice of each port range'''
+        raise NotImplementedError
+
+    def export_chunks(self,state,chunksize=50000):
+        '''Rows of a selection, for the export
+        Input:
+            state; FilterState
+            chunksize; rows per chunk at most
+        Returns. Generator of dataframes (export_frame), one chunk in memory at a time'''
+        raise NotImplementedError
+
+    def time_chunks(self):
+        '''start_of_service, service_time and waiting_time of every operation, for the time series
+        Returns. Generator of (times (datetime64), service, waiting) numpy arrays, chunk by chunk'''
+        raise NotImplementedError
+
+class FrameBackend(Backend):
+    '''Ops table in memory. Ranking, barge age bins, summary and the 95th percentile cutoffs of the
+    densities from the cube when it covers the GT range of a selection, everything
+    else from the filtered rows
+    Input:
+        frame; cleaned ops table (store.load("ops"))
+        cube; OpsCube of frame
+        exact; quantiles and trimmed means from the rows, not the sketches (validation)'''
+    def __init__(self,frame,cube,exact=False):
+        self.frame=frame
+        self.cube=cube
+        self.exact=exact
+        ##Shared filter stage. One selection is filtered once and reused by every panel
+        self.store=FilterStore(frame)
+        self.rows=frame.shape[0]
+        self.end=frame.start_of_service.max()
+        self.codes=frame.code.unique()
+        ##Dropdown options in order of appearance
+        self.port_options=[(row["bunkering_port"],row["code"])
+                           for index,row in frame.drop_duplicates(subset=["bunkering_port"]).iterrows()]
+        self.type_options=list(frame.dropna(subset=["ConType"]).ConType.unique())
+
+    def export_chunks(self,state,chunksize=50000):
+        ##The date window is a view, the rows of the selection are copied chunk by chunk in time order
+        window=date_window(self.frame,"start_of_service",state.date_from,state.date_to)
+        for start in range(0,window.shape[0],chunksize):
+            chunk=window.iloc[start:start+chunksize]
+            chunk=chunk[selection_mask(chunk,state)]
+            if chunk.shape[0]:
+                yield export_frame(**{col:chunk[col].values for col in EXPORT_COLUMNS})
+
+    def time_chunks(self):
+        yield self.frame.start_of_service.values,self.frame.service_time.values,self.frame.waiting_time.values
+
+    def filter(self,state):
+        '''Filtered ops of a selection (read only)'''
+        df_in=self.store.get(state)
+        instrument.note(rows=df_in.shape[0])
+        instrument.lap("filter")
+        return df_in
+
+    def code_counts(self,state):
+        if self.cube.covers(state):
+            return self.cube.code_counts(state)
+        return counts(self.filter(state).code)
+
+    def port_counts(self,state):
+        if self.cube.covers(state):
+            return self.cube.port_counts(state)
+        return counts(self.filter(state).bunkering_port)
+
+    def age_histogram(self,state,width=2):
+        if self.cube.covers(state) and width==AGE_WIDTH:
+            return self.cube.age_histogram(state)
+        count=np.bincount((self.filter(state).barge_age_at_op.values//width).astype("int64"))
+        return np.arange(len(count))*width,count
+
+    def quantile_buckets(self,state,column,labels,q=0.95):
+        '''Sketch bucket of the q quantile of a time column per port name, from the merged cube sketches
+        Input:
+            state; FilterState covered by the cube
+            column; service_time or waiting_time
+            labels; port names
+            q; quantile
+        Returns. Numpy array (len(labels)), -1 for ports without values'''
+        names=self.cube.port_names
+        out=np.full(len(labels),-1,dtype="int64")
+        for k,label in enumerate(labels):
+            counts=sum(self.cube.port_histogram(state,code,column)[0] for code in names.index[names.values==label])
+            out[k]=self.cube.sketch.quantile_bucket(np.asarray(counts),q)
+        return out
+
+    def port_stats(self,state,code,q=0.95):
+        if self.cube.covers(state) and not self.exact:
+            stats=self.cube.port_summary(state,code)
+            ##Trimmed means from the merged sketches
+            return dict(name=self.cube.port_names[code],ops=stats["ops"],
+                        age=stats["age_sum"]/stats["ops"] if stats["ops"] else np.nan,
+                        service=self.cube.sketch.trimmed_mean(*stats["service_time"],q),
+                        waiting=self.cube.sketch.trimmed_mean(*stats["waiting_time"],q))
+        df_in=self.filter(state)
+        df_in=df_in[df_in.code==code]
+        return dict(name=self.cube.port_names[code],ops=df_in.shape[0],age=df_in.barge_age_at_op.mean(),
+                    service=df_in[df_in.service_time<=df_in.service_time.quantile(q)].service_time.mean(),
+                    waiting=df_in[df_in.waiting_time<=df_in.waiting_time.quantile(q)].waiting_time.mean())
+
+    def grouped_kde(self,state,column,labels,q=0.95,clip=None,points=500):
+        df_in=self.filter(state)
+        ##Port of every row as its position in the labels, from the category codes
+        label_pos=np.append(pd.Index(labels).get_indexer(df_in.bunkering_port.cat.categories),-1)
+        groups=label_pos[df_in.bunkering_port.cat.codes.values]
+        if self.cube.covers(state) and not self.exact:
+            ##Cutoff of every port from its merged sketches, no sort of the rows. The values
+            ##of the buckets up to the quantile bucket are kept
+            times=np.asarray(df_in[column].values[groups>=0],dtype="float64")
+            groups=groups[groups>=0]
+            times,groups=times[~np.isnan(times)],groups[~np.isnan(times)]
+            keep=self.cube.sketch.index(times)<=self.quantile_buckets(state,column,labels,q)[groups]
+            times,groups=times[keep],groups[keep]
+        else:
+            #Outliers remove, all the ports in one pass
+            times,groups=trim_groups(df_in[column].values[groups>=0],groups[groups>=0],len(labels),q)
+        if clip is not None:
+            times=np.minimum(times,clip)
+        return grouped_kde(times,groups,len(labels),points)
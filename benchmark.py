@@ -0,0 +1,364 @@
+"""
+Load benchmark of the dashboard callbacks.
+
+Replays interaction traces (port multi-selects, vessel types, date ranges,
+slider moves, map selections, map pans and refresh clicks) against the real
+/_dash-update-component endpoint of app.server, in process through the Flask
+test client. Each interaction posts the callbacks the browser would send to the
+server for it, the clientside callbacks are left to the browser.
+The ops table is resampled to 1x, 10x and 100x its size (rows drawn with
+replacement, dates jittered) and written as a binary store in a temporary data
+folder. Without an ops table in the data folder (a fresh checkout) the rows are
+generated instead: Mediterranean ports of ports_positions.csv, vessel types,
+GT, dates, times and barges drawn from fixed distributions (synthetic_ops).
+Every scale and query backend runs in its own process so the peak RSS is its
+own. The backends (frame, sqlite, partitions) replay the same traces
+on the same rows.
+
+    python benchmark.py [--scales 1 10 100] [--backends frame sqlite] [--interactions 200] [--no-cache]
+
+Reports p50/p95/p99 latency per callback, throughput and peak RSS, and appends
+the run (with the git commit) to benchmark_results.jsonl. --compare <commit>
+prints the change against the last stored run of that commit, otherwise the
+other backends are compared with frame.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import partitions
+import sqlbackend
+import store
+
+DEFAULT_RESULTS="benchmark_results.jsonl"
+BACKENDS=["frame","sqlite","partitions"]
+
+##Synthetic data
+##Ops rows of the real table, the rows generated at scale 1 without it
+BASE_ROWS=20000
+VESSEL_TYPES=["Bulk Carrier","Container","Cruise","Tanker"]
+##Ports of the generated rows: lat, long box of the Mediterranean
+MED_BOX=((30,46),(-6,36))
+
+def synthetic_ops(rows,ports,seed=0,n_ports=20,n_barges=400):
+    '''Raw ops rows (the columns of the ops CSV) drawn from fixed distributions
+    Input:
+        rows; number of rows
+        ports; ports dataframe (ports_positions.csv)
+        seed; random seed
+        n_ports; ports of the Mediterranean box used, with Zipf distributed operations
+        n_barges; barges, each with its build year
+    Returns. Dataframe, clean it with store.clean_ops'''
+    rng=np.random.default_rng(seed)
+    (lat_lo,lat_hi),(lon_lo,lon_hi)=MED_BOX
+    med=ports[ports.Lat.between(lat_lo,lat_hi)&ports.Long.between(lon_lo,lon_hi)]
+    med=med.drop_duplicates("PortCode").iloc[:n_ports]
+    weights=1/np.arange(1,med.shape[0]+1)
+    port=rng.choice(med.shape[0],rows,p=weights/weights.sum())
+    first,last=np.datetime64("2014-01-01T00:00:00"),np.datetime64("2019-06-01T00:00:00")
+    start=first+np.sort(rng.integers(0,(last-first).astype("int64"),rows)).astype("timedelta64[s]")
+    waiting=rng.lognormal(1.3,0.9,rows)
+    barge=rng.integers(0,n_barges,rows)
+    built=rng.integers(1970,2013,n_barges)
+    return pd.DataFrame({"start_of_service":start,
+                         "vessel_inside_port":start-(waiting*3600).astype("timedelta64[s]"),
+                         "bunkering_port":med["BE PORT_NA"].values[port],
+                         "code":med.PortCode.values[port],
+                         "ConType":rng.choice(VESSEL_TYPES,rows),
+                         "VesselGT":rng.integers(1000,220000,rows),
+                         "service_time":rng.lognormal(1.6,0.7,rows),
+                         "BargeBuilt":built[barge],
+                         "barge_imo":9000000+barge})
+
+def synthetic_data(scale,data_dir,source="data",seed=0):
+    '''Writes the tables of a data folder with the ops resampled to scale times their rows
+    Input:
+        scale; size factor of the ops table
+        data_dir; destination data folder
+        source; data folder with the real tables. Without its ops table scale*BASE_ROWS rows
+            are generated (synthetic_ops)
+        seed; random seed
+    Returns. Number of ops rows'''
+    rng=np.random.default_rng(seed)
+    if not (os.path.exists(os.path.join(source,store.OPS_CSV))
+            or os.path.exists(os.path.join(store.store_path("ops",source),"manifest.json"))):
+        ops=store.clean_ops(synthetic_ops(int(BASE_ROWS*scale),store.load("ports",source),seed))
+        scale=1
+    else:
+        ops=store.load("ops",source)
+    if scale!=1:
+        rows=rng.integers(0,ops.shape[0],int(ops.shape[0]*scale))
+        ops=ops.iloc[rows].reset_index(drop=True)
+        ##Jitter within +-12 hours so the copies do not share timestamps
+        shift=rng.integers(-12*3600,12*3600,ops.shape[0]).astype("timedelta64[s]")
+        ops=ops.assign(start_of_service=ops.start_of_service+shift,
+                       vessel_inside_port=ops.vessel_inside_port+shift)
+        ops=ops.sort_values(by=["start_of_service"],kind="mergesort").reset_index(drop=True)
+    store.write_table(ops,store.store_path("ops",data_dir))
+    for name in ["brent","ports"]:
+        store.write_table(store.load(name,source),store.store_path(name,data_dir))
+    return int(ops.shape[0])
+
+def backend_data(backend,data_dir):
+    '''Writes the files of a query backend from the ops store of a data folder
+    Returns. Environment variables selecting the backend'''
+    if backend=="sqlite":
+        path=os.path.join(data_dir,"ops.sqlite")
+        if not os.path.exists(path):
+            sqlbackend.from_frame(store.load("ops",data_dir),path)
+        return {"BUNKER_SQLITE":path}
+    if backend=="partitions":
+        path=os.path.join(data_dir,"partitions")
+        if not os.path.exists(path):
+            partitions.from_frame(store.load("ops",data_dir),path)
+        return {"BUNKER_PARTITIONS":path}
+    return {}
+
+##Interaction traces
+def interaction_trace(codes,types,marks,length=200,seed=0):
+    '''Synthetic session of a user. The selection is carried from one interaction to the next
+    Input:
+        codes; port codes of the ports dropdown
+        types; vessel types of the types dropdown
+        marks; slider marks
+        length; number of interactions
+        seed; random seed
+    Returns. List of (interaction kind, selection dict)'''
+    rand=random.Random(seed)
+    days=np.arange(np.datetime64("2014-01-01"),np.datetime64("2019-06-01"))
+    default=dict(ports=None,types=None,start=None,end=None,size=None,view=None)
+    state=dict(default)
+    trace=[]
+    for _ in range(length):
+        kind=rand.choice(["ports","ports","types","dates","slider","map","pan","refresh"])
+        if kind=="ports":
+            state["ports"]=rand.sample(codes,rand.choice([1,1,2,3,5,7]))
+        elif kind=="types":
+            state["types"]=rand.sample(types,rand.randint(1,2))
+        elif kind=="dates":
+            start,end=sorted(rand.sample(range(len(days)),2))
+            state["start"],state["end"]=str(days[start]),str(days[end])
+        elif kind=="slider":
+            low,high=sorted(rand.sample(range(len(marks)),2))
+            state["size"]=[marks[low],marks[high]]
+        elif kind=="map":
+            state["ports"]=rand.sample(codes,rand.randint(1,4))
+        elif kind=="pan":
+            ##relayoutData of a pan or zoom of the Mediterranean
+            state["view"]={"mapbox.center":{"lat":rand.uniform(31,45),"lon":rand.uniform(-6,36)},
+                           "mapbox.zoom":rand.uniform(3,7)}
+        else:
+            state=dict(default)
+        trace.append((kind,dict(state)))
+    return trace
+
+class Client:
+    '''Posts callbacks to the Dash endpoint of an app, as the browser renderer does'''
+    def __init__(self,app):
+        self.app=app
+        self.client=app.server.test_client()
+        self.callbacks={}
+        for callback in app._callback_list:
+            ##Clientside callbacks run in the browser
+            if callback.get("clientside_function"):
+                continue
+            outputs=callback["output"]
+            if outputs.startswith(".."):
+                outputs=[i.rsplit(".",1) for i in outputs[2:-2].split("...")]
+                outputs=[{"id":i,"property":p} for i,p in outputs]
+            else:
+                i,p=outputs.rsplit(".",1)
+                outputs={"id":i,"property":p}
+            ##Named after the callback function
+            name=app.callback_map[callback["output"]]["callback"].__wrapped__.__name__
+            self.callbacks[name]=(callback,outputs)
+
+    def fire(self,name,values,changed):
+        '''Posts a callback
+        Input:
+            name; callback function name
+            values; dict "id.property": value of the inputs
+            changed; triggering "id.property"
+        Returns. response, seconds'''
+        callback,outputs=self.callbacks[name]
+        inputs=[dict(i,value=values.get(i["id"]+"."+i["property"])) for i in callback["inputs"]]
+        body={"output":callback["output"],"outputs":outputs,"inputs":inputs,
+              "state":[dict(i,value=values.get(i["id"]+"."+i["property"])) for i in callback.get("state",[])],
+              "changedPropIds":[changed]}
+        start=time.perf_counter()
+        response=self.client.post("/_dash-update-component",json=body)
+        return response,time.perf_counter()-start
+
+def replay(client,trace):
+    '''Fires the callbacks of every interaction of a trace
+    Returns. dict callback name: list of seconds, total seconds'''
+    timings={}
+    clicks=0
+    def post(name,values,changed):
+        ##A trace posting a callback the app does not serve would leave its traffic out of the timings
+        if name not in client.callbacks:
+            raise KeyError("{} is not a server callback of the app".format(name))
+        response,seconds=client.fire(name,values,changed)
+        if response.status_code not in (200,204):
+            raise RuntimeError("{} returned {}".format(name,response.status_code))
+        timings.setdefault(name,[]).append(seconds)
+        return response
+    start=time.perf_counter()
+    for kind,state in trace:
+        values={"ports-dropdown.value":state["ports"],"types-dropdown.value":state["types"],
+                "date-picker-start.date":state["start"],"date-picker-end.date":state["end"],
+                "range-slider.value":state["size"],"update-button.n_clicks":None,"series-resolution.value":"W"}
+        if kind=="refresh":
+            clicks+=1
+            values["update-button.n_clicks"]=clicks
+            for name in ["panels_update","brent_update","series_update"]:
+                post(name,values,"update-button.n_clicks")
+            continue
+        if kind=="pan":
+            post("map_view",{"map.relayoutData":state["view"]},"map.relayoutData")
+            continue
+        if kind=="map":
+            points={"points":[{"text":i} for i in state["ports"]]}
+            post("display_selected_data",{"map.selectedData":points},"map.selectedData")
+        changed={"ports":"ports-dropdown.value","map":"ports-dropdown.value","types":"types-dropdown.value",
+                 "dates":"date-picker-start.date","slider":"range-slider.value"}[kind]
+        post("panels_update",values,changed)
+        if kind=="dates":
+            post("brent_update",values,changed)
+            post("series_update",values,changed)
+    return timings,time.perf_counter()-start
+
+def peak_rss():
+    '''Peak resident memory of this process in MiB. VmHWM, ru_maxrss keeps the peak of
+    the parent across fork and exec'''
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1])/1024,1)
+    except OSError:
+        pass
+    ##ru_maxrss is in KiB on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024,1)
+
+def run_scale(scale,interactions,seed,no_cache,data_dir,backend="frame"):
+    '''Benchmark of one scale and backend, in this process. Imports the app on a data folder
+    written by synthetic_data and backend_data'''
+    os.environ["BUNKER_DATA_DIR"]=data_dir
+    for name in ["BUNKER_CUBE","BUNKER_FIGURE_CACHE","BUNKER_SQLITE","BUNKER_PARTITIONS"]:
+        os.environ.pop(name,None)
+    os.environ.update(backend_data(backend,data_dir))
+    if no_cache:
+        os.environ["BUNKER_FIGURE_CACHE_SIZE"]="0"
+    start=time.perf_counter()
+    import app
+    startup=time.perf_counter()-start
+    client=Client(app.app)
+    start=time.perf_counter()
+    client.client.get("/")
+    client.client.get("/_dash-layout")
+    layout=time.perf_counter()-start
+
+    codes=sorted(app.current().backend.codes)
+    types=sorted(app.current().backend.type_options)
+    timings,total=replay(client,interaction_trace(codes,types,app.list_of_marks,interactions,seed))
+    requests=sum(len(i) for i in timings.values())
+    return dict(scale=scale,backend=backend,rows=app.current().backend.rows,
+                startup_s=round(startup,3),layout_ms=round(layout*1000,2),
+                interactions=interactions,requests=requests,
+                throughput_rps=round(requests/total,2),interactions_per_s=round(interactions/total,2),
+                peak_rss_mib=peak_rss(),
+                callbacks={name:dict(n=len(values),
+                                     **{"p{}_ms".format(q):round(float(np.percentile(values,q))*1000,2) for q in (50,95,99)})
+                           for name,values in sorted(timings.items())})
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git","rev-parse","--short","HEAD"],stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError,subprocess.CalledProcessError):
+        return "unknown"
+
+def describe(result,baseline=None):
+    '''Text report of a scale, with the ratio to a baseline result when given'''
+    lines=["scale {scale}x {backend}: {rows:,} rows, startup {startup_s}s, layout {layout_ms}ms, "
+           "{throughput_rps} req/s, peak rss {peak_rss_mib} MiB".format(**result)]
+    for name,values in result["callbacks"].items():
+        line="    {:<22}n {:>4}  p50 {:>8.2f}  p95 {:>8.2f}  p99 {:>8.2f} ms".format(
+            name,values["n"],values["p50_ms"],values["p95_ms"],values["p99_ms"])
+        before=(baseline or {}).get("callbacks",{}).get(name)
+        if before:
+            line+="  (p50 x{:.2f}, p95 x{:.2f})".format(values["p50_ms"]/max(before["p50_ms"],1e-9),
+                                                       values["p95_ms"]/max(before["p95_ms"],1e-9))
+        lines.append(line)
+    return "\n".join(lines)
+
+def stored_runs(path,commit):
+    '''Results by (scale, backend) of the last stored run of a commit'''
+    out={}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                run=json.loads(line)
+                if run["commit"].startswith(commit) or commit.startswith(run["commit"]):
+                    out={(i["scale"],i.get("backend","frame")):i for i in run["results"]}
+    return out
+
+def main():
+    parser=argparse.ArgumentParser(description="Replays dashboard interactions against the Dash callback endpoint")
+    parser.add_argument("--scales",type=float,nargs="+",default=[1,10,100],help="ops table size factors")
+    parser.add_argument("--backends",nargs="+",choices=BACKENDS,default=["frame"],help="query backends")
+    parser.add_argument("--interactions",type=int,default=200,help="interactions per scale")
+    parser.add_argument("--seed",type=int,default=0)
+    parser.add_argument("--no-cache",action="store_true",help="disables the figure cache")
+    parser.add_argument("--data",default="data",help="data folder with the real tables")
+    parser.add_argument("--results",default=DEFAULT_RESULTS,help="JSON lines file of the stored runs")
+    parser.add_argument("--compare",default=None,help="commit of a stored run to compare with")
+    parser.add_argument("--scale",type=float,default=None,help=argparse.SUPPRESS)
+    parser.add_argument("--backend",default="frame",help=argparse.SUPPRESS)
+    args=parser.parse_args()
+
+    ##Child process of one scale and backend on a synthetic data folder, prints its result
+    if args.scale is not None:
+        print(json.dumps(run_scale(args.scale,args.interactions,args.seed,args.no_cache,args.data,args.backend)))
+        return
+
+    baseline=stored_runs(args.results,args.compare) if args.compare else {}
+    results=[]
+    for scale in args.scales:
+        ##Same rows for every backend
+        data_dir=tempfile.mkdtemp(prefix="bunker-bench-")
+        try:
+            synthetic_data(scale,data_dir,args.data,args.seed)
+            frame=None
+            for backend in sorted(set(args.backends),key=BACKENDS.index):
+                backend_data(backend,data_dir)
+                command=[sys.executable,os.path.abspath(__file__),"--scale",str(scale),"--backend",backend,
+                         "--interactions",str(args.interactions),"--seed",str(args.seed),
+                         "--data",data_dir]
+                if args.no_cache:
+                    command.append("--no-cache")
+                output=subprocess.check_output(command,cwd=os.path.dirname(os.path.abspath(__file__)))
+                result=json.loads(output.decode().strip().splitlines()[-1])
+                results.append(result)
+                frame=result if backend=="frame" else frame
+                print(describe(result,baseline.get((scale,backend)) if args.compare else
+                               (frame if backend!="frame" else None)),flush=True)
+        finally:
+            shutil.rmtree(data_dir,ignore_errors=True)
+
+    with open(args.results,"a") as f:
+        f.write(json.dumps(dict(commit=git_commit(),date=time.strftime("%Y-%m-%dT%H:%M:%S"),
+                                interactions=args.interactions,seed=args.seed,no_cache=args.no_cache,
+                                backends=args.backends,
+                                results=results))+"\n")
+
+if __name__=="__main__":
+    main()
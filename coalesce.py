@@ -0,0 +1,108 @@
+"""
+Coalescing of concurrent callback work.
+
+Dragging the GT slider or stepping through the dates fires the panel callbacks
+for every intermediate value, and the browser throws away all the responses but
+the last. Two helpers keep the workers on the latest selection:
+
+    SingleFlight  one computation per key at a time. Requests asking for a key
+                  being computed wait for it and share its result
+    Latest        the latest request of every page (browser tab) and callback. An
+                  older request still running is dropped at its next check
+
+Both are per worker process: a request of the same page served by another
+worker is not seen, the figure cache file is what workers share.
+"""
+from collections import OrderedDict
+import itertools
+import threading
+
+class _Call:
+    ##Computation in flight and its outcome
+    def __init__(self):
+        self.done=threading.Event()
+        self.value=None
+        self.error=None
+
+class SingleFlight:
+    '''Shares one computation between the concurrent callers of the same key'''
+    def __init__(self):
+        self._calls={}
+        self._lock=threading.Lock()
+        self.counters=dict(leaders=0,shared=0)
+
+    def do(self,key,func):
+        '''Runs func once for all the callers of key arriving while it runs
+        Input:
+            key; hashable key of the computation
+            func; function without arguments
+        Returns. (result of func, True for the caller that ran it). Its exception is
+            raised to every caller'''
+        with self._lock:
+            call=self._calls.get(key)
+            leader=call is None
+            if leader:
+                call=self._calls[key]=_Call()
+            self.counters["leaders" if leader else "shared"]+=1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value,False
+        try:
+            call.value=func()
+        except BaseException as error:
+            call.error=error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.value,True
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters,in_flight=len(self._calls))
+
+class Latest:
+    '''Sequence number of the latest request of every (page, callback)
+    Input:
+        maxsize; pages remembered, the least recent ones are forgotten'''
+    def __init__(self,maxsize=4096):
+        self.maxsize=maxsize
+        self._latest=OrderedDict()
+        self._lock=threading.Lock()
+        self._count=itertools.count(1)
+        self.counters=dict(requests=0,dropped=0)
+
+    def begin(self,page,name):
+        '''Ticket of a new request, it supersedes the running ones of the page
+        Input:
+            page; page id (one per layout served), None when unknown (never superseded)
+            name; callback
+        Returns. Ticket for superseded'''
+        if not page:
+            return None
+        key=(page,name)
+        number=next(self._count)
+        with self._lock:
+            self._latest[key]=number
+            self._latest.move_to_end(key)
+            while len(self._latest)>self.maxsize:
+                self._latest.popitem(last=False)
+            self.counters["requests"]+=1
+        return key,number
+
+    def superseded(self,ticket):
+        '''True once a newer request of the same page and callback has begun'''
+        if ticket is None:
+            return False
+        with self._lock:
+            newer=self._latest.get(ticket[0],ticket[1])!=ticket[1]
+            if newer:
+                self.counters["dropped"]+=1
+        return newer
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters,pages=len(self._latest))
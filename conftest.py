@@ -0,0 +1,53 @@
+"""
+Shared fixtures of the tests: a data folder with generated ops (benchmark.synthetic_data)
+and random dashboard selections.
+"""
+import os
+import random
+import numpy as np
+import pytest
+import store
+from filters import normalize_filters
+
+DATA=os.path.join(os.path.dirname(os.path.abspath(__file__)),"data")
+##GT buckets of the cube, the slider marks of app.py
+GT_EDGES=list(range(1000,220000,21900))+[220000]
+
+@pytest.fixture(scope="session")
+def data_dir(tmp_path_factory):
+    import benchmark
+    path=str(tmp_path_factory.mktemp("data"))
+    benchmark.synthetic_data(0.5,path,source=DATA,seed=0)
+    return path
+
+@pytest.fixture(scope="session")
+def ops(data_dir):
+    return store.load("ops",data_dir)
+
+def random_states(ops,n,seed=0,on_grid=None):
+    '''Random selections of an ops table
+    Input:
+        ops; ops table
+        n; number of selections
+        seed; random seed
+        on_grid; True for GT ranges on GT_EDGES (covered by the cube), False off them,
+            None for both
+    Returns. List of FilterState'''
+    rand=random.Random(seed)
+    days=np.arange(np.datetime64("2013-12-01"),np.datetime64("2019-07-01"))
+    codes=list(ops.code.cat.categories)
+    types=list(ops.ConType.cat.categories)
+    states=[]
+    for i in range(n):
+        start,end=sorted(rand.sample(range(len(days)),2))
+        port=rand.sample(codes,rand.choice([1,1,2,3,5])) if rand.random()<0.7 else ["full"]
+        type_vessel=rand.sample(types,rand.randint(1,2)) if rand.random()<0.5 else ["full"]
+        grid=on_grid if on_grid is not None else rand.random()<0.5
+        if rand.random()<0.3:
+            size=["full"]
+        elif grid:
+            size=sorted(rand.sample(GT_EDGES,2))
+        else:
+            size=sorted(rand.uniform(1000,220000) for _ in range(2))
+        states.append(normalize_filters(str(days[start]),str(days[end]),port,type_vessel,size))
+    return states
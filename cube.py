@@ -0,0 +1,361 @@
+"""
+Aggregate cube of the bunkering operations.
+
+Cells are month x port code x vessel type (ConType) x GT bucket. Operation counts
+and sums are held as prefix sums over the months, so any range of whole months
+is answered with two lookups. Service and waiting times are kept per cell as log
+bucketed histograms (mergeable quantile sketches, relative accuracy alpha) for
+the 95th percentile cutoffs and trimmed means, so any selection gets them by
+adding a few histograms. Barge ages are counted in AGE_WIDTH year bins per occupied
+port x type x GT cell, prefix summed over the months as well. Rows of the partial
+months at the edges of a date window are read exactly from the sorted ops table.
+"""
+import math
+import numpy as np
+import pandas as pd
+
+##Years of the barge age bins
+AGE_WIDTH=2
+
+##Months are keyed year*12+month-1
+def month_start(key):
+    return pd.Timestamp(year=int(key)//12,month=int(key)%12+1,day=1)
+
+class LogSketch:
+    '''Bucket layout of a log spaced histogram with relative accuracy alpha.
+    Histograms on the same layout are merged by adding their bucket arrays.
+    Values below min_value (zero or negative times) share the first bucket.'''
+    def __init__(self,alpha=0.01,min_value=0.01,max_value=1e5):
+        self.alpha=alpha
+        self.min_value=min_value
+        self.max_value=max_value
+        self.gamma=(1+alpha)/(1-alpha)
+        self.nbins=int(math.ceil(math.log(max_value/min_value)/math.log(self.gamma)))+1
+
+    def index(self,values):
+        '''Bucket of every value'''
+        values=np.asarray(values,dtype="float64")
+        ratio=np.maximum(np.nan_to_num(values,nan=self.min_value),self.min_value)/self.min_value
+        return np.clip(np.ceil(np.log(ratio)/math.log(self.gamma)),0,self.nbins-1).astype("int32")
+
+    def histogram(self,values):
+        '''Counts and sums per bucket of raw values'''
+        values=np.asarray(values,dtype="float64")
+        values=values[~np.isnan(values)]
+        idx=self.index(values)
+        return (np.bincount(idx,minlength=self.nbins).astype("int64"),
+                np.bincount(idx,weights=values,minlength=self.nbins).astype("float64"))
+
+    def _rank_bucket(self,counts,q):
+        ##Bucket holding the lower interpolation point of pandas quantile and its rank
+        rank=math.floor(q*(counts.sum()-1))
+        return int(np.searchsorted(np.cumsum(counts),rank+1)),rank
+
+    def quantile_bucket(self,counts,q):
+        '''Bucket holding the q quantile, -1 for an empty histogram. The values of the buckets
+        up to it hold every value up to the quantile'''
+        if counts.sum()==0:
+            return -1
+        return self._rank_bucket(counts,q)[0]
+
+    def quantile(self,counts,q):
+        '''Quantile estimate, within alpha of the true value'''
+        if counts.sum()==0:
+            return np.nan
+        i,_=self._rank_bucket(counts,q)
+        if i==0:
+            return self.min_value
+        return 2*self.min_value*self.gamma**i/(self.gamma+1)
+
+    def trimmed_mean(self,counts,sums,q):
+        '''Mean of the values up to the q quantile'''
+        if counts.sum()==0:
+            return np.nan
+        i,rank=self._rank_bucket(counts,q)
+        ##The rank+1 smallest values, the last bucket taken at its own mean
+        below=counts[:i].sum()
+        need=rank+1-below
+        return (sums[:i].sum()+need*sums[i]/counts[i])/(below+need)
+
+class OpsCube:
+    '''Month x port x type x GT bucket aggregates of an ops table.
+    Built with OpsCube.from_frame, persisted with save/load.'''
+    def __init__(self,frame,arrays,sketch):
+        self.frame=frame
+        self.sketch=sketch
+        self.__dict__.update(arrays)
+        self.ports=pd.Index(self.ports)
+        self.types=pd.Index(self.types)
+        self.port_names=pd.Series(self.names,index=self.ports)
+        self.months=self.ops.shape[0]-1
+        self._first=np.datetime64(month_start(self.month0),"M")
+        self._port_pos={code:i for i,code in enumerate(self.ports)}
+        self._type_pos={code:i for i,code in enumerate(self.types)}
+        ##Ports sharing a name are counted together by port_counts
+        self._name_list,self._name_of=np.unique(self.names,return_inverse=True)
+        ##Port and month key of the histogram entries, sorted
+        for col in ["service_time","waiting_time"]:
+            keys=getattr(self,col)
+            setattr(self,"_"+col+"_key",keys[0].astype("int64")*(self.months+1)+keys[1])
+        ##Cell coordinates of every row, for the exact edges of a window
+        self.rows=self._cells(frame,self.gt_edges)
+        for col in ["barge_age_at_op","service_time","waiting_time"]:
+            self.rows[col]=frame[col].values
+
+    @staticmethod
+    def _cells(frame,gt_edges):
+        T=len(frame.ConType.cat.categories)+1
+        gt=frame.VesselGT.values.astype("float64")
+        codes=frame.ConType.cat.codes.values
+        return {"time":frame.start_of_service.values,
+                "port":frame.code.cat.codes.values,
+                ##Missing type on the last slot
+                "type":np.where(codes<0,T-1,codes),
+                ##Bucket k holds edges[k-1]<GT<=edges[k], missing GT on the last bucket
+                "gt":np.where(np.isnan(gt),len(gt_edges)+1,np.searchsorted(gt_edges,gt,side="left"))}
+
+    @classmethod
+    def from_frame(cls,frame,gt_edges,sketch=None):
+        '''Builds the cube
+        Input:
+            frame; ops dataframe sorted on start_of_service, categorical code and ConType
+            gt_edges; GT bucket edges, the size filters (>lo,<=hi) answered by the cube
+            sketch; LogSketch layout for the time histograms
+        Returns. OpsCube'''
+        sketch=sketch or LogSketch()
+        gt_edges=np.asarray(gt_edges,dtype="float64")
+        ports=frame.code.cat.categories
+        types=frame.ConType.cat.categories
+        cells=cls._cells(frame,gt_edges)
+        keys=frame.start_of_service.dt.year.values*12+frame.start_of_service.dt.month.values-1
+        month0=int(keys.min())
+        M,P,T,G=int(keys.max())-month0+1,len(ports),len(types)+1,len(gt_edges)+2
+        cells=pd.DataFrame({"month":keys-month0,"port":cells["port"],"type":cells["type"],"gt":cells["gt"]})
+
+        ##Dense counts and sums, prefix summed over months
+        flat=np.ravel_multi_index(tuple(cells[c].values for c in ["month","port","type","gt"]),(M,P,T,G))
+        ops=np.bincount(flat,minlength=M*P*T*G).reshape(M,P,T,G)
+        age=np.bincount(flat,weights=frame.barge_age_at_op.values,minlength=M*P*T*G).reshape(M,P,T,G)
+        names=frame.drop_duplicates(subset=["code"]).set_index("code").bunkering_port.reindex(ports)
+        arrays=dict(month0=month0,gt_edges=gt_edges,ports=np.asarray(ports,dtype=str),
+                    types=np.asarray(types,dtype=str),names=np.asarray(names,dtype=str),
+                    ops=np.concatenate([np.zeros((1,P,T,G),dtype="int64"),ops.cumsum(axis=0)]),
+                    age=np.concatenate([np.zeros((1,P,T,G)),age.cumsum(axis=0)]))
+        ##Barge age bins of the occupied cells only, prefix summed over months
+        occupied,cell=np.unique(np.ravel_multi_index(tuple(cells[c].values for c in ["port","type","gt"]),(P,T,G)),
+                                return_inverse=True)
+        age_bin=(frame.barge_age_at_op.values//AGE_WIDTH).astype("int64")
+        C,B=len(occupied),int(age_bin.max())+1 if len(age_bin) else 0
+        bins=np.bincount((cells["month"].values*C+cell)*B+age_bin,minlength=M*C*B).reshape(M,C,B)
+        arrays["age_cells"]=np.stack(np.unravel_index(occupied,(P,T,G))).astype("int32")
+        arrays["age_bins"]=np.concatenate([np.zeros((1,C,B),dtype="int32"),bins.cumsum(axis=0).astype("int32")])
+        ##Sparse histograms per cell, sorted on port then month
+        for col in ["service_time","waiting_time"]:
+            valid=frame[col].notna().values
+            entries=cells[valid].assign(bucket=sketch.index(frame[col].values[valid]),
+                                        value=frame[col].values[valid].astype("float64"))
+            entries=entries.groupby(["port","month","type","gt","bucket"]).value.agg(["size","sum"]).reset_index()
+            arrays[col]=np.stack([entries[c].values for c in ["port","month","type","gt","bucket"]]).astype("int32")
+            arrays[col+"_counts"]=entries["size"].values.astype("int64")
+            arrays[col+"_sums"]=entries["sum"].values
+        return cls(frame,arrays,sketch)
+
+    def merge(self,other,frame):
+        '''Cube of the rows of two cubes, without going through the rows again
+        Input:
+            other; OpsCube on the same GT edges and sketch layout (appended rows)
+            frame; ops table holding the rows of both, sorted on start_of_service
+        Returns. OpsCube of frame'''
+        if not np.array_equal(self.gt_edges,other.gt_edges) or self.sketch.nbins!=other.sketch.nbins:
+            raise ValueError("cubes on different GT edges or sketch layouts")
+        ports=frame.code.cat.categories
+        types=frame.ConType.cat.categories
+        month0=min(self.month0,other.month0)
+        M=max(self.month0+self.months,other.month0+other.months)-month0
+        P,T,G=len(ports),len(types)+1,len(self.gt_edges)+2
+        ops=np.zeros((M,P,T,G),dtype="int64")
+        age=np.zeros((M,P,T,G))
+        arrays=dict(month0=month0,gt_edges=self.gt_edges,ports=np.asarray(ports,dtype=str),
+                    types=np.asarray(types,dtype=str))
+        entries={col:[] for col in ["service_time","waiting_time"]}
+        ##Occupied cells of both cubes in the merged layout
+        cells=[np.ravel_multi_index((ports.get_indexer(cube.ports)[cube.age_cells[0]],
+                                     np.append(types.get_indexer(cube.types),T-1)[cube.age_cells[1]],
+                                     cube.age_cells[2]),(P,T,G)) for cube in [self,other]]
+        occupied=np.unique(np.concatenate(cells))
+        bins=np.zeros((M,len(occupied),max(self.age_bins.shape[2],other.age_bins.shape[2])),dtype="int32")
+        for cube,cell in zip([self,other],cells):
+            month=np.arange(cube.months)+cube.month0-month0
+            bins[np.ix_(month,occupied.searchsorted(cell),np.arange(cube.age_bins.shape[2]))]+=np.diff(cube.age_bins,axis=0)
+        arrays["age_cells"]=np.stack(np.unravel_index(occupied,(P,T,G))).astype("int32")
+        arrays["age_bins"]=np.concatenate([np.zeros((1,)+bins.shape[1:],dtype="int32"),bins.cumsum(axis=0,dtype="int32")])
+        for cube in [self,other]:
+            ##Positions of the cube ports, types (missing type last) and months in the merged cube
+            port=ports.get_indexer(cube.ports)
+            kind=np.append(types.get_indexer(cube.types),T-1)
+            month=np.arange(cube.months)+cube.month0-month0
+            cells=np.ix_(month,port,kind,np.arange(G))
+            ops[cells]+=np.diff(cube.ops,axis=0)
+            age[cells]+=np.diff(cube.age,axis=0)
+            for col in entries:
+                keys=getattr(cube,col)
+                entries[col].append((np.stack([port[keys[0]],keys[1]+cube.month0-month0,kind[keys[2]],keys[3],keys[4]]),
+                                     getattr(cube,col+"_counts"),getattr(cube,col+"_sums")))
+        arrays["ops"]=np.concatenate([np.zeros((1,P,T,G),dtype="int64"),ops.cumsum(axis=0)])
+        arrays["age"]=np.concatenate([np.zeros((1,P,T,G)),age.cumsum(axis=0)])
+        ##Entries of the same cell and bucket added, sorted on port, month, type, gt, bucket
+        for col,parts in entries.items():
+            keys=np.concatenate([i[0] for i in parts],axis=1).astype("int64")
+            cell,inverse=np.unique(keys,axis=1,return_inverse=True)
+            inverse=inverse.ravel()
+            arrays[col]=cell.astype("int32")
+            arrays[col+"_counts"]=np.bincount(inverse,weights=np.concatenate([i[1] for i in parts])).astype("int64")
+            arrays[col+"_sums"]=np.bincount(inverse,weights=np.concatenate([i[2] for i in parts]))
+        names=frame.drop_duplicates(subset=["code"]).set_index("code").bunkering_port.reindex(ports)
+        arrays["names"]=np.asarray(names,dtype=str)
+        return OpsCube(frame,arrays,self.sketch)
+
+    def save(self,path):
+        '''Writes the cube arrays to a .npz file'''
+        keys=["month0","gt_edges","names","ops","age","age_cells","age_bins"]
+        for col in ["service_time","waiting_time"]:
+            keys+=[col,col+"_counts",col+"_sums"]
+        np.savez_compressed(path,alpha=self.sketch.alpha,min_value=self.sketch.min_value,
+                            max_value=self.sketch.max_value,ports=np.asarray(self.ports,dtype=str),
+                            types=np.asarray(self.types,dtype=str),**{k:getattr(self,k) for k in keys})
+
+    @classmethod
+    def load(cls,path,frame):
+        '''Reads a cube written by save, frame is the ops table it was built from'''
+        with np.load(path) as data:
+            arrays={k:data[k] for k in data.files}
+        if arrays["ops"][-1].sum()!=frame.shape[0]:
+            raise ValueError("cube {} was not built from this ops table".format(path))
+        if "age_bins" not in arrays:
+            raise ValueError("cube {} has no barge age bins".format(path))
+        sketch=LogSketch(float(arrays.pop("alpha")),float(arrays.pop("min_value")),float(arrays.pop("max_value")))
+        arrays["month0"]=int(arrays["month0"])
+        return cls(frame,arrays,sketch)
+
+    def covers(self,state):
+        '''True when the GT range of a selection falls on the cube buckets'''
+        return "full" in state.size or all(np.isin(state.size,self.gt_edges))
+
+    def _selection(self,state):
+        ##Boolean lookups of the selected ports, types and GT buckets
+        P,T,G=self.ops.shape[1:]
+        sel=[np.ones(P,dtype=bool),np.ones(T,dtype=bool),np.ones(G,dtype=bool)]
+        if "full" not in state.port:
+            sel[0][:]=False
+            sel[0][[self._port_pos[i] for i in state.port if i in self._port_pos]]=True
+        if "full" not in state.type_vessel:
+            sel[1][:]=False
+            sel[1][[self._type_pos[i] for i in state.type_vessel if i in self._type_pos]]=True
+        if "full" not in state.size:
+            lo,hi=np.searchsorted(self.gt_edges,state.size)
+            sel[2][:]=False
+            sel[2][lo+1:hi+1]=True
+        return sel
+
+    def _split(self,state,sel):
+        ##Whole months inside the window and the selected rows of the partial months at the edges
+        start=state.date_from.to_datetime64()
+        end=state.date_to.to_datetime64()+np.timedelta64(1,"ns")
+        lo=start.astype("datetime64[M]")
+        lo=lo if lo==start else lo+1
+        hi=end.astype("datetime64[M]")
+        if hi<=lo:
+            bounds=[start,end]
+            lo=hi=self._first
+        else:
+            bounds=[start,lo,hi,end]
+        pos=self.rows["time"].searchsorted(np.array(bounds,dtype="datetime64[ns]"))
+        rows=np.concatenate([np.arange(pos[i],pos[i+1]) for i in range(0,len(pos),2)])
+        rows=rows[sel[0][self.rows["port"][rows]]&sel[1][self.rows["type"][rows]]&sel[2][self.rows["gt"][rows]]]
+        lo,hi=[int(np.clip((m-self._first).astype("int64"),0,self.months)) for m in (lo,hi)]
+        return lo,hi,rows
+
+    def _counts(self,state):
+        ##Operations per port position
+        sel=self._selection(state)
+        lo,hi,rows=self._split(state,sel)
+        window=self.ops[hi]-self.ops[lo]
+        count=(window*sel[1][None,:,None]*sel[2][None,None,:]).sum(axis=(1,2))*sel[0]
+        return count+np.bincount(self.rows["port"][rows],minlength=len(self.ports))
+
+    def code_counts(self,state):
+        '''Operations per port code of a selection
+        Input:
+            state; FilterState covered by the cube
+        Returns. Series of counts indexed by code, sorted descending, zeros dropped'''
+        count=self._counts(state)
+        keep=np.flatnonzero(count)
+        keep=keep[np.argsort(-count[keep],kind="mergesort")]
+        return pd.Series(count[keep],index=self.ports[keep],name="code")
+
+    def age_histogram(self,state):
+        '''Operations per barge age bin of a selection
+        Input:
+            state; FilterState covered by the cube
+        Returns. Bin starts, counts (numpy arrays), up to the last non empty bin'''
+        sel=self._selection(state)
+        lo,hi,rows=self._split(state,sel)
+        cells=self.age_cells
+        keep=sel[0][cells[0]]&sel[1][cells[1]]&sel[2][cells[2]]
+        count=(self.age_bins[hi,keep]-self.age_bins[lo,keep]).sum(axis=0,dtype="int64")
+        count+=np.bincount((self.rows["barge_age_at_op"][rows]//AGE_WIDTH).astype("int64"),minlength=len(count))
+        count=count[:np.flatnonzero(count)[-1]+1] if count.any() else count[:0]
+        return np.arange(len(count))*AGE_WIDTH,count
+
+    def port_counts(self,state):
+        '''Operations per port name of a selection, same layout as code_counts'''
+        count=np.bincount(self._name_of,weights=self._counts(state),minlength=len(self._name_list)).astype("int64")
+        keep=np.flatnonzero(count)
+        keep=keep[np.argsort(-count[keep],kind="mergesort")]
+        return pd.Series(count[keep],index=self._name_list[keep],name="bunkering_port")
+
+    def _port_window(self,state,code):
+        ##Selection of one port, its whole months and the rows at the edges
+        p=self._port_pos[code]
+        sel=self._selection(state)
+        sel[0][:]=False
+        sel[0][p]=True
+        lo,hi,rows=self._split(state,sel)
+        return p,sel,lo,hi,rows
+
+    def _histogram(self,col,p,sel,lo,hi,rows):
+        ##Merged sketch of the cells of one port in months lo..hi plus the edge rows
+        keys=getattr(self,col)
+        ##Entries of the port for months lo..hi are contiguous
+        start,stop=np.searchsorted(getattr(self,"_"+col+"_key"),[p*(self.months+1)+lo,p*(self.months+1)+hi])
+        part=slice(start,stop)
+        keep=sel[1][keys[2,part]]&sel[2][keys[3,part]]
+        counts,sums=self.sketch.histogram(self.rows[col][rows])
+        counts+=np.bincount(keys[4,part][keep],weights=getattr(self,col+"_counts")[part][keep],
+                            minlength=self.sketch.nbins).astype("int64")
+        sums+=np.bincount(keys[4,part][keep],weights=getattr(self,col+"_sums")[part][keep],
+                          minlength=self.sketch.nbins)
+        return counts,sums
+
+    def port_histogram(self,state,code,col):
+        '''Merged sketch of a time column of one port within a selection
+        Input:
+            state; FilterState covered by the cube
+            code; port code
+            col; service_time or waiting_time
+        Returns. (counts,sums) histogram on the sketch layout'''
+        return self._histogram(col,*self._port_window(state,code))
+
+    def port_summary(self,state,code):
+        '''Aggregates of one port within a selection
+        Input:
+            state; FilterState covered by the cube
+            code; port code
+        Returns. Dict with ops, age_sum and (counts,sums) histograms of service_time and waiting_time'''
+        p,sel,lo,hi,rows=self._port_window(state,code)
+        cell=sel[1][:,None]&sel[2][None,:]
+        out=dict(ops=int((self.ops[hi,p]-self.ops[lo,p])[cell].sum())+len(rows),
+                 age_sum=float((self.age[hi,p]-self.age[lo,p])[cell].sum()+self.rows["barge_age_at_op"][rows].sum()))
+        for col in ["service_time","waiting_time"]:
+            out[col]=self._histogram(col,p,sel,lo,hi,rows)
+        return out
@@ -0,0 +1,114 @@
+"""
+Grouped densities for the service and waiting time panels.
+
+All the selected ports are handled in one pass: the 95th percentile trimming is
+done on a single sort of (port, value), and the kernel density estimates are
+binned on a grid shared by every port and smoothed by FFT convolution with a
+Gaussian kernel of each port's own bandwidth (Scott's rule, as scipy's
+gaussian_kde used by figure_factory.create_distplot).
+"""
+import numpy as np
+
+def group_quantile(values,groups,ngroups,q):
+    '''Quantile of every group, linear interpolation as pandas
+    Input:
+        values; numpy array of values, no missing values
+        groups; group number of every value (0..ngroups-1)
+        ngroups; number of groups
+        q; quantile in [0,1]
+    Returns. Numpy array (ngroups), NaN for empty groups'''
+    order=np.lexsort((values,groups))
+    ordered=values[order]
+    size=np.bincount(groups,minlength=ngroups)
+    start=np.cumsum(size)-size
+    pos=q*np.maximum(size-1,0)
+    below=np.floor(pos).astype("int64")
+    above=np.minimum(below+1,np.maximum(size-1,0))
+    quantile=np.full(ngroups,np.nan)
+    full=size>0
+    lo=ordered[(start+below)[full]]
+    hi=ordered[(start+above)[full]]
+    quantile[full]=lo+(hi-lo)*(pos-below)[full]
+    return quantile
+
+def trim_groups(values,groups,ngroups,q=0.95):
+    '''Drops the values above the q quantile of their group (and missing values)
+    Input:
+        values; numpy array of values
+        groups; group number of every value (0..ngroups-1)
+        ngroups; number of groups
+        q; quantile kept. Default 0.95
+    Returns. values, groups kept'''
+    values=np.asarray(values,dtype="float64")
+    valid=~np.isnan(values)
+    values,groups=values[valid],groups[valid]
+    cutoff=group_quantile(values,groups,ngroups,q)
+    keep=values<=cutoff[groups]
+    return values[keep],groups[keep]
+
+def bin_groups(values,groups,ngroups,grid):
+    '''Linear binning of every value on its two nearest grid points
+    Input:
+        values; numpy array of values inside the grid range
+        groups; group number of every value (0..ngroups-1)
+        ngroups; number of groups
+        grid; evenly spaced grid
+    Returns. Binned weights (ngroups x points), added over chunks of values'''
+    points=len(grid)
+    pos=(np.asarray(values,dtype="float64")-grid[0])/(grid[1]-grid[0])
+    left=np.clip(np.floor(pos).astype("int64"),0,points-2)
+    weight=pos-left
+    return (np.bincount(groups*points+left,weights=1-weight,minlength=ngroups*points)+
+            np.bincount(groups*points+left+1,weights=weight,minlength=ngroups*points)).reshape(ngroups,points)
+
+def smooth(binned,size,var,grid):
+    '''Gaussian kernel densities of binned groups
+    Input:
+        binned; binned weights (ngroups x points) from bin_groups
+        size; number of values of every group
+        var; variance (ddof 1) of every group
+        grid; evenly spaced grid of the bins
+    Returns. Densities (ngroups x points)'''
+    points=len(grid)
+    step=grid[1]-grid[0]
+    ##Scott's bandwidth, std with ddof 1. At least one grid step so the binning stays smooth
+    bandwidth=np.sqrt(var)*np.maximum(size,1)**(-1/5)
+    bandwidth=np.where(np.isfinite(bandwidth)&(bandwidth>step),bandwidth,step)
+
+    ##Convolution through FFT, padded so the kernel does not wrap around
+    n=1<<int(np.ceil(np.log2(2*points)))
+    offsets=np.fft.fftfreq(n,1/n)*step
+    kernel=np.exp(-0.5*(offsets[None,:]/bandwidth[:,None])**2)/(bandwidth[:,None]*np.sqrt(2*np.pi))
+    density=np.fft.irfft(np.fft.rfft(binned,n)*np.fft.rfft(kernel,n),n)[:,:points]
+    return np.maximum(density,0)/np.maximum(size,1)[:,None]
+
+def kde_grid(start,end,points=500):
+    '''Evenly spaced grid of a value range, a unit wide when the range is a single value'''
+    if end==start:
+        end=start+1.0
+    return np.linspace(start,end,points)
+
+def grouped_kde(values,groups,ngroups,points=500):
+    '''Gaussian kernel density of every group on a shared grid
+    Input:
+        values; numpy array of values
+        groups; group number of every value (0..ngroups-1)
+        ngroups; number of groups
+        points; grid size
+    Returns. grid (points), densities (ngroups x points), [lo,hi) grid slice of each group range'''
+    values=np.asarray(values,dtype="float64")
+    size=np.bincount(groups,minlength=ngroups)
+    low=np.full(ngroups,np.inf)
+    high=np.full(ngroups,-np.inf)
+    np.minimum.at(low,groups,values)
+    np.maximum.at(high,groups,values)
+    grid=kde_grid(values.min(),values.max(),points)
+
+    mean=np.bincount(groups,weights=values,minlength=ngroups)/np.maximum(size,1)
+    var=np.bincount(groups,weights=(values-mean[groups])**2,minlength=ngroups)/np.maximum(size-1,1)
+    density=smooth(bin_groups(values,groups,ngroups,grid),size,var,grid)
+    return grid,density,group_bounds(grid,low,high)
+
+def group_bounds(grid,low,high):
+    '''[lo,hi) grid slice of the range of every group'''
+    return np.stack([np.searchsorted(grid,low,side="left"),np.searchsorted(grid,high,side="right")],axis=1)
@@ -0,0 +1,97 @@
+"""
+Streamed export of the ops rows of a selection.
+
+The rows come from the query backend (Backend.export_chunks) a bounded chunk at
+a time, and every chunk is encoded and sent before the next one is read
+(chunked transfer encoding), so a worker holds one chunk whatever the size of
+the selection. CSV is always available, Parquet (one row group per chunk) when
+pyarrow is installed. Either can be gzip compressed on the fly.
+"""
+import zlib
+from backends import EXPORT_COLUMNS
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow=None
+
+def csv_stream(chunks):
+    '''CSV bytes of dataframe chunks, the header first'''
+    yield (",".join(EXPORT_COLUMNS)+"\n").encode()
+    for chunk in chunks:
+        yield chunk.to_csv(header=False,index=False,date_format="%Y-%m-%d %H:%M:%S").encode()
+
+class _Sink:
+    ##Write only file of the parquet writer, the bytes are taken out as they are written
+    closed=False
+
+    def __init__(self):
+        self.parts=[]
+        self.size=0
+
+    def write(self,data):
+        self.parts.append(bytes(data))
+        self.size+=len(data)
+        return len(data)
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed=True
+
+    def take(self):
+        data=b"".join(self.parts)
+        self.parts=[]
+        return data
+
+def parquet_schema():
+    types={"datetime64[ns]":pyarrow.timestamp("ns"),object:pyarrow.string(),
+           "float64":pyarrow.float64(),"int64":pyarrow.int64()}
+    return pyarrow.schema([(col,types[dtype]) for col,dtype in EXPORT_COLUMNS.items()])
+
+def parquet_stream(chunks):
+    '''Parquet bytes of dataframe chunks, one row group per chunk'''
+    sink=_Sink()
+    schema=parquet_schema()
+    writer=pyarrow.parquet.ParquetWriter(pyarrow.PythonFile(sink,mode="w"),schema)
+    for chunk in chunks:
+        writer.write_table(pyarrow.Table.from_pandas(chunk,schema=schema,preserve_index=False))
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+def gzip_stream(pieces,level=6):
+    '''gzip compressed bytes of a stream of bytes'''
+    compressor=zlib.compressobj(level,zlib.DEFLATED,31)
+    for piece in pieces:
+        data=compressor.compress(piece)
+        if data:
+            yield data
+    yield compressor.flush()
+
+##Format: mimetype, file extension, encoder
+FORMATS={"csv":("text/csv","csv",csv_stream),
+         "parquet":("application/vnd.apache.parquet","parquet",parquet_stream)}
+
+def available(fmt):
+    '''True when a format can be written here'''
+    return fmt=="csv" or (fmt=="parquet" and pyarrow is not None)
+
+def export_stream(chunks,fmt="csv",compression=None):
+    '''Encoded export of dataframe chunks
+    Input:
+        chunks; iterable of dataframes (Backend.export_chunks)
+        fmt; csv or parquet
+        compression; None or gzip
+    Returns. Generator of bytes, mimetype, file name'''
+    mimetype,extension,encoder=FORMATS[fmt]
+    stream=encoder(chunks)
+    name="bunker_ops."+extension
+    if compression=="gzip":
+        return gzip_stream(stream),"application/gzip",name+".gz"
+    return stream,mimetype,name
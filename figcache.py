@@ -0,0 +1,181 @@
+"""
+Memoized panel outputs.
+
+Builders are wrapped with FigureCache.cached. Their arguments are normalized into
+the same FilterState used by the filter stage, so equivalent selections (ports
+in another order, default values given or not) share one entry. Entries are
+kept in an in-process LRU and, when a file path is given, in a SQLite file that
+every gunicorn worker reads and writes, so a figure built by one worker is
+served by all of them. A miss being built is built once: concurrent requests for
+the same key wait for it (coalesce.SingleFlight).
+"""
+from collections import OrderedDict
+from functools import wraps
+import inspect
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import plotly.graph_objects as go
+from dash.development.base_component import Component
+from coalesce import SingleFlight
+from filters import normalize_filters
+import instrument
+
+_MISSING=object()
+
+def plain_figures(output):
+    '''Replaces the plotly figures of a component tree by plain dicts (cheap to pickle)'''
+    if isinstance(output,(list,tuple)):
+        return [plain_figures(i) for i in output]
+    if isinstance(output,Component):
+        for prop in output._prop_names:
+            value=getattr(output,prop,None)
+            if isinstance(value,go.Figure):
+                setattr(output,prop,value.to_plotly_json())
+            elif isinstance(value,(Component,list,tuple)):
+                setattr(output,prop,plain_figures(value))
+    return output
+
+class FigureCache:
+    '''LRU cache of builder outputs with an optional SQLite tier shared between processes
+    Input:
+        maxsize; entries kept in memory
+        path; SQLite file shared by the workers. None for memory only
+        disk_maxsize; entries kept in the file
+        version; function returning the version of the data, part of every key'''
+    def __init__(self,maxsize=128,path=None,disk_maxsize=2048,version=None):
+        self.maxsize=maxsize
+        self.path=path
+        self.disk_maxsize=disk_maxsize
+        self.version=version
+        self._entries=OrderedDict()
+        self._lock=threading.Lock()
+        self._local=threading.local()
+        self._flight=SingleFlight()
+        self.counters=dict(hits=0,disk_hits=0,misses=0,evictions=0,disk_errors=0)
+
+    @staticmethod
+    def key(kind,state):
+        '''Canonical key of a panel for a FilterState'''
+        return repr((kind,state.date_from.isoformat(),state.date_to.isoformat(),
+                     state.port,state.type_vessel,tuple(str(i) for i in state.size)))
+
+    def _db(self):
+        ##One connection per thread (SQLite serializes the writers), reopened after a fork
+        conn=getattr(self._local,"conn",None)
+        if conn is None or self._local.pid!=os.getpid():
+            conn=sqlite3.connect(self.path,timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS figures (key TEXT PRIMARY KEY, value BLOB, used REAL)")
+            self._local.conn,self._local.pid=conn,os.getpid()
+        return conn
+
+    def _count(self,counter):
+        with self._lock:
+            self.counters[counter]+=1
+
+    def get(self,key):
+        '''Cached output of a key, _MISSING when absent'''
+        ##The lock covers the LRU only, the shared file is read and unpickled outside it
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.counters["hits"]+=1
+                instrument.note(cache="hit")
+                return self._entries[key]
+        if self.path:
+            try:
+                db=self._db()
+                row=db.execute("SELECT value FROM figures WHERE key=?",(key,)).fetchone()
+                if row is not None:
+                    db.execute("UPDATE figures SET used=? WHERE key=?",(time.time(),key))
+                    db.commit()
+                    value=pickle.loads(row[0])
+                    with self._lock:
+                        self._remember(key,value)
+                        self.counters["disk_hits"]+=1
+                    instrument.note(cache="disk_hit")
+                    return value
+            except sqlite3.Error:
+                self._count("disk_errors")
+        self._count("misses")
+        instrument.note(cache="miss")
+        return _MISSING
+
+    def _remember(self,key,value):
+        self._entries[key]=value
+        while len(self._entries)>self.maxsize:
+            self._entries.popitem(last=False)
+            self.counters["evictions"]+=1
+
+    def put(self,key,value):
+        value=plain_figures(value)
+        with self._lock:
+            self._remember(key,value)
+        if self.path:
+            try:
+                data=pickle.dumps(value,protocol=pickle.HIGHEST_PROTOCOL)
+                db=self._db()
+                db.execute("INSERT OR REPLACE INTO figures VALUES (?,?,?)",(key,data,time.time()))
+                ##Least recently used entries of the file
+                db.execute("DELETE FROM figures WHERE key IN (SELECT key FROM figures ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                           (self.disk_maxsize,))
+                db.commit()
+            except sqlite3.Error:
+                self._count("disk_errors")
+        return value
+
+    def clear(self):
+        '''Drops every entry, in memory and in the shared file'''
+        with self._lock:
+            self._entries.clear()
+        if self.path:
+            try:
+                db=self._db()
+                db.execute("DELETE FROM figures")
+                db.commit()
+            except sqlite3.Error:
+                self._count("disk_errors")
+
+    def stats(self):
+        '''Hit and miss counters of this process'''
+        with self._lock:
+            stats=dict(self.counters,entries=len(self._entries),maxsize=self.maxsize,shared=bool(self.path))
+        return dict(stats,single_flight=self._flight.stats())
+
+    def cached(self,builder):
+        '''Decorator of a panel builder taking fr, to, port, type_vessel, size (and graph) arguments.
+        The wrapper has lookup(*args,**kwargs), the key and cached output (None when not built)
+        of a call, and builder, the undecorated builder'''
+        signature=inspect.signature(builder)
+
+        def key_of(*args,**kwargs):
+            bound=signature.bind(*args,**kwargs)
+            bound.apply_defaults()
+            values=bound.arguments
+            state=normalize_filters(values["fr"],values["to"],values.get("port"),
+                                    values.get("type_vessel"),values.get("size"))
+            key=self.key(builder.__name__+":"+str(values.get("graph","")),state)
+            if self.version is not None:
+                key=self.version()+"|"+key
+            return key
+
+        def lookup(*args,**kwargs):
+            key=key_of(*args,**kwargs)
+            output=self.get(key)
+            return key,(None if output is _MISSING else output)
+
+        @wraps(builder)
+        def run(*args,**kwargs):
+            key=key_of(*args,**kwargs)
+            output=self.get(key)
+            if output is _MISSING:
+                output,leader=self._flight.do(key,lambda: self.put(key,builder(*args,**kwargs)))
+                if not leader:
+                    instrument.note(cache="shared")
+            return output
+        run.lookup=lookup
+        run.builder=builder
+        return run
@@ -0,0 +1,150 @@
+"""
+Shared filter stage for the dashboard panels.
+
+Every data panel works on the same selection of bunkering operations: a date
+window, the selected ports, the vessel types and the GT range. The selection is
+normalized into a hashable FilterState and the filtered frame is kept in a small
+keyed store, so one interaction filters the ops table once no matter how many
+panels ask for it. Concurrent requests for the same selection filter it once.
+"""
+from collections import OrderedDict, namedtuple
+import threading
+import numpy as np
+import pandas as pd
+from coalesce import SingleFlight
+
+FilterState=namedtuple("FilterState",["date_from","date_to","port","type_vessel","size"])
+
+def normalize_filters(fr="01-01-2014",to="01-06-2019",port=["full"],type_vessel=["full"],
+                      size=["full"]):
+    '''Canonical form of a dashboard selection
+    Input:
+        fr; From date (datetime dd-mm-YYYY). Default 01-01-2014
+        to; To date (datetime dd-mm-YYYY)
+        port; list of port codes. Full or empty for all the ports
+        type_vessel; list of vessel types. Full or empty for all the types
+        size; GT range [min,max]. Full or empty for all the sizes
+    Returns. FilterState (hashable, same for equivalent selections)'''
+    port=("full",) if (not port or "full" in port) else tuple(sorted(set(port)))
+    type_vessel=("full",) if (not type_vessel or "full" in type_vessel) else tuple(sorted(set(type_vessel)))
+    size=("full",) if (not size or "full" in size) else (size[0],size[1])
+    return FilterState(pd.to_datetime(fr),pd.to_datetime(to),port,type_vessel,size)
+
+def query_filters(values,date_from,date_to):
+    '''FilterState of the arguments of an HTTP request, as the callbacks get them
+    Input:
+        values; function of an argument name returning its list of strings: fr and to (dates),
+            port and type (repeated or comma separated, default all), size (min,max GT, default all)
+        date_from, date_to; dates without fr or to
+    Returns. FilterState. ValueError for a wrong date or size'''
+    def split(name):
+        return [i for value in values(name) for i in str(value).split(",") if i]
+    size=split("size")
+    if size and "full" not in size:
+        if len(size)!=2:
+            raise ValueError("size is min,max")
+        size=[float(i) for i in size]
+    fr,to=split("fr"),split("to")
+    try:
+        return normalize_filters(fr[0] if fr else date_from,to[0] if to else date_to,split("port"),split("type"),size)
+    except OverflowError as error:
+        raise ValueError(str(error))
+
+def category_mask(series,values):
+    '''Membership mask of a series on a list of values
+    Input:
+        series; categorical series (plain series fall back to isin)
+        values; values to keep
+    Returns. Numpy boolean array, computed on the integer codes with a lookup table'''
+    if not isinstance(series.dtype,pd.CategoricalDtype):
+        return series.isin(values).values
+    lookup=np.zeros(len(series.cat.categories)+1,dtype=bool)
+    codes=series.cat.categories.get_indexer(list(values))
+    lookup[codes[codes>=0]]=True
+    ##Missing values have code -1 and land on the last (False) slot
+    return lookup[series.cat.codes.values]
+
+def sorted_counts(values,index,name):
+    '''Series of the non zero counts sorted descending, ties in index order'''
+    values=np.asarray(values,dtype="int64")
+    keep=np.flatnonzero(values)
+    keep=keep[np.argsort(-values[keep],kind="mergesort")]
+    return pd.Series(values[keep],index=pd.Index(index)[keep],name=name)
+
+def counts(series):
+    '''value_counts without the categories that are absent from the series, ordered as
+    sorted_counts (the cube and the other backends) so ties rank the same on every path
+    Input:
+        series; categorical or plain series
+    Returns. Series of counts sorted descending, ties in category (or sorted value) order'''
+    if isinstance(series.dtype,pd.CategoricalDtype):
+        codes,index=series.cat.codes.values,series.cat.categories
+    else:
+        codes,index=pd.factorize(series,sort=True)
+    return sorted_counts(np.bincount(codes[codes>=0],minlength=len(index)),index,series.name)
+
+def date_window(frame,column,date_from,date_to):
+    '''Rows of a frame sorted on a date column between two dates (both included)
+    Input:
+        frame; dataframe sorted ascending on column
+        column; name of the date column
+        date_from; From date (Timestamp)
+        date_to; To date (Timestamp)
+    Returns. Dataframe slice (view), bounds found by binary search'''
+    values=frame[column].values
+    lo=values.searchsorted(pd.Timestamp(date_from).to_datetime64(),side="left")
+    hi=values.searchsorted(pd.Timestamp(date_to).to_datetime64(),side="right")
+    return frame.iloc[lo:max(lo,hi)]
+
+def selection_mask(df_in,state):
+    '''Port, vessel type and GT mask of a selection (dates not included)
+    Input:
+        df_in; ops dataframe
+        state; FilterState
+    Returns. Numpy boolean array'''
+    mask=np.ones(df_in.shape[0],dtype=bool)
+    if "full" not in state.port:
+        mask&=category_mask(df_in.code,state.port)
+    if "full" not in state.type_vessel:
+        mask&=category_mask(df_in.ConType,state.type_vessel)
+    if "full" not in state.size:
+        mask&=((df_in.VesselGT>state.size[0])&(df_in.VesselGT<=state.size[1])).values
+    return mask
+
+def apply_filters(frame,state):
+    '''Filters the ops table for a selection
+    Input:
+        frame; ops dataframe sorted on start_of_service
+        state; FilterState
+    Returns. Filtered dataframe'''
+    df_in=date_window(frame,"start_of_service",state.date_from,state.date_to)
+    mask=selection_mask(df_in,state)
+    if mask.all():
+        return df_in
+    return df_in[mask]
+
+class FilterStore:
+    '''Keyed store of filtered frames, least recently used selections are evicted.
+    Frames returned are shared between panels and must not be modified in place.'''
+    def __init__(self,frame,maxsize=8):
+        if not frame.start_of_service.is_monotonic_increasing:
+            raise ValueError("ops frame must be sorted on start_of_service")
+        self.frame=frame
+        self.maxsize=maxsize
+        self._entries=OrderedDict()
+        self._lock=threading.Lock()
+        self._flight=SingleFlight()
+
+    def get(self,state):
+        with self._lock:
+            if state in self._entries:
+                self._entries.move_to_end(state)
+                return self._entries[state]
+        df_in,leader=self._flight.do(state,lambda: apply_filters(self.frame,state))
+        if not leader:
+            return df_in
+        with self._lock:
+            self._entries[state]=df_in
+            while len(self._entries)>self.maxsize:
+                self._entries.popitem(last=False)
+        return df_in
@@ -0,0 +1,45 @@
+"""
+Production gunicorn settings. Procfile: gunicorn --config gunicorn.conf.py app:server
+
+The app is preloaded: app.py (tables, cube, default panels) is imported once in
+the master and the workers are forked from it. The tables are read only arrays
+(memory-mapped from the binary store or frozen after parsing) and the objects
+alive at fork time are moved out of the garbage collector's reach with
+gc.freeze, so the pages stay shared copy-on-write instead of one copy per worker.
+
+Environment:
+    WEB_CONCURRENCY; worker processes. Default 2 (set by Heroku from the dyno size)
+    BUNKER_THREADS; threads per worker. Default 4. The panels are numpy bound and
+        release the GIL for most of their work, threads add concurrency for little memory
+    BUNKER_TIMEOUT; worker timeout in seconds. Default 60
+    PORT; listening port (set by Heroku). Default 8000
+    BUNKER_JOBS; SQLite file of the background jobs (jobs.py). Each worker forks its
+        job pool in post_fork, before its threads start
+"""
+import gc
+import os
+import memory
+
+bind="0.0.0.0:{}".format(os.environ.get("PORT","8000"))
+workers=int(os.environ.get("WEB_CONCURRENCY",2))
+threads=int(os.environ.get("BUNKER_THREADS",4))
+worker_class="gthread"
+timeout=int(os.environ.get("BUNKER_TIMEOUT",60))
+preload_app=True
+##Recycling workers would throw away the warm caches, memory is bounded by the LRU sizes
+max_requests=0
+
+def when_ready(server):
+    ##Runs in the master after the app is loaded, before the first fork
+    gc.collect()
+    gc.freeze()
+    server.log.info("Preloaded app. %s",memory.describe("master {}".format(os.getpid()),memory.usage()))
+
+def post_fork(server,worker):
+    ##Process pool of the background jobs, forked while the worker has one thread
+    import app
+    if app.job_queue is not None:
+        app.job_queue.start()
+
+def post_worker_init(worker):
+    worker.log.info("Worker ready. %s",memory.describe("worker {}".format(os.getpid()),memory.usage()))
@@ -0,0 +1,193 @@
+"""
+Incremental ingestion of new bunkering operations.
+
+New ops arrive as CSV files with the columns of bunkering_ops_mediterranean.csv,
+dropped in a watched folder (BUNKER_INGEST_DIR) or uploaded to POST /ingest,
+which validates them and writes them to that folder. Every worker polls the
+folder, so all of them apply the same files, and a restart applies them again
+on top of the base table.
+
+Rows are validated and go through the startup cleaning (store.parse_ops and
+store.derive_ops with the reference year of the base table). The more than 30
+ops rule is applied on the raw counts of the base table plus every row
+received, rows of ports still under it are held until the port passes it.
+
+Memory: every append builds a new sorted table (append_rows) in the worker. From
+the first append on, the table of a worker is its own instead of the pages of
+the preloaded master shared copy-on-write, so each worker adds about the size of
+the ops table (and its cube) to its private memory, once per table kept alive
+by requests still reading the previous one. Adding the new rows to the ops CSV,
+rebuilding the store (python store.py) and restarting shares the table again.
+"""
+import hashlib
+import io
+import os
+import threading
+import numpy as np
+import pandas as pd
+import store
+from filters import counts
+
+class Ingestor:
+    '''Appends validated ops files to an ops table
+    Input:
+        frame; cleaned ops table (store.load("ops")), attrs with reference_year and port_ops
+        directory; watched folder of the CSV files
+        on_update; called with the new table and the appended rows after every change'''
+    def __init__(self,frame,directory,on_update):
+        self.frame=frame
+        self.directory=directory
+        self.on_update=on_update
+        ##Without the attrs of the cleaning the kept rows stand for the raw counts
+        self.reference_year=int(frame.attrs.get("reference_year",frame.start_of_service.min().year))
+        self.port_ops=dict(frame.attrs.get("port_ops",counts(frame.bunkering_port).to_dict()))
+        self.held=[]
+        self.seen=set()
+        self.report=[]
+        self._lock=threading.RLock()
+        self._thread=None
+        self._pid=None
+
+    @staticmethod
+    def validate(raw):
+        '''Rows of a raw ops file that can be cleaned
+        Input:
+            raw; dataframe as read from the CSV
+        Returns. valid rows (every column of raw), number of rejected rows. ValueError when
+            columns are missing'''
+        missing=[i for i in store.OPS_COLUMNS if i not in raw.columns]
+        if missing:
+            raise ValueError("missing columns: {}".format(", ".join(missing)))
+        ##Other columns are kept as read, the cleaning puts the rows on the columns of the table
+        raw=raw.copy()
+        for col in ["start_of_service","vessel_inside_port"]:
+            raw[col]=pd.to_datetime(raw[col],errors="coerce")
+        for col in ["VesselGT","service_time","BargeBuilt","barge_imo"]:
+            raw[col]=pd.to_numeric(raw[col],errors="coerce")
+        ##Vessel type and GT may be missing, as in the base table
+        valid=raw[["start_of_service","vessel_inside_port","bunkering_port","code",
+                   "service_time","BargeBuilt","barge_imo"]].notna().all(axis=1)
+        raw=raw[valid].reset_index(drop=True)
+        for col in ["bunkering_port","code"]:
+            raw[col]=raw[col].astype(str)
+        for col in ["BargeBuilt","barge_imo"]+(["VesselGT"] if raw.VesselGT.notna().all() else []):
+            raw[col]=raw[col].astype("int64")
+        return raw,int((~valid).sum())
+
+    def _clean(self,raw):
+        ##Same cleaning as the startup, held rows of the ports under the rule come back in
+        raw=store.parse_ops(raw)
+        for port,count in counts(raw.bunkering_port).items():
+            self.port_ops[port]=self.port_ops.get(port,0)+int(count)
+        rows=pd.concat(self.held+[raw],ignore_index=True)
+        keep=rows.bunkering_port.map(self.port_ops).fillna(0).values>store.MIN_PORT_OPS
+        self.held=[rows[~keep]] if (~keep).any() else []
+        rows=store.derive_ops(rows[keep],self.reference_year)
+        ##Columns of the table only, the ones absent from the file are NaN
+        rows=rows.reindex(columns=self.frame.columns).sort_values(by=["start_of_service"],kind="mergesort").reset_index(drop=True)
+        for col in ["bunkering_port","code","ConType"]:
+            rows[col]=rows[col].astype("category")
+        return rows
+
+    def _append(self,valid):
+        ##Cleans validated rows and swaps in the table with them
+        rows=self._clean(valid)
+        if rows.shape[0]:
+            frame=append_rows(self.frame,rows)
+            self.on_update(frame,rows)
+            self.frame=frame
+        return dict(appended=int(rows.shape[0]),held=int(sum(i.shape[0] for i in self.held)))
+
+    def scan(self):
+        '''Appends the CSV files of the folder not seen yet, all of them in one swap
+        Returns. dict with the (file name, accepted and rejected rows or error) of every
+            file, and the appended and held row counts'''
+        if not self.directory or not os.path.isdir(self.directory):
+            return dict(files=[],appended=0,held=0)
+        with self._lock:
+            files,parts=[],[]
+            for name in sorted(os.listdir(self.directory)):
+                if not name.endswith(".csv") or name in self.seen:
+                    continue
+                self.seen.add(name)
+                try:
+                    valid,rejected=self.validate(pd.read_csv(os.path.join(self.directory,name)))
+                    parts.append(valid)
+                    files.append((name,dict(accepted=int(valid.shape[0]),rejected=rejected)))
+                except (ValueError,OSError,pd.errors.ParserError) as error:
+                    files.append((name,str(error)))
+            result=dict(appended=0,held=int(sum(i.shape[0] for i in self.held)))
+            ##A failed append leaves the table and counts as they were, the polling goes on
+            port_ops,held_rows=dict(self.port_ops),list(self.held)
+            try:
+                if parts:
+                    result=self._append(pd.concat(parts,ignore_index=True))
+            except Exception as error:
+                self.port_ops,self.held=port_ops,held_rows
+                files=[(name,"not appended: {}".format(error) if isinstance(i,dict) else i) for name,i in files]
+            self.report=(self.report+files)[-100:]
+            return dict(result,files=files)
+
+    def save_upload(self,data):
+        '''Validates an uploaded CSV and writes it to the folder, atomically
+        Input:
+            data; bytes of the CSV
+        Returns. File name. ValueError when it has no valid rows or was already received'''
+        valid,rejected=self.validate(pd.read_csv(io.BytesIO(data)))
+        if valid.shape[0]==0:
+            raise ValueError("no valid rows ({} rejected)".format(rejected))
+        os.makedirs(self.directory,exist_ok=True)
+        ##Named by arrival time and content, the same file uploaded twice is ingested once
+        digest=hashlib.sha1(data).hexdigest()[:12]
+        if any(i.endswith(digest+".csv") for i in os.listdir(self.directory)):
+            raise ValueError("file already received")
+        name="{}-{}.csv".format(pd.Timestamp.now().strftime("%Y%m%dT%H%M%S"),digest)
+        tmp=os.path.join(self.directory,"."+name+".tmp")
+        with open(tmp,"wb") as f:
+            f.write(data)
+        os.replace(tmp,os.path.join(self.directory,name))
+        return name
+
+    def watch(self,interval=30):
+        '''Polls the folder every interval seconds in a daemon thread, one per process'''
+        if self._thread is not None and self._thread.is_alive() and self._pid==os.getpid():
+            return
+        def run():
+            wait=threading.Event()
+            while not wait.wait(interval):
+                self.scan()
+        self._pid=os.getpid()
+        self._thread=threading.Thread(target=run,name="bunker-ingest",daemon=True)
+        self._thread.start()
+
+def _recode(values,categories):
+    ##Codes of a categorical on other categories, missing values stay -1
+    return np.append(categories.get_indexer(values.categories),-1)[values.codes]
+
+def append_rows(frame,rows):
+    '''Ops table with appended rows, read only
+    Input:
+        frame; ops table sorted on start_of_service
+        rows; cleaned rows on the same columns
+    Returns. Dataframe sorted on start_of_service (table rows first on equal times), attrs kept'''
+    order=np.argsort(np.concatenate([frame.start_of_service.values,rows.start_of_service.values]),kind="mergesort")
+    data={}
+    for col in frame.columns:
+        current=frame[col].array
+        if isinstance(current,pd.Categorical):
+            new=pd.Categorical(rows[col])
+            categories=current.categories.union(new.categories)
+            codes=np.concatenate([_recode(current,categories),_recode(new,categories)])
+            data[col]=pd.Categorical.from_codes(codes[order],categories=categories)
+            continue
+        current=np.asarray(current)
+        new=rows[col].values
+        ##Integer columns widened when the new values do not fit
+        dtype=current.dtype
+        if np.issubdtype(dtype,np.integer) and not (np.issubdtype(new.dtype,np.integer) and
+                                                    np.iinfo(dtype).min<=new.min() and new.max()<=np.iinfo(dtype).max):
+            dtype=np.result_type(dtype,new.dtype)
+        data[col]=np.concatenate([current.astype(dtype),new.astype(dtype)])[order]
+    out=pd.DataFrame(data,columns=frame.columns)
+    out.attrs.update(frame.attrs)
+    return store.freeze(out)
@@ -0,0 +1,296 @@
+"""
+Opt-in timing instrumentation of the callbacks and panel builders.
+
+Enabled with BUNKER_INSTRUMENT=1, otherwise traced returns the functions
+untouched and lap/note return at once. Every traced call (callbacks and
+builders) is a span; builders split their time with lap("filter"),
+lap("aggregate"), lap("figure"), the rest of the span is "other". The serialize
+stage of a Dash request is its time after the callback returned. Filtered rows
+and figure cache status are attached with note.
+
+Every response carries a Server-Timing header, server.route /metrics serves the
+counters of the worker in Prometheus text format, and a sampling profiler dumps
+folded stacks (flamegraph.pl / speedscope input) of the requests slower than
+BUNKER_PROFILE_SLOW_MS to BUNKER_PROFILE_DIR. /profiling?slow_ms=<ms> changes
+the threshold at runtime, 0 turns the profiler off. Both routes answer 403 to
+the requests the allowed check of install rejects (/metrics can be left open).
+"""
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from functools import wraps
+import os
+import sys
+import threading
+import time
+import flask
+
+ENABLED=os.environ.get("BUNKER_INSTRUMENT","0") not in ("","0")
+BUCKETS=(0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0)
+
+_local=threading.local()
+
+class Metrics:
+    '''Counters of this process, rendered in Prometheus text format'''
+    def __init__(self):
+        self._lock=threading.Lock()
+        self.requests=defaultdict(lambda:[0]*(len(BUCKETS)+1)+[0.0])
+        self.stages=defaultdict(float)
+        self.calls=Counter()
+        self.rows=Counter()
+        self.cache=Counter()
+        self.profiles=0
+
+    def request(self,name,seconds):
+        with self._lock:
+            values=self.requests[name]
+            for i,bound in enumerate(BUCKETS):
+                if seconds<=bound:
+                    values[i]+=1
+            values[len(BUCKETS)]+=1
+            values[-1]+=seconds
+
+    def span(self,span):
+        with self._lock:
+            self.calls[span["name"]]+=1
+            self.stages[(span["name"],"total")]+=span["duration"]
+            for stage,seconds in span["stages"].items():
+                self.stages[(span["name"],stage)]+=seconds
+            self.rows[span["name"]]+=span["rows"]
+            if span["cache"]:
+                self.cache[(span["name"],span["cache"])]+=1
+
+    def serialize(self,name,seconds):
+        with self._lock:
+            self.stages[(name,"serialize")]+=seconds
+
+    def profile(self):
+        with self._lock:
+            self.profiles+=1
+
+    def render(self):
+        lines=[]
+        def metric(name,kind,text):
+            lines.extend(["# HELP {} {}".format(name,text),"# TYPE {} {}".format(name,kind)])
+        with self._lock:
+            metric("bunker_request_seconds","histogram","Request latency by callback (or path)")
+            for name,values in sorted(self.requests.items()):
+                for bound,count in zip(BUCKETS+("+Inf",),values[:-1]):
+                    lines.append('bunker_request_seconds_bucket{{callback="{}",le="{}"}} {}'.format(name,bound,count))
+                lines.append('bunker_request_seconds_sum{{callback="{}"}} {:.6f}'.format(name,values[-1]))
+                lines.append('bunker_request_seconds_count{{callback="{}"}} {}'.format(name,values[len(BUCKETS)]))
+            metric("bunker_stage_seconds_total","counter","Time spent by span and stage")
+            for (name,stage),seconds in sorted(self.stages.items()):
+                lines.append('bunker_stage_seconds_total{{span="{}",stage="{}"}} {:.6f}'.format(name,stage,seconds))
+            metric("bunker_span_calls_total","counter","Calls of the traced callbacks and builders")
+            lines.extend('bunker_span_calls_total{{span="{}"}} {}'.format(*i) for i in sorted(self.calls.items()))
+            metric("bunker_rows_total","counter","Filtered rows handled by span")
+            lines.extend('bunker_rows_total{{span="{}"}} {}'.format(*i) for i in sorted(self.rows.items()))
+            metric("bunker_cache_total","counter","Figure cache lookups by span and status")
+            lines.extend('bunker_cache_total{{span="{}",status="{}"}} {}'.format(name,status,count)
+                         for (name,status),count in sorted(self.cache.items()))
+            metric("bunker_slow_profiles_total","counter","Folded stacks dumped for slow requests")
+            lines.append("bunker_slow_profiles_total {}".format(self.profiles))
+        return "\n".join(lines)+"\n"
+
+metrics=Metrics()
+
+##Spans
+def traced(func):
+    '''Records every call of func as a span of the current request. No-op when disabled'''
+    if not ENABLED:
+        return func
+
+    @wraps(func)
+    def run(*args,**kwargs):
+        stack=getattr(_local,"stack",None)
+        if stack is None:
+            stack=_local.stack=[]
+        now=time.perf_counter()
+        span=dict(name=func.__name__,start=now,last=now,stages=defaultdict(float),rows=0,cache=None)
+        stack.append(span)
+        try:
+            return func(*args,**kwargs)
+        finally:
+            stack.pop()
+            now=time.perf_counter()
+            span["duration"]=now-span["start"]
+            if span["stages"] and now>span["last"]:
+                span["stages"]["other"]+=now-span["last"]
+            metrics.span(span)
+            record=getattr(_local,"record",None)
+            if record is not None:
+                record["spans"].append(span)
+                if not stack:
+                    record["callback"]=span["name"]
+                    record["callback_end"]=now
+    return run
+
+def lap(stage):
+    '''Adds the time since the span start (or the last lap) to a stage of the current span'''
+    if ENABLED and getattr(_local,"stack",None):
+        span=_local.stack[-1]
+        now=time.perf_counter()
+        span["stages"][stage]+=now-span["last"]
+        span["last"]=now
+
+def note(rows=0,cache=None):
+    '''Attaches filtered rows and a cache status to the current span'''
+    if ENABLED and getattr(_local,"stack",None):
+        span=_local.stack[-1]
+        span["rows"]+=rows
+        span["cache"]=cache or span["cache"]
+
+def context():
+    '''Request record and current span of this thread, for work handed to other threads'''
+    stack=getattr(_local,"stack",None)
+    return getattr(_local,"record",None),(stack[-1] if stack else None)
+
+@contextmanager
+def attach(context):
+    '''Spans of this thread go to the request of another thread, under its span (context())'''
+    if not ENABLED or context[0] is None:
+        yield
+        return
+    before=getattr(_local,"record",None),getattr(_local,"stack",None)
+    _local.record,_local.stack=context[0],[context[1]] if context[1] else []
+    try:
+        yield
+    finally:
+        _local.record,_local.stack=before
+
+def server_timing(record,total,serialize):
+    '''Server-Timing header value of a request record, spans of the same name merged'''
+    merged={}
+    for span in record["spans"]:
+        entry=merged.setdefault(span["name"],dict(duration=0.0,stages=defaultdict(float),rows=0,cache=[]))
+        entry["duration"]+=span["duration"]
+        entry["rows"]+=span["rows"]
+        for stage,seconds in span["stages"].items():
+            entry["stages"][stage]+=seconds
+        if span["cache"]:
+            entry["cache"].append(span["cache"])
+    parts=[]
+    for name,entry in merged.items():
+        desc=" ".join(entry["cache"]+(["{} rows".format(entry["rows"])] if entry["rows"] else []))
+        parts.append('{};dur={:.2f}'.format(name,entry["duration"]*1000)+(';desc="{}"'.format(desc) if desc else ""))
+        parts.extend('{}.{};dur={:.2f}'.format(name,stage,seconds*1000) for stage,seconds in entry["stages"].items())
+    if serialize is not None:
+        parts.append("serialize;dur={:.2f}".format(serialize*1000))
+    parts.append("total;dur={:.2f}".format(total*1000))
+    return ", ".join(parts)
+
+##Sampling profiler
+class Sampler:
+    '''Samples the stacks of the threads serving requests, dumps the slow ones as folded stacks
+    Input:
+        slow_ms; requests at least this slow are dumped. 0 disables the sampling
+        interval; seconds between samples
+        directory; destination of the .folded files'''
+    def __init__(self,slow_ms=0,interval=0.005,directory="profiles"):
+        self.slow_ms=slow_ms
+        self.interval=interval
+        self.directory=directory
+        self._active={}
+        self._lock=threading.Lock()
+        self._thread=None
+        self._pid=None
+
+    def _run(self):
+        while self.slow_ms:
+            frames=sys._current_frames()
+            with self._lock:
+                for ident,stacks in self._active.items():
+                    frame=frames.get(ident)
+                    names=[]
+                    while frame is not None:
+                        code=frame.f_code
+                        names.append("{} ({}:{})".format(code.co_name,os.path.basename(code.co_filename),code.co_firstlineno))
+                        frame=frame.f_back
+                    if names:
+                        stacks[";".join(reversed(names))]+=1
+            time.sleep(self.interval)
+
+    def start(self):
+        '''Starts sampling the current thread'''
+        if not self.slow_ms:
+            return
+        ##Threads do not survive the fork of the workers
+        if self._thread is None or not self._thread.is_alive() or self._pid!=os.getpid():
+            self._thread=threading.Thread(target=self._run,name="bunker-sampler",daemon=True)
+            self._pid=os.getpid()
+            self._thread.start()
+        with self._lock:
+            self._active[threading.get_ident()]=Counter()
+
+    def stop(self,name,seconds):
+        '''Stops sampling the current thread, dumps its stacks when the request was slow
+        Returns. Path of the dump, None when not dumped'''
+        with self._lock:
+            stacks=self._active.pop(threading.get_ident(),None)
+        if not stacks or not self.slow_ms or seconds*1000<self.slow_ms:
+            return None
+        os.makedirs(self.directory,exist_ok=True)
+        path=os.path.join(self.directory,"{}-{}-{}-{:.0f}ms.folded".format(
+            time.strftime("%Y%m%dT%H%M%S"),os.getpid(),name.strip("/").replace("/","_") or "root",seconds*1000))
+        with open(path,"w") as f:
+            f.writelines("{} {}\n".format(stack,count) for stack,count in stacks.most_common())
+        metrics.profile()
+        return path
+
+sampler=Sampler(slow_ms=float(os.environ.get("BUNKER_PROFILE_SLOW_MS",0)),
+                interval=float(os.environ.get("BUNKER_PROFILE_INTERVAL_MS",5))/1000,
+                directory=os.environ.get("BUNKER_PROFILE_DIR","profiles"))
+
+##Flask integration
+def install(server,allowed=lambda: False,public_metrics=False):
+    '''Adds the request hooks, /metrics and /profiling to a Flask server. No-op when disabled
+    Input:
+        server; Flask app
+        allowed; function telling whether the current request may read /metrics and use /profiling
+        public_metrics; /metrics open to every client'''
+    if not ENABLED:
+        return
+
+    @server.before_request
+    def start_request():
+        _local.record=dict(start=time.perf_counter(),spans=[],callback=None,callback_end=None)
+        _local.stack=[]
+        sampler.start()
+
+    @server.after_request
+    def end_request(response):
+        record=getattr(_local,"record",None)
+        _local.record=None
+        if record is None:
+            return response
+        end=time.perf_counter()
+        total=end-record["start"]
+        name=record["callback"] or flask.request.path
+        serialize=None
+        if record["callback_end"] is not None:
+            serialize=end-record["callback_end"]
+            metrics.serialize(name,serialize)
+        metrics.request(name,total)
+        sampler.stop(name,total)
+        response.headers["Server-Timing"]=server_timing(record,total,serialize)
+        return response
+
+    @server.route("/metrics")
+    def prometheus_metrics():
+        if not (public_metrics or allowed()):
+            return flask.jsonify(error="not allowed"),403
+        return flask.Response(metrics.render(),mimetype="text/plain; version=0.0.4")
+
+    @server.route("/profiling")
+    def profiling():
+        if not allowed():
+            return flask.jsonify(error="not allowed"),403
+        if "slow_ms" in flask.request.args:
+            try:
+                slow_ms=float(flask.request.args["slow_ms"])
+            except ValueError:
+                return flask.jsonify(error="slow_ms is a number of milliseconds"),400
+            if not slow_ms>=0:
+                return flask.jsonify(error="slow_ms is a number of milliseconds"),400
+            sampler.slow_ms=slow_ms
+        return flask.jsonify(slow_ms=sampler.slow_ms,directory=sampler.directory,dumped=metrics.profiles)
@@ -0,0 +1,201 @@
+"""
+Background jobs for the heavy panel builders.
+
+The service and waiting distributions of a large selection can hold a request
+thread for seconds. With BUNKER_JOBS set to a SQLite file, panels_update
+submits them as jobs and answers with a placeholder right away; the browser
+polls (dcc.Interval) until the job is done. The file is the broker shared by
+the gunicorn workers:
+
+    jobs(key, version, builder, args, status, owner, created, started, finished, result, error)
+
+Every worker runs a dispatcher thread claiming queued jobs of its dataset
+version while fewer than BUNKER_HEAVY_JOBS run across all the workers, and
+hands them to its process pool. The pool is forked when the worker starts
+(gunicorn post_fork, no request thread alive yet), so the jobs run on the
+tables of the worker without copying them and without holding its GIL. A job
+of a dataset appended after the fork runs in a thread of the worker. Queued
+jobs of another dataset version, never claimed once every worker has swapped,
+are deleted after the timeout, as the done and failed jobs after ten minutes.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import json
+import multiprocessing
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from figcache import plain_figures
+
+##Queue of the process, read by the pool processes forked from it
+_queue=None
+
+class StaleJob(Exception):
+    '''The pool process was forked before the dataset of the job'''
+
+def _run(name,kwargs,version):
+    ##Runs in a pool process
+    if _queue.version()!=version:
+        raise StaleJob(version)
+    return plain_figures(_queue.builders[name](**kwargs))
+
+def _ready():
+    return os.getpid()
+
+class JobQueue:
+    '''SQLite backed job queue with a process pool per worker
+    Input:
+        path; SQLite file shared by the workers
+        builders; dict name: panel builder (undecorated) run by the jobs
+        version; function returning the version of the data of this process
+        limit; jobs running at the same time across all the workers
+        timeout; seconds after which a running job is queued again (its worker died)'''
+    def __init__(self,path,builders,version,limit=2,timeout=120):
+        self.path=path
+        self.builders=builders
+        self.version=version
+        self.limit=limit
+        self.timeout=timeout
+        self._conn=None
+        self._pid=None
+        self._lock=threading.Lock()
+        self._pool=None
+        self._owner=None
+        self._wake=threading.Event()
+
+    def _db(self):
+        ##One connection per process, reopened after a fork
+        if self._conn is None or self._pid!=os.getpid():
+            self._conn=sqlite3.connect(self.path,timeout=10,check_same_thread=False,isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS jobs (key TEXT PRIMARY KEY, version TEXT, builder TEXT,
+                                  args TEXT, status TEXT, owner INTEGER, created REAL, started REAL,
+                                  finished REAL, result BLOB, error TEXT)""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+            self._pid=os.getpid()
+        return self._conn
+
+    def start(self):
+        '''Forks the process pool and starts the dispatcher thread of this process.
+        Called once per worker before it serves requests'''
+        global _queue
+        _queue=self
+        self._owner=os.getpid()
+        self._pool=ProcessPoolExecutor(max_workers=self.limit,mp_context=multiprocessing.get_context("fork"))
+        ##Fork every pool process now, while no other thread holds a lock
+        self._pool.submit(_ready).result()
+        threading.Thread(target=self._dispatch,name="jobs",daemon=True).start()
+        return self
+
+    def active(self):
+        '''True when this process runs jobs'''
+        return self._pool is not None and self._owner==os.getpid()
+
+    def submit(self,key,builder,kwargs):
+        '''Queues a job, once per key
+        Input:
+            key; figure cache key of the output
+            builder; name in builders
+            kwargs; json serializable arguments of the builder'''
+        with self._lock:
+            self._db().execute("INSERT OR IGNORE INTO jobs (key,version,builder,args,status,created) VALUES (?,?,?,?,?,?)",
+                               (key,self.version(),builder,json.dumps(kwargs),"queued",time.time()))
+        self._wake.set()
+
+    def result(self,key):
+        '''Status of the job of a key
+        Returns. (status, output) with status None (no job), queued, running, done (with
+            the output) or failed (with the error)'''
+        with self._lock:
+            row=self._db().execute("SELECT status,result,error FROM jobs WHERE key=?",(key,)).fetchone()
+        if row is None:
+            return None,None
+        if row[0]=="done":
+            return "done",pickle.loads(row[1])
+        return row[0],row[2]
+
+    def forget(self,key):
+        '''Drops a job (a failed one is submitted again)'''
+        with self._lock:
+            self._db().execute("DELETE FROM jobs WHERE key=?",(key,))
+
+    def stats(self):
+        with self._lock:
+            rows=self._db().execute("SELECT status,COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return dict(rows,limit=self.limit,pool=self.active())
+
+    def _claim(self):
+        ##Oldest queued job of this dataset, when the running jobs are under the limit
+        now=time.time()
+        with self._lock:
+            db=self._db()
+            ##Read first, the write lock only when there is a job to claim or to queue again
+            pending=db.execute("SELECT COUNT(*) FROM jobs WHERE (status='queued' AND (version=? OR created<?)) "
+                               "OR (status='running' AND started<?)",
+                               (self.version(),now-self.timeout,now-self.timeout)).fetchone()[0]
+            if not pending:
+                return None
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.execute("UPDATE jobs SET status='queued',owner=NULL WHERE status='running' AND started<?",
+                           (now-self.timeout,))
+                db.execute("DELETE FROM jobs WHERE status IN ('done','failed') AND finished<?",(now-600,))
+                ##Queued jobs of another dataset are never claimed. Left for timeout seconds, a worker
+                ##still on that dataset (it swaps a little later) may claim them meanwhile
+                db.execute("DELETE FROM jobs WHERE status='queued' AND version!=? AND created<?",
+                           (self.version(),now-self.timeout))
+                running=db.execute("SELECT COUNT(*) FROM jobs WHERE status='running'").fetchone()[0]
+                row=None
+                if running<self.limit:
+                    row=db.execute("SELECT key,builder,args,version FROM jobs WHERE status='queued' AND version=? "
+                                   "ORDER BY created LIMIT 1",(self.version(),)).fetchone()
+                    if row is not None:
+                        db.execute("UPDATE jobs SET status='running',owner=?,started=? WHERE key=?",
+                                   (os.getpid(),now,row[0]))
+                db.execute("COMMIT")
+            except sqlite3.Error:
+                db.execute("ROLLBACK")
+                raise
+        return row
+
+    def _finish(self,key,output=None,error=None):
+        with self._lock:
+            if error is None:
+                self._db().execute("UPDATE jobs SET status='done',finished=?,result=? WHERE key=?",
+                                   (time.time(),pickle.dumps(output,protocol=pickle.HIGHEST_PROTOCOL),key))
+            else:
+                self._db().execute("UPDATE jobs SET status='failed',finished=?,error=? WHERE key=?",
+                                   (time.time(),error,key))
+        self._wake.set()
+
+    def _inline(self,key,name,kwargs):
+        ##Job of a dataset newer than the pool processes, run in this process
+        try:
+            self._finish(key,plain_figures(self.builders[name](**kwargs)))
+        except Exception as error:
+            self._finish(key,error="{}: {}".format(type(error).__name__,error))
+
+    def _done(self,key,name,kwargs,future):
+        ##Pool callback, in the thread of the pool
+        try:
+            self._finish(key,future.result())
+        except StaleJob:
+            threading.Thread(target=self._inline,args=(key,name,kwargs),daemon=True).start()
+        except Exception as error:
+            self._finish(key,error="{}: {}".format(type(error).__name__,error))
+
+    def _dispatch(self):
+        while True:
+            try:
+                row=self._claim()
+            except sqlite3.Error:
+                row=None
+            if row is None:
+                self._wake.wait(0.2)
+                self._wake.clear()
+                continue
+            key,name,args,version=row
+            kwargs=json.loads(args)
+            future=self._pool.submit(_run,name,kwargs,version)
+            future.add_done_callback(lambda future,key=key,name=name,kwargs=kwargs: self._done(key,name,kwargs,future))
@@ -0,0 +1,70 @@
+"""
+Memory report of the gunicorn master and its workers.
+
+With the preloaded app (see gunicorn.conf.py) the tables are loaded once in the
+master and the workers share its pages copy-on-write. The private memory of a
+worker is what it added on top of the master after the fork, the per-worker
+delta. Reads /proc/<pid>/smaps_rollup (Linux 4.14 and later), the memory is
+reported as unavailable where it is missing (macOS, older kernels, sandboxes).
+
+    python memory.py <master pid>
+"""
+import os
+import sys
+
+FIELDS={"Rss":"rss","Pss":"pss","Shared_Clean":"shared","Shared_Dirty":"shared",
+        "Private_Clean":"private","Private_Dirty":"private"}
+
+def usage(pid="self"):
+    '''Memory of a process in MiB
+    Input:
+        pid; process id. Default the current process
+    Returns. dict with rss, pss (shared pages split between their users), shared and private.
+        None when smaps_rollup cannot be read'''
+    out=dict(rss=0.0,pss=0.0,shared=0.0,private=0.0)
+    try:
+        with open("/proc/{}/smaps_rollup".format(pid)) as f:
+            for line in f:
+                field,_,value=line.partition(":")
+                if field in FIELDS:
+                    out[FIELDS[field]]+=int(value.split()[0])/1024
+    except OSError:
+        return None
+    return out
+
+def children(pid):
+    '''Process ids whose parent is pid'''
+    out=[]
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open("/proc/{}/stat".format(entry)) as f:
+                    ##ppid is the second field after the parenthesized command
+                    if int(f.read().rsplit(")",1)[1].split()[1])==int(pid):
+                        out.append(int(entry))
+            except (OSError,IndexError,ValueError):
+                continue
+    return sorted(out)
+
+def describe(name,values):
+    if values is None:
+        return "{:<14}memory unavailable".format(name)
+    return "{:<14}rss {rss:8.1f}  pss {pss:8.1f}  shared {shared:8.1f}  private {private:8.1f} MiB".format(name,**values)
+
+def report(master):
+    '''Text report of a master and its workers. The private column of the workers is their delta'''
+    main=usage(master)
+    lines=[describe("master {}".format(master),main)]
+    workers=[(pid,usage(pid)) for pid in children(master)]
+    lines+=[describe("worker {}".format(pid),values) for pid,values in workers]
+    workers=[(pid,values) for pid,values in workers if values is not None]
+    if workers and main is not None:
+        lines.append("{} workers, {:.1f} MiB private per worker on average, {:.1f} MiB in total (pss)".format(
+            len(workers),sum(i["private"] for _,i in workers)/len(workers),
+            main["pss"]+sum(i["pss"] for _,i in workers)))
+    return "\n".join(lines)
+
+if __name__=="__main__":
+    if len(sys.argv)!=2:
+        sys.exit("usage: python memory.py <gunicorn master pid>")
+    print(report(sys.argv[1]))
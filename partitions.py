@@ -0,0 +1,364 @@
+"""
+Out-of-core ops table, partitioned by month and port on disk.
+
+For ops tables larger than the memory of a worker. The conversion command
+
+    python partitions.py [--data data] [--out data/partitions] [--chunksize 200000]
+
+reads the ops CSV in chunks (twice: the more than 30 ops rule needs the counts
+of the whole file first), cleans every chunk as store.clean_ops does and writes
+the rows of every month to <out>/<YYYY-MM>.npy as a structured array, the rows of
+every port contiguous and sorted on start_of_service (a month x port partition),
+plus a manifest.json with the partitions, the port names, the vessel types and
+their order of appearance.
+
+PartitionedOps answers the panels partition by partition: the date window and
+the port codes of a selection prune the partitions, and counts, the barge age
+histogram, the port summary sketches and the trimmed distributions are added
+up over the memory-mapped partitions, so memory does not grow with the table.
+With BUNKER_PARTITIONS=<out> the dashboard runs on it instead of loading the
+ops table.
+"""
+import argparse
+import json
+import os
+import shutil
+from collections import Counter, defaultdict
+import numpy as np
+import pandas as pd
+import store
+from backends import Backend, export_frame
+from cube import LogSketch
+from density import bin_groups, group_bounds, kde_grid, smooth
+from filters import sorted_counts
+
+##One row of a partition. Missing vessel type is -1, missing GT is NaN
+RECORD=np.dtype([("time","<i8"),("type","<i2"),("gt","<f8"),("age","<f4"),
+                 ("service_time","<f4"),("waiting_time","<f4")])
+
+##Conversion
+def clean_chunks(path,chunksize=200000):
+    '''Cleaned ops of the CSV, chunk by chunk
+    Input:
+        path; ops CSV
+        chunksize; rows read at once
+    Returns. Generator of cleaned dataframes (store.parse_ops and store.derive_ops),
+        the reference year is the year of the first kept row as in store.clean_ops'''
+    port_ops=Counter()
+    for chunk in pd.read_csv(path,usecols=["bunkering_port"],chunksize=chunksize):
+        port_ops.update(chunk.bunkering_port.str.title().value_counts().to_dict())
+    keep=[port for port,count in port_ops.items() if count>store.MIN_PORT_OPS]
+    reference_year=None
+    for chunk in pd.read_csv(path,chunksize=chunksize):
+        chunk=store.parse_ops(chunk)
+        chunk=chunk[chunk.bunkering_port.isin(keep)]
+        if chunk.shape[0]==0:
+            continue
+        if reference_year is None:
+            reference_year=int(chunk.start_of_service.iloc[0].year)
+        yield store.derive_ops(chunk,reference_year)
+
+def _first(seen,key,when,value=None):
+    ##Keeps the earliest (time, row) of a key, with a value attached
+    if key not in seen or when<seen[key][0]:
+        seen[key]=(when,value)
+
+def write_partitions(chunks,directory):
+    '''Writes cleaned ops chunks as month x port partitions
+    Input:
+        chunks; iterable of cleaned ops dataframes, in file order
+        directory; destination folder, replaced when it exists
+    Returns. Number of rows written'''
+    tmp=directory.rstrip(os.sep)+".tmp"
+    shutil.rmtree(tmp,ignore_errors=True)
+    os.makedirs(tmp)
+    types,names=[],{}
+    first_port,first_type={},{}
+    parts=defaultdict(list)
+    rows=0
+    reference_year=None
+    for n,chunk in enumerate(chunks):
+        time=chunk.start_of_service.values.astype("datetime64[ns]")
+        code=np.asarray(chunk.code.values).astype(str)
+        if reference_year is None:
+            ##Year the ages are counted at, from the first row
+            reference_year=int(chunk.barge_age_at_op.iloc[0]+chunk.BargeBuilt.iloc[0])
+        kind=chunk.ConType.values
+        for value in pd.unique(kind[pd.notna(kind)]):
+            if value not in types:
+                types.append(value)
+        records=np.empty(chunk.shape[0],dtype=RECORD)
+        records["time"]=time.astype("int64")
+        records["type"]=pd.Index(types).get_indexer(kind)
+        records["gt"]=chunk.VesselGT.values.astype("float64")
+        records["age"]=chunk.barge_age_at_op.values
+        records["service_time"]=chunk.service_time.values
+        records["waiting_time"]=chunk.waiting_time.values
+        ##First appearance of every port name and type, for the dropdowns order
+        order=rows+np.arange(chunk.shape[0])
+        frame=pd.DataFrame({"time":records["time"],"row":order,"name":np.asarray(chunk.bunkering_port.values),
+                            "code":code,"type":kind})
+        frame=frame.sort_values(by=["time","row"])
+        for row in frame.drop_duplicates(subset=["name"]).itertuples():
+            _first(first_port,row.name,(row.time,row.row),row.code)
+        for row in frame.dropna(subset=["type"]).drop_duplicates(subset=["type"]).itertuples():
+            _first(first_type,row.type,(row.time,row.row))
+        for port,name in zip(frame.code,frame.name):
+            names.setdefault(port,name)
+        ##Part files of every month x port, merged below
+        month=np.datetime_as_string(time.astype("datetime64[M]"))
+        keys=pd.DataFrame({"month":month,"code":code})
+        for (month_key,port),index in keys.groupby(["month","code"]).indices.items():
+            os.makedirs(os.path.join(tmp,month_key),exist_ok=True)
+            name=os.path.join(month_key,"{}.{:05d}.npy".format(port,n))
+            np.save(os.path.join(tmp,name),records[index])
+            parts[(month_key,port)].append(name)
+        rows+=chunk.shape[0]
+    if rows==0:
+        shutil.rmtree(tmp)
+        raise ValueError("no ops rows to write")
+
+    ##One file per month, its ports one after the other, each sorted on time (equal times
+    ##in file order). One month in memory at a time
+    partitions=[]
+    for month_key in sorted({i for i,_ in parts}):
+        name="{}.npy".format(month_key)
+        blocks=[]
+        offset=0
+        for code in sorted(port for i,port in parts if i==month_key):
+            records=np.concatenate([np.load(os.path.join(tmp,i)) for i in parts[(month_key,code)]])
+            records=records[np.argsort(records["time"],kind="mergesort")]
+            blocks.append(records)
+            partitions.append(dict(month=month_key,port=code,file=name,offset=offset,rows=int(records.shape[0]),
+                                   start=int(records["time"][0]),end=int(records["time"][-1])))
+            offset+=records.shape[0]
+        np.save(os.path.join(tmp,name),np.concatenate(blocks))
+        shutil.rmtree(os.path.join(tmp,month_key))
+    manifest=dict(rows=rows,reference_year=reference_year,types=types,
+                  ports=sorted(names),names=[names[i] for i in sorted(names)],
+                  port_order=[[name,code] for name,(_,code) in sorted(first_port.items(),key=lambda i:i[1][0])],
+                  type_order=[kind for kind,_ in sorted(first_type.items(),key=lambda i:i[1][0])],
+                  start=min(i["start"] for i in partitions),end=max(i["end"] for i in partitions),
+                  partitions=partitions)
+    ##Manifest written last, a folder without it is incomplete
+    with open(os.path.join(tmp,"manifest.json"),"w") as f:
+        json.dump(manifest,f)
+    shutil.rmtree(directory,ignore_errors=True)
+    os.replace(tmp,directory)
+    return rows
+
+def convert(data_dir="data",directory=None,chunksize=200000):
+    '''Partitions the ops CSV of a data folder
+    Input:
+        data_dir; data folder with the ops CSV
+        directory; destination folder. Default <data_dir>/partitions
+        chunksize; rows read at once
+    Returns. Number of rows written'''
+    directory=directory or os.path.join(data_dir,"partitions")
+    return write_partitions(clean_chunks(os.path.join(data_dir,store.OPS_CSV),chunksize),directory)
+
+def from_frame(frame,directory,chunksize=200000):
+    '''Partitions a cleaned ops table (store.load("ops")), chunksize rows at a time'''
+    chunks=(frame.iloc[i:i+chunksize] for i in range(0,frame.shape[0],chunksize))
+    return write_partitions(chunks,directory)
+
+##Queries
+class PartitionedOps(Backend):
+    '''Ops table partitioned by month x port, read partition by partition.
+    Answers code_counts, port_counts and port_summary as OpsCube does, for any
+    GT range, plus the other Backend queries.
+    Input:
+        directory; folder written by write_partitions
+        sketch; LogSketch layout of the time histograms'''
+    def __init__(self,directory,sketch=None):
+        self.directory=directory
+        self.sketch=sketch or LogSketch()
+        with open(os.path.join(directory,"manifest.json")) as f:
+            manifest=json.load(f)
+        self.manifest=manifest
+        self.rows=manifest["rows"]
+        self.ports=pd.Index(manifest["ports"])
+        self.types=pd.Index(manifest["types"])
+        self.port_names=pd.Series(manifest["names"],index=self.ports)
+        self.codes=list(self.ports)
+        self.port_options=[tuple(i) for i in manifest["port_order"]]
+        self.type_options=manifest["type_order"]
+        self.start=pd.Timestamp(manifest["start"])
+        self.end=pd.Timestamp(manifest["end"])
+        parts=manifest["partitions"]
+        self._month=np.array([np.datetime64(i["month"],"M") for i in parts])
+        self._port=self.ports.get_indexer([i["port"] for i in parts])
+        self._files=[os.path.join(directory,i["file"]) for i in parts]
+        self._slices=[slice(i["offset"],i["offset"]+i["rows"]) for i in parts]
+        ##Memory maps of the month files, opened once
+        self._maps={}
+        self._name_list,self._name_of=np.unique(self.port_names.values.astype(str),return_inverse=True)
+
+    def _open(self,path):
+        ##Read only memory map of a month file
+        if path not in self._maps:
+            self._maps[path]=np.load(path,mmap_mode="r")
+        return self._maps[path]
+
+    def _partitions(self,state):
+        ##Partitions of the months of the window and the selected ports
+        keep=(self._month>=state.date_from.to_datetime64().astype("datetime64[M]"))&(
+            self._month<=state.date_to.to_datetime64().astype("datetime64[M]"))
+        if "full" not in state.port:
+            keep&=np.isin(self._port,self.ports.get_indexer(list(state.port)))
+        return np.flatnonzero(keep)
+
+    def scan(self,state):
+        '''Selected rows of every partition left after pruning
+        Input:
+            state; FilterState
+        Returns. Generator of (port position, records), records a structured array (RECORD)'''
+        start=state.date_from.to_datetime64().astype("datetime64[ns]").astype("int64")
+        end=state.date_to.to_datetime64().astype("datetime64[ns]").astype("int64")
+        lookup=None
+        if "full" not in state.type_vessel:
+            lookup=np.zeros(len(self.types)+1,dtype=bool)
+            codes=self.types.get_indexer(list(state.type_vessel))
+            lookup[codes[codes>=0]]=True
+        for i in self._partitions(state):
+            records=self._open(self._files[i])[self._slices[i]]
+            ##Sorted on time, the window is a slice
+            lo,hi=records["time"].searchsorted(start,side="left"),records["time"].searchsorted(end,side="right")
+            records=records[lo:max(lo,hi)]
+            mask=None
+            if lookup is not None:
+                ##Missing types (-1) land on the last (False) slot
+                mask=lookup[records["type"]]
+            if "full" not in state.size:
+                size=(records["gt"]>state.size[0])&(records["gt"]<=state.size[1])
+                mask=size if mask is None else mask&size
+            if mask is not None:
+                records=records[mask]
+            if records.shape[0]:
+                yield self._port[i],records
+
+    def export_chunks(self,state,chunksize=50000):
+        ##Partition by partition (months, then ports), in time order within a partition
+        types=np.append(self.types.values.astype(object),None)
+        for port,records in self.scan(state):
+            code=self.ports[port]
+            for start in range(0,records.shape[0],chunksize):
+                part=records[start:start+chunksize]
+                yield export_frame(start_of_service=part["time"].astype("datetime64[ns]"),
+                                   bunkering_port=np.full(part.shape[0],self.port_names[code],dtype=object),
+                                   code=np.full(part.shape[0],code,dtype=object),ConType=types[part["type"]],
+                                   VesselGT=part["gt"],barge_age_at_op=part["age"],
+                                   service_time=part["service_time"],waiting_time=part["waiting_time"])
+
+    def time_chunks(self):
+        ##One partition at a time
+        for i in range(len(self._files)):
+            records=self._open(self._files[i])[self._slices[i]]
+            yield records["time"].astype("datetime64[ns]"),records["service_time"],records["waiting_time"]
+
+    def _counts(self,state):
+        ##Operations per port position
+        count=np.zeros(len(self.ports),dtype="int64")
+        for port,records in self.scan(state):
+            count[port]+=records.shape[0]
+        return count
+
+    def code_counts(self,state):
+        return sorted_counts(self._counts(state),self.ports,"code")
+
+    def port_counts(self,state):
+        return sorted_counts(np.bincount(self._name_of,weights=self._counts(state),minlength=len(self._name_list)),
+                             self._name_list,"bunkering_port")
+
+    def port_summary(self,state,code):
+        '''Aggregates of one port within a selection, as OpsCube.port_summary
+        Returns. Dict with ops, age_sum and (counts,sums) histograms of service_time and waiting_time'''
+        out=dict(ops=0,age_sum=0.0)
+        for col in ["service_time","waiting_time"]:
+            out[col]=(np.zeros(self.sketch.nbins,dtype="int64"),np.zeros(self.sketch.nbins))
+        for _,records in self.scan(state._replace(port=(code,))):
+            out["ops"]+=records.shape[0]
+            out["age_sum"]+=float(records["age"].sum(dtype="float64"))
+            for col in ["service_time","waiting_time"]:
+                counts,sums=self.sketch.histogram(records[col])
+                out[col][0][:]+=counts
+                out[col][1][:]+=sums
+        return out
+
+    def port_stats(self,state,code,q=0.95):
+        ##Trimmed means from the merged sketches
+        stats=self.port_summary(state,code)
+        return dict(name=self.port_names[code],ops=stats["ops"],
+                    age=stats["age_sum"]/stats["ops"] if stats["ops"] else np.nan,
+                    service=self.sketch.trimmed_mean(*stats["service_time"],q),
+                    waiting=self.sketch.trimmed_mean(*stats["waiting_time"],q))
+
+    def age_histogram(self,state,width=2):
+        count=np.zeros(0,dtype="int64")
+        for _,records in self.scan(state):
+            part=np.bincount((records["age"]//width).astype("int64"))
+            if len(part)>len(count):
+                count=np.concatenate([count,np.zeros(len(part)-len(count),dtype="int64")])
+            count[:len(part)]+=part
+        return np.arange(len(count))*width,count
+
+    def grouped_kde(self,state,column,labels,q=0.95,clip=None,points=500):
+        ##Three passes over the partitions. The q quantile of every port comes from
+        ##its merged sketch (within the sketch accuracy)
+        n=len(labels)
+        ##Group of every port position, from its name
+        group_of=pd.Index(labels).get_indexer(self.port_names.values)
+
+        def values():
+            for port,records in self.scan(state):
+                if group_of[port]>=0:
+                    part=records[column].astype("float64")
+                    yield group_of[port],part[~np.isnan(part)]
+
+        ##Pass 1, quantiles from the sketches
+        hist=np.zeros((n,self.sketch.nbins),dtype="int64")
+        for group,part in values():
+            hist[group]+=np.bincount(self.sketch.index(part),minlength=self.sketch.nbins)
+        bucket=np.array([self.sketch.quantile_bucket(i,q) for i in hist])
+        cutoff=np.array([self.sketch.quantile(i,q) for i in hist])
+
+        def trimmed():
+            ##Values of the buckets up to the quantile bucket
+            for group,part in values():
+                part=part[self.sketch.index(part)<=bucket[group]]
+                yield group,(np.minimum(part,clip) if clip is not None else part)
+
+        ##Pass 2, size, range and variance (shifted sums) of the kept values
+        size=np.zeros(n,dtype="int64")
+        low=np.full(n,np.inf)
+        high=np.full(n,-np.inf)
+        shift=np.nan_to_num(cutoff/2)
+        total=np.zeros(n)
+        squares=np.zeros(n)
+        for group,part in trimmed():
+            if part.size:
+                size[group]+=part.size
+                low[group]=min(low[group],part.min())
+                high[group]=max(high[group],part.max())
+                total[group]+=(part-shift[group]).sum()
+                squares[group]+=((part-shift[group])**2).sum()
+        if size.sum()==0:
+            grid=kde_grid(0.0,0.0,points)
+            return grid,np.zeros((n,points)),group_bounds(grid,low,high)
+        var=(squares-total**2/np.maximum(size,1))/np.maximum(size-1,1)
+        grid=kde_grid(low[size>0].min(),high[size>0].max(),points)
+
+        ##Pass 3, binning on the shared grid
+        binned=np.zeros((n,points))
+        for group,part in trimmed():
+            binned[group]+=bin_groups(part,np.zeros(part.size,dtype="int64"),1,grid)[0]
+        return grid,smooth(binned,size,np.maximum(var,0),grid),group_bounds(grid,low,high)
+
+if __name__=="__main__":
+    parser=argparse.ArgumentParser(description="Partitions the ops CSV by month and port")
+    parser.add_argument("--data",default="data",help="data folder with the ops CSV")
+    parser.add_argument("--out",default=None,help="destination folder. Default <data>/partitions")
+    parser.add_argument("--chunksize",type=int,default=200000,help="rows read at once")
+    args=parser.parse_args()
+    rows=convert(args.data,args.out,args.chunksize)
+    print("{:,} rows written to {}".format(rows,args.out or os.path.join(args.data,"partitions")))
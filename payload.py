@@ -0,0 +1,83 @@
+"""
+Payload reduction of the figures sent to the browser.
+
+The line traces are downsampled with largest-triangle-three-buckets (LTTB) to
+about one point per pixel of their graph, which keeps the peaks a plain
+decimation would drop, and the numbers are rounded to the precision the axis
+can show. Dates are sent as days.
+
+The graphs are not told their pixel width by the browser; PLOT_WIDTH is the
+widest the service, waiting and brent graphs get (four of the twelve columns of
+a 1920 px screen). BUNKER_PLOT_WIDTH overrides it.
+
+plotly.js 1.x (dash 1.12) has no typed array encoding, the arrays stay JSON.
+"""
+import os
+import numpy as np
+
+PLOT_WIDTH=int(os.environ.get("BUNKER_PLOT_WIDTH",640))
+
+def lttb(x,y,points):
+    '''Largest triangle three buckets downsampling
+    Input:
+        x; numpy array of increasing positions (numbers)
+        y; numpy array of values
+        points; points kept, first and last included
+    Returns. Positions (indices) of the points kept'''
+    n=len(x)
+    if points>=n or points<3:
+        return np.arange(n)
+    x=np.asarray(x,dtype="float64").tolist()
+    y=np.asarray(y,dtype="float64").tolist()
+    ##Buckets of the points between the first and the last
+    edges=(np.linspace(1,n-1,points-1)).astype("int64").tolist()
+    kept=[0]
+    a=0
+    for i in range(points-2):
+        start,end=edges[i],edges[i+1]
+        ##Average of the next bucket, the last point for the last one
+        nstart,nend=end,(edges[i+2] if i+2<len(edges) else n)
+        cx=sum(x[nstart:nend])/(nend-nstart)
+        cy=sum(y[nstart:nend])/(nend-nstart)
+        ax,ay=x[a],y[a]
+        best,area=start,-1.0
+        for j in range(start,end):
+            value=abs((ax-cx)*(y[j]-ay)-(ax-x[j])*(cy-ay))
+            if value>area:
+                best,area=j,value
+        kept.append(best)
+        a=best
+    kept.append(n-1)
+    return np.asarray(kept)
+
+def round_to_range(values,digits=4):
+    '''Rounds to digits significant figures of the largest magnitude (the axis precision)
+    Input:
+        values; numpy array of floats
+        digits; significant figures kept
+    Returns. Numpy array'''
+    values=np.asarray(values,dtype="float64")
+    top=np.nanmax(np.abs(values)) if values.size else 0
+    if not np.isfinite(top) or top==0:
+        return values
+    return np.round(values,max(0,digits-1-int(np.floor(np.log10(top)))))
+
+def compact_line(x,y,points=PLOT_WIDTH,digits=4):
+    '''Downsampled and rounded line trace
+    Input:
+        x; numpy array of numbers or datetime64, increasing
+        y; numpy array of values
+        points; points kept. Default PLOT_WIDTH
+        digits; significant figures of the numbers
+    Returns. x, y. Dates as day strings'''
+    x=np.asarray(x)
+    y=np.asarray(y)
+    dates=np.issubdtype(x.dtype,np.datetime64)
+    keep=lttb(x.astype("datetime64[s]").astype("int64") if dates else x,y,points)
+    x,y=x[keep],y[keep]
+    if dates:
+        days=x.astype("datetime64[D]")
+        x=np.datetime_as_string(days if (days==x).all() else x.astype("datetime64[s]"))
+    else:
+        x=round_to_range(x,digits)
+    return x,round_to_range(y,digits)
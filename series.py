@@ -0,0 +1,164 @@
+"""
+Time series of the bunkering operations and the Brent price.
+
+Built once per dataset over the whole ops table (every port, vessel type and
+size), chunk by chunk from the query backend: the operations and the service
+and waiting time sums of every day are kept as prefix sums over the days, so
+the totals of any range of days are two lookups. The daily, weekly (from Monday)
+and monthly rollups of a date window are the differences of the prefix sums at
+the period starts, one per period; the periods at the edges of the window only
+count its days. Appended operations are added to a copy.
+
+The Brent prices are daily (trading days). Open, high, low and close of every
+period come from one reduceat over the prices of the window.
+"""
+import numpy as np
+import pandas as pd
+
+##Resolutions of the rollups
+RESOLUTIONS={"D":"Day","W":"Week","M":"Month"}
+##Sums per day, counts of the non missing times apart from the operations
+COLUMNS=["ops","service_sum","service_n","waiting_sum","waiting_n"]
+
+def epoch_day(value):
+    '''Days since 1970-01-01 of a date (Timestamp, string or datetime64)'''
+    return int(pd.Timestamp(value).to_datetime64().astype("datetime64[D]").astype("int64"))
+
+def period_starts(first,last,resolution):
+    '''First day of every period of a resolution overlapping a range of days
+    Input:
+        first, last; epoch days, both included
+        resolution; D, W or M
+    Returns. Numpy array of epoch days, the first one moved to first, empty when first is after last'''
+    if resolution not in RESOLUTIONS:
+        raise ValueError("unknown resolution {}".format(resolution))
+    if first>last:
+        return np.empty(0,dtype="int64")
+    if resolution=="D":
+        starts=np.arange(first,last+1)
+    elif resolution=="W":
+        ##1970-01-01 is a Thursday
+        starts=np.arange(first-(first+3)%7,last+1,7)
+    elif resolution=="M":
+        months=np.arange(np.datetime64(first,"D").astype("datetime64[M]"),
+                         np.datetime64(last,"D").astype("datetime64[M]")+1)
+        starts=months.astype("datetime64[D]").astype("int64")
+    starts=starts[starts<=last]
+    starts[:1]=first
+    return starts
+
+def day_totals(times,service,waiting):
+    '''Sums per day of ops rows
+    Input:
+        times; start_of_service (datetime64)
+        service, waiting; service and waiting times, NaN when missing
+    Returns. First day (epoch days), dict of COLUMNS arrays with one item per day'''
+    day=np.asarray(times).astype("datetime64[D]").astype("int64")
+    if not len(day):
+        return 0,{col:np.zeros(0) for col in COLUMNS}
+    first=int(day.min())
+    day=day-first
+    out=dict(ops=np.bincount(day))
+    for name,values in [("service",service),("waiting",waiting)]:
+        values=np.asarray(values,dtype="float64")
+        seen=~np.isnan(values)
+        out[name+"_sum"]=np.bincount(day[seen],weights=values[seen],minlength=len(out["ops"]))
+        out[name+"_n"]=np.bincount(day[seen],minlength=len(out["ops"]))
+    return first,out
+
+class SeriesStore:
+    '''Prefix sums per day of the ops and the daily Brent prices
+    Input:
+        start; first day of the sums (epoch days)
+        prefix; dict of COLUMNS arrays, item i the sum over the days before start+i
+        brent_days; epoch days of the Brent prices, ascending
+        brent_prices; Brent prices'''
+    def __init__(self,start,prefix,brent_days,brent_prices):
+        self.start=start
+        self.prefix=prefix
+        self.days=len(prefix["ops"])-1
+        self.brent_days=brent_days
+        self.brent_prices=brent_prices
+
+    @staticmethod
+    def _combine(parts):
+        ##Prefix sums of daily totals (first day, dict of arrays) covering other days
+        parts=[(first,daily) for first,daily in parts if len(daily["ops"])]
+        if not parts:
+            return 0,{col:np.zeros(1) for col in COLUMNS}
+        start=min(first for first,_ in parts)
+        days=max(first+len(daily["ops"]) for first,daily in parts)-start
+        prefix={}
+        for col in COLUMNS:
+            total=np.zeros(days+1)
+            for first,daily in parts:
+                total[first-start+1:first-start+1+len(daily[col])]+=daily[col]
+            prefix[col]=np.cumsum(total)
+        return start,prefix
+
+    @classmethod
+    def build(cls,chunks,brent_dates,brent_prices):
+        '''Store of the whole ops table and the Brent prices
+        Input:
+            chunks; iterable of (times, service, waiting) arrays (Backend.time_chunks)
+            brent_dates, brent_prices; daily Brent prices, sorted on the dates
+        Returns. SeriesStore'''
+        start,prefix=cls._combine([day_totals(*chunk) for chunk in chunks])
+        prices=np.asarray(brent_prices,dtype="float64")
+        days=np.asarray(brent_dates).astype("datetime64[D]").astype("int64")
+        return cls(start,prefix,days[~np.isnan(prices)],prices[~np.isnan(prices)])
+
+    def daily(self):
+        '''Totals per day from the first day, dict of COLUMNS arrays'''
+        return {col:np.diff(values) for col,values in self.prefix.items()}
+
+    def add(self,times,service,waiting):
+        '''Copy of the store with ops rows added (see day_totals)'''
+        start,prefix=self._combine([(self.start,self.daily()),day_totals(times,service,waiting)])
+        return SeriesStore(start,prefix,self.brent_days,self.brent_prices)
+
+    def _window(self,date_from,date_to,resolution):
+        ##Period starts of a window and the sums of every period
+        first,last=epoch_day(date_from),epoch_day(date_to)
+        starts=period_starts(first,last,resolution)
+        edges=np.clip(np.append(starts,last+1)-self.start,0,self.days)
+        return starts,{col:np.diff(values[edges]) for col,values in self.prefix.items()}
+
+    def ops(self,date_from,date_to,resolution="W"):
+        '''Operations and mean service and waiting times (hours) per period of a window
+        Input:
+            date_from, date_to; dates of the window, their days included
+            resolution; D, W or M
+        Returns. Dataframe indexed by the period starts: ops, service and waiting (NaN without ops)'''
+        starts,sums=self._window(date_from,date_to,resolution)
+        with np.errstate(invalid="ignore",divide="ignore"):
+            return pd.DataFrame({"ops":sums["ops"].astype("int64"),
+                                 "service":sums["service_sum"]/sums["service_n"],
+                                 "waiting":sums["waiting_sum"]/sums["waiting_n"]},
+                                index=pd.DatetimeIndex(starts.astype("datetime64[D]"),name="period"))
+
+    def brent(self,date_from,date_to,resolution="W"):
+        '''Open, high, low and close Brent prices per period of a window
+        Input:
+            date_from, date_to; dates of the window, their days included
+            resolution; D, W or M
+        Returns. Dataframe indexed by the period starts, periods without prices left out'''
+        first,last=epoch_day(date_from),epoch_day(date_to)
+        lo=self.brent_days.searchsorted(first,side="left")
+        hi=self.brent_days.searchsorted(last,side="right")
+        days,prices=self.brent_days[lo:max(lo,hi)],self.brent_prices[lo:max(lo,hi)]
+        starts=period_starts(first,last,resolution)
+        ##First price of every period, the periods without prices dropped
+        at=days.searchsorted(starts)
+        keep=at<np.append(at[1:],len(days))
+        starts,at=starts[keep],at[keep]
+        end=np.append(at[1:],len(days))-1
+        index=pd.DatetimeIndex(starts.astype("datetime64[D]"),name="period")
+        if not len(at):
+            return pd.DataFrame({col:np.zeros(0) for col in ["open","high","low","close"]},index=index)
+        return pd.DataFrame({"open":prices[at],"high":np.maximum.reduceat(prices,at),
+                             "low":np.minimum.reduceat(prices,at),"close":prices[end]},index=index)
+
+    def table(self,date_from,date_to,resolution="W"):
+        '''Operations, mean times and Brent prices per period of a window, one row per period'''
+        return self.ops(date_from,date_to,resolution).join(self.brent(date_from,date_to,resolution))
@@ -0,0 +1,126 @@
+"""
+Spatial index of the port positions for the map.
+
+The ports with operations are put once per dataset in a uniform longitude x
+latitude grid. Box and lasso selections of the map are resolved against it (the
+grid cells overlapping the selection, then an exact test of their ports), and
+the markers of a viewport are the ports of the cells it overlaps. When a
+viewport holds more ports than the map draws well they are clustered on a
+screen grid of the zoom (web mercator pixels), one marker per group.
+"""
+import math
+import numpy as np
+
+##Tile size of the web mercator pixels
+TILE=256
+
+def mercator(lon,lat,zoom):
+    '''Web mercator pixel coordinates of positions at a zoom'''
+    scale=TILE*2.0**zoom
+    lat=np.clip(np.radians(np.asarray(lat,dtype="float64")),-1.4844,1.4844)
+    x=(np.asarray(lon,dtype="float64")+180)/360*scale
+    y=(1-np.log(np.tan(lat)+1/np.cos(lat))/math.pi)/2*scale
+    return x,y
+
+def viewport(relayout,center,zoom,width=760,height=500):
+    '''Bounds of the map view from a mapbox relayoutData
+    Input:
+        relayout; relayoutData of the map, None or without the view for the initial one
+        center; dict lat, lon of the initial view
+        zoom; initial zoom
+        width, height; map size in pixels when relayout has no corner coordinates
+    Returns. (lon0,lat0,lon1,lat1), zoom'''
+    relayout=relayout or {}
+    zoom=float(relayout.get("mapbox.zoom",zoom))
+    corners=(relayout.get("mapbox._derived") or {}).get("coordinates")
+    if corners:
+        lon,lat=np.asarray(corners,dtype="float64").T
+        return (lon.min(),lat.min(),lon.max(),lat.max()),zoom
+    center=relayout.get("mapbox.center",center)
+    x,y=mercator(center["lon"],center["lat"],zoom)
+    scale=TILE*2.0**zoom
+    lon0,lon1=[(x+dx)/scale*360-180 for dx in (-width/2,width/2)]
+    lat1,lat0=[math.degrees(math.atan(math.sinh(math.pi*(1-2*(y+dy)/scale)))) for dy in (-height/2,height/2)]
+    return (lon0,lat0,lon1,lat1),zoom
+
+class PortIndex:
+    '''Grid index of port positions
+    Input:
+        codes; port codes
+        names; port names
+        lat, lon; positions in degrees
+        cell; grid cell size in degrees'''
+    def __init__(self,codes,names,lat,lon,cell=1.0):
+        self.codes=np.asarray(codes,dtype=object)
+        self.names=np.asarray(names,dtype=object)
+        self.lat=np.asarray(lat,dtype="float64")
+        self.lon=np.asarray(lon,dtype="float64")
+        self.cell=cell
+        self._cols=int(math.ceil(360/cell))+1
+        ##Ports sorted on their cell, the ports of a row of cells are contiguous
+        key=self._key(self.lon,self.lat)
+        self._order=np.argsort(key,kind="mergesort")
+        self._keys=key[self._order]
+
+    def __len__(self):
+        return len(self.codes)
+
+    def _key(self,lon,lat):
+        col=np.floor((np.asarray(lon)+180)/self.cell).astype("int64")
+        row=np.floor((np.clip(lat,-90,90)+90)/self.cell).astype("int64")
+        return row*self._cols+col
+
+    def _candidates(self,lon0,lat0,lon1,lat1):
+        ##Ports of the cells overlapping a box (lon0<=lon1)
+        c0,c1=[int(math.floor((min(max(v,-180),180)+180)/self.cell)) for v in (lon0,lon1)]
+        r0,r1=[int(math.floor((min(max(v,-90),90)+90)/self.cell)) for v in (lat0,lat1)]
+        rows=np.arange(r0,r1+1)*self._cols
+        start=self._keys.searchsorted(rows+c0)
+        stop=self._keys.searchsorted(rows+c1,side="right")
+        if not len(rows):
+            return np.zeros(0,dtype="int64")
+        return np.concatenate([self._order[a:b] for a,b in zip(start,stop)])
+
+    def bbox(self,lon0,lat0,lon1,lat1):
+        '''Positions of the ports inside a box, lon0>lon1 crosses the antimeridian
+        Returns. Numpy array of positions, ascending'''
+        if lon0>lon1:
+            return np.union1d(self.bbox(lon0,lat0,180,lat1),self.bbox(-180,lat0,lon1,lat1))
+        pos=self._candidates(lon0,lat0,lon1,lat1)
+        inside=(self.lon[pos]>=lon0)&(self.lon[pos]<=lon1)&(self.lat[pos]>=lat0)&(self.lat[pos]<=lat1)
+        return np.sort(pos[inside])
+
+    def lasso(self,points):
+        '''Positions of the ports inside a polygon (even-odd rule)
+        Input:
+            points; [[lon,lat],...] vertices
+        Returns. Numpy array of positions, ascending'''
+        lon,lat=np.asarray(points,dtype="float64").reshape(-1,2).T
+        if len(lon)<3:
+            return np.zeros(0,dtype="int64")
+        pos=self.bbox(lon.min(),lat.min(),lon.max(),lat.max())
+        x,y=self.lon[pos][:,None],self.lat[pos][:,None]
+        x0,y0,x1,y1=lon,lat,np.roll(lon,-1),np.roll(lat,-1)
+        ##Edges crossing the horizontal line of every port, right of it
+        crosses=((y0>y)!=(y1>y))&(x<(x1-x0)*(y-y0)/np.where(y1==y0,1,y1-y0)+x0)
+        return pos[crosses.sum(axis=1)%2==1]
+
+    def markers(self,bounds,zoom,max_markers=500,radius=40):
+        '''Markers of a viewport
+        Input:
+            bounds; (lon0,lat0,lon1,lat1) of the view
+            zoom; mapbox zoom
+            max_markers; ports drawn one by one up to this number
+            radius; cluster size in pixels beyond it
+        Returns. List of position arrays, one per marker'''
+        if len(self)<=max_markers:
+            pos=np.arange(len(self))
+        else:
+            pos=self.bbox(*bounds)
+        if len(pos)<=max_markers:
+            return [pos[i:i+1] for i in range(len(pos))]
+        x,y=mercator(self.lon[pos],self.lat[pos],zoom)
+        group=np.floor(x/radius).astype("int64")*(1<<32)+np.floor(y/radius).astype("int64")
+        keys,inverse=np.unique(group,return_inverse=True)
+        order=np.argsort(inverse,kind="mergesort")
+        return np.split(pos[order],np.cumsum(np.bincount(inverse,minlength=len(keys)))[:-1])
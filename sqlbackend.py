@@ -0,0 +1,331 @@
+"""
+SQLite backend of the dashboard panels.
+
+The conversion command
+
+    python sqlbackend.py [--data data] [--out data/ops.sqlite] [--chunksize 200000]
+
+cleans the ops CSV in chunks (partitions.clean_chunks) and writes it to one
+SQLite file, with the ports and vessel types as integer ids and indexes on
+start_of_service, code, ConType and VesselGT. With BUNKER_SQLITE=<file> the
+dashboard opens it read only and starts without loading the ops table; all the
+workers read the same file (memory-mapped, the pages shared through the OS
+cache). The rows are clustered on (code, start_of_service). Counts, age bins,
+the 95th percentile cutoffs (with the interpolation of pandas) and the linear
+binning of the densities run in the engine, only the smoothing of the binned
+densities is done in numpy.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import numpy as np
+import pandas as pd
+import store
+from backends import Backend, export_frame
+from density import group_bounds, kde_grid, smooth
+from filters import sorted_counts
+from partitions import clean_chunks
+
+SCHEMA="""
+CREATE TABLE ports (id INTEGER PRIMARY KEY, code TEXT NOT NULL, name TEXT NOT NULL);
+CREATE TABLE types (id INTEGER PRIMARY KEY, name TEXT NOT NULL);
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE ops (code INTEGER NOT NULL, start_of_service INTEGER NOT NULL, seq INTEGER NOT NULL,
+                  port_name INTEGER NOT NULL, ConType INTEGER, VesselGT REAL, barge_age_at_op INTEGER NOT NULL,
+                  service_time REAL, waiting_time REAL, PRIMARY KEY (code, start_of_service, seq)) WITHOUT ROWID;
+"""
+##The rows are clustered on (code, start_of_service): the ops of a port and date window are contiguous
+INDEXES="""
+CREATE INDEX ops_start ON ops (start_of_service);
+CREATE INDEX ops_type ON ops (ConType);
+CREATE INDEX ops_gt ON ops (VesselGT);
+"""
+
+##Conversion
+def _nullable(values):
+    ##NaN as NULL
+    values=np.asarray(values,dtype="float64")
+    return np.where(np.isnan(values),None,values.astype(object)).tolist()
+
+def write_database(chunks,path):
+    '''Writes cleaned ops chunks to a SQLite file
+    Input:
+        chunks; iterable of cleaned ops dataframes, in file order
+        path; destination file, replaced when it exists
+    Returns. Number of rows written'''
+    tmp=path+".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    connection=sqlite3.connect(tmp)
+    connection.executescript(SCHEMA)
+    ports,names,types={},{},{}
+    rows=0
+    reference_year=None
+    for chunk in chunks:
+        if reference_year is None:
+            reference_year=int(chunk.barge_age_at_op.iloc[0]+chunk.BargeBuilt.iloc[0])
+        ##Ids in order of appearance
+        code=np.asarray(chunk.code.values).astype(str)
+        name=np.asarray(chunk.bunkering_port.values).astype(str)
+        for i,j in zip(code,name):
+            if i not in ports:
+                ports[i]=len(ports)
+                connection.execute("INSERT INTO ports VALUES (?,?,?)",(ports[i],i,j))
+            names.setdefault(j,len(names))
+        kind=chunk.ConType.values
+        for i in pd.unique(kind[pd.notna(kind)]):
+            if i not in types:
+                types[i]=len(types)
+                connection.execute("INSERT INTO types VALUES (?,?)",(types[i],i))
+        kind=pd.Series(kind).map(types)
+        connection.executemany("INSERT INTO ops VALUES (?,?,?,?,?,?,?,?,?)",zip(
+            [ports[i] for i in code],chunk.start_of_service.values.astype("datetime64[ns]").astype("int64").tolist(),
+            range(rows,rows+chunk.shape[0]),[names[i] for i in name],_nullable(kind),_nullable(chunk.VesselGT.values),
+            chunk.barge_age_at_op.values.astype("int64").tolist(),
+            _nullable(chunk.service_time.values),_nullable(chunk.waiting_time.values)))
+        rows+=chunk.shape[0]
+    if rows==0:
+        connection.close()
+        os.remove(tmp)
+        raise ValueError("no ops rows to write")
+    connection.executescript(INDEXES)
+    ##Dropdown options in order of appearance (earliest operation, then file order)
+    port_order=connection.execute(
+        "SELECT p.name,p.code FROM (SELECT code,start_of_service,seq,ROW_NUMBER() OVER "
+        "(PARTITION BY port_name ORDER BY start_of_service,seq) AS k FROM ops) o JOIN ports p ON p.id=o.code "
+        "WHERE o.k=1 ORDER BY o.start_of_service,o.seq").fetchall()
+    type_order=connection.execute(
+        "SELECT t.name FROM (SELECT ConType,start_of_service,seq,ROW_NUMBER() OVER "
+        "(PARTITION BY ConType ORDER BY start_of_service,seq) AS k FROM ops WHERE ConType IS NOT NULL) o "
+        "JOIN types t ON t.id=o.ConType WHERE o.k=1 ORDER BY o.start_of_service,o.seq").fetchall()
+    start,end=connection.execute("SELECT MIN(start_of_service),MAX(start_of_service) FROM ops").fetchone()
+    meta=dict(rows=rows,reference_year=reference_year,start=start,end=end,port_names=sorted(names,key=names.get),
+              port_order=[list(i) for i in port_order],type_order=[i[0] for i in type_order])
+    connection.executemany("INSERT INTO meta VALUES (?,?)",[(k,json.dumps(v)) for k,v in meta.items()])
+    connection.execute("ANALYZE")
+    connection.commit()
+    connection.close()
+    os.replace(tmp,path)
+    return rows
+
+def convert(data_dir="data",path=None,chunksize=200000):
+    '''Writes the ops CSV of a data folder to a SQLite file, default <data_dir>/ops.sqlite'''
+    path=path or os.path.join(data_dir,"ops.sqlite")
+    return write_database(clean_chunks(os.path.join(data_dir,store.OPS_CSV),chunksize),path)
+
+def from_frame(frame,path,chunksize=200000):
+    '''Writes a cleaned ops table (store.load("ops")) to a SQLite file'''
+    return write_database((frame.iloc[i:i+chunksize] for i in range(0,frame.shape[0],chunksize)),path)
+
+##Queries
+class SQLiteOps(Backend):
+    '''Ops table in a SQLite file written by write_database, opened read only.
+    One connection per thread (and per process, connections do not survive a fork)
+    Input:
+        path; SQLite file
+        mmap_size; bytes of the file memory-mapped by every connection'''
+    def __init__(self,path,mmap_size=1<<30):
+        self.path=path
+        self.mmap_size=mmap_size
+        self._local=threading.local()
+        connection=self._connection()
+        meta={k:json.loads(v) for k,v in connection.execute("SELECT key,value FROM meta")}
+        self.rows=meta["rows"]
+        self._span=(meta["start"],meta["end"])
+        self.end=pd.Timestamp(meta["end"])
+        ports=connection.execute("SELECT id,code,name FROM ports ORDER BY id").fetchall()
+        self._port_id={code:i for i,code,_ in ports}
+        self.port_names=pd.Series([name for _,_,name in ports],index=[code for _,code,_ in ports])
+        self._type_id={name:i for i,name in connection.execute("SELECT id,name FROM types")}
+        self._name_id={name:i for i,name in enumerate(meta["port_names"])}
+        ##Port ids of every name, the clustered key of the rows of a name
+        self._name_codes={}
+        for i,_,name in ports:
+            self._name_codes.setdefault(self._name_id[name],[]).append(i)
+        self.codes=sorted(self._port_id)
+        self.port_options=[tuple(i) for i in meta["port_order"]]
+        self.type_options=meta["type_order"]
+
+    def _connection(self):
+        if getattr(self._local,"pid",None)!=os.getpid():
+            self._local.connection=sqlite3.connect("file:{}?mode=ro".format(self.path),uri=True)
+            self._local.connection.execute("PRAGMA mmap_size={:d}".format(self.mmap_size))
+            self._local.pid=os.getpid()
+        return self._local.connection
+
+    def query(self,sql,params=()):
+        '''Rows of a query'''
+        return self._connection().execute(sql,params).fetchall()
+
+    def _where(self,state):
+        ##WHERE clause and parameters of a selection. The time index is left out of
+        ##windows over half the table, a scan of the clustered rows is faster there
+        start,end=self._span
+        wide=min(state.date_to.value,end)-max(state.date_from.value,start)>(end-start)/2
+        clauses=["{}start_of_service BETWEEN ? AND ?".format("+" if wide else "")]
+        params=[state.date_from.value,state.date_to.value]
+        for column,ids,values in [("code",self._port_id,state.port),("ConType",self._type_id,state.type_vessel)]:
+            if "full" not in values:
+                values=[ids[i] for i in values if i in ids]
+                clauses.append("{} IN ({})".format(column,",".join("?"*len(values))) if values else "0")
+                params+=values
+        if "full" not in state.size:
+            clauses.append("VesselGT > ? AND VesselGT <= ?")
+            params+=[float(state.size[0]),float(state.size[1])]
+        return " AND ".join(clauses),params
+
+    def code_counts(self,state):
+        where,params=self._where(state)
+        count=np.zeros(len(self.codes),dtype="int64")
+        position={code:i for i,code in enumerate(self.codes)}
+        codes=self.port_names.index
+        for port,n in self.query("SELECT code,COUNT(*) FROM ops WHERE {} GROUP BY code".format(where),params):
+            count[position[codes[port]]]=n
+        return sorted_counts(count,self.codes,"code")
+
+    def port_counts(self,state):
+        where,params=self._where(state)
+        names=sorted(self._name_id)
+        position={self._name_id[name]:i for i,name in enumerate(names)}
+        count=np.zeros(len(names),dtype="int64")
+        for name,n in self.query("SELECT port_name,COUNT(*) FROM ops WHERE {} GROUP BY port_name".format(where),params):
+            count[position[name]]=n
+        return sorted_counts(count,names,"bunkering_port")
+
+    def export_chunks(self,state,chunksize=50000):
+        ##In the order of the clustered key (port, then time)
+        where,params=self._where(state)
+        codes=self.port_names.index.values.astype(object)
+        names=self.port_names.values.astype(object)
+        types={i:name for name,i in self._type_id.items()}
+        cursor=self._connection().execute("SELECT code,start_of_service,ConType,VesselGT,barge_age_at_op,service_time,"
+                                          "waiting_time FROM ops WHERE {} ORDER BY code,start_of_service,seq".format(where),
+                                          params)
+        while True:
+            rows=cursor.fetchmany(chunksize)
+            if not rows:
+                break
+            port,time,kind,gt,age,service,waiting=zip(*rows)
+            port=np.array(port,dtype="int64")
+            yield export_frame(start_of_service=np.array(time,dtype="int64").astype("datetime64[ns]"),
+                               bunkering_port=names[port],code=codes[port],
+                               ConType=np.array([types.get(i) for i in kind],dtype=object),
+                               VesselGT=np.array(gt,dtype="float64"),barge_age_at_op=age,
+                               service_time=np.array(service,dtype="float64"),
+                               waiting_time=np.array(waiting,dtype="float64"))
+
+    def time_chunks(self,chunksize=200000):
+        cursor=self._connection().execute("SELECT start_of_service,service_time,waiting_time FROM ops")
+        while True:
+            rows=cursor.fetchmany(chunksize)
+            if not rows:
+                break
+            times,service,waiting=zip(*rows)
+            ##NULL times as NaN
+            yield (np.array(times,dtype="int64").astype("datetime64[ns]"),
+                   np.array(service,dtype="float64"),np.array(waiting,dtype="float64"))
+
+    def age_histogram(self,state,width=2):
+        where,params=self._where(state)
+        bins=self.query("SELECT barge_age_at_op/? AS bin,COUNT(*) FROM ops WHERE {} GROUP BY bin".format(where),
+                        [int(width)]+params)
+        count=np.zeros(max([i for i,_ in bins],default=-1)+1,dtype="int64")
+        for i,n in bins:
+            count[i]=n
+        return np.arange(len(count))*width,count
+
+    def _codes_in(self,groups):
+        ##Clause on the port ids of port names
+        codes=[i for group in groups for i in self._name_codes.get(group,[])]
+        return ("code IN ({})".format(",".join("?"*len(codes))) if codes else "0"),codes
+
+    def _quantiles(self,column,where,params,q,sizes=None):
+        ##q quantile of column per port name, linear interpolation as pandas. The two
+        ##values around it are read from the top of the order, a sort bounded to the tail
+        out={}
+        if sizes is None:
+            sizes=self.query("SELECT port_name,COUNT({c}) FROM ops WHERE {w} GROUP BY port_name".format(c=column,w=where),
+                             params)
+        for group,n in sizes:
+            if n==0:
+                continue
+            pos=q*(n-1)
+            below=int(np.floor(pos))
+            above=min(below+1,n-1)
+            clause,codes=self._codes_in([group])
+            values=[i[0] for i in self.query("SELECT {c} FROM ops WHERE {w} AND {p} AND {c} IS NOT NULL "
+                                             "ORDER BY {c} DESC LIMIT ? OFFSET ?".format(c=column,w=where,p=clause),
+                                             params+codes+[above-below+1,n-1-above])]
+            hi,lo=values[0],values[-1]
+            out[group]=lo+(hi-lo)*(pos-below)
+        return out
+
+    def port_stats(self,state,code,q=0.95):
+        where,params=self._where(state._replace(port=(code,)))
+        group=self._name_id[self.port_names[code]]
+        ops,age,service,waiting=self.query("SELECT COUNT(*),AVG(barge_age_at_op),COUNT(service_time),COUNT(waiting_time) "
+                                           "FROM ops WHERE {}".format(where),params)[0]
+        cutoff=[self._quantiles(column,where,params,q,[(group,n)]).get(group) for column,n in
+                [("service_time",service),("waiting_time",waiting)]]
+        ##Both trimmed means in one pass
+        service,waiting=self.query("SELECT AVG(CASE WHEN service_time<=? THEN service_time END),"
+                                   "AVG(CASE WHEN waiting_time<=? THEN waiting_time END) FROM ops WHERE {}".format(where),
+                                   cutoff+params)[0]
+        return dict(name=self.port_names[code],ops=ops,age=np.nan if age is None else age,
+                    service=np.nan if service is None else service,waiting=np.nan if waiting is None else waiting)
+
+    def grouped_kde(self,state,column,labels,q=0.95,clip=None,points=500):
+        n=len(labels)
+        where,params=self._where(state)
+        ids=[self._name_id.get(i,-1) for i in labels]
+        clause,codes=self._codes_in(ids)
+        where+=" AND "+clause
+        params+=codes
+        group={i:k for k,i in enumerate(ids)}
+        cutoff=self._quantiles(column,where,params,q)
+        ##Values up to the cutoff of their port, clipped
+        case="CASE port_name {} END".format(" ".join("WHEN ? THEN ?" for _ in cutoff))
+        case_params=[i for pair in cutoff.items() for i in pair]
+        value="MIN({},?)".format(column) if clip is not None else column
+        value_params=[float(clip)] if clip is not None else []
+        trimmed=("SELECT port_name AS g,{v} AS v FROM ops WHERE {w} AND {c} IS NOT NULL AND {c}<={case}"
+                 .format(v=value,w=where,c=column,case=case))
+        trimmed_params=value_params+params+case_params
+
+        size=np.zeros(n,dtype="int64")
+        low=np.full(n,np.inf)
+        high=np.full(n,-np.inf)
+        total=np.zeros(n)
+        squares=np.zeros(n)
+        if cutoff:
+            for g,count,lo,hi,s,ss in self.query("SELECT g,COUNT(*),MIN(v),MAX(v),SUM(v),SUM(v*v) FROM ({}) GROUP BY g"
+                                                 .format(trimmed),trimmed_params):
+                k=group[g]
+                size[k],low[k],high[k],total[k],squares[k]=count,lo,hi,s,ss
+        if size.sum()==0:
+            grid=kde_grid(0.0,0.0,points)
+            return grid,np.zeros((n,points)),group_bounds(grid,low,high)
+        var=np.maximum(squares-total**2/np.maximum(size,1),0)/np.maximum(size-1,1)
+        grid=kde_grid(low[size>0].min(),high[size>0].max(),points)
+
+        ##Linear binning on the shared grid, each value split on its two nearest points
+        step=grid[1]-grid[0]
+        binned=np.zeros((n,points))
+        rows=self.query("SELECT g,l,SUM(1-(p-l)),SUM(p-l) FROM (SELECT g,p,MIN(CAST(p AS INTEGER),?) AS l FROM "
+                        "(SELECT g,(v-?)/? AS p FROM ({}))) GROUP BY g,l".format(trimmed),
+                        [points-2,float(grid[0]),float(step)]+trimmed_params)
+        for g,left,lower,upper in rows:
+            binned[group[g],left]+=lower
+            binned[group[g],left+1]+=upper
+        return grid,smooth(binned,size,var,grid),group_bounds(grid,low,high)
+
+if __name__=="__main__":
+    parser=argparse.ArgumentParser(description="Writes the ops CSV to an indexed SQLite file")
+    parser.add_argument("--data",default="data",help="data folder with the ops CSV")
+    parser.add_argument("--out",default=None,help="destination file. Default <data>/ops.sqlite")
+    parser.add_argument("--chunksize",type=int,default=200000,help="rows read at once")
+    args=parser.parse_args()
+    rows=convert(args.data,args.out,args.chunksize)
+    print("{:,} rows written to {}".format(rows,args.out or os.path.join(args.data,"ops.sqlite")))
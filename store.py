@@ -0,0 +1,196 @@
+"""
+Loading of the dashboard tables and their binary columnar store.
+
+The CSV files are parsed and cleaned once by the conversion command
+
+    python store.py [--data data]
+
+which writes every table to <data>/store/<table>/ as one .npy file per column
+(text columns as integer codes plus their categories) and a manifest.json.
+At startup the store is memory-mapped when present, so boot time does not grow
+with the parsing work and the workers share the pages through the OS cache.
+Without a store (or with a CSV newer than it) the CSV is parsed as before.
+"""
+import argparse
+import json
+import os
+import numpy as np
+import pandas as pd
+
+OPS_CSV="bunkering_ops_mediterranean.csv"
+BRENT_CSV="brent-daily.csv"
+PORTS_CSV="ports_positions.csv"
+
+##CSV parsing and cleaning
+OPS_COLUMNS=["start_of_service","vessel_inside_port","bunkering_port","code","ConType",
+             "VesselGT","service_time","BargeBuilt","barge_imo"]
+##Ports with this many observations or less are left out
+MIN_PORT_OPS=30
+
+def parse_ops(df):
+    '''Dates and port names of raw ops rows'''
+    df["start_of_service"]=pd.to_datetime(df["start_of_service"])
+    df["vessel_inside_port"]=pd.to_datetime(df["vessel_inside_port"])
+    ##Sentence case
+    df["bunkering_port"]=df.bunkering_port.str.title()
+    return df
+
+def derive_ops(df,reference_year):
+    '''Waiting time (hours) and barge age at the operation, false ages dropped
+    Input:
+        df; parsed ops rows
+        reference_year; year the barge ages are counted at
+    Returns. Dataframe'''
+    ##Waiting time generation and barge age
+    df=df.assign(waiting_time=df.start_of_service-df.vessel_inside_port,
+                  barge_age_at_op=reference_year-df.BargeBuilt)
+    ##False values
+    df=df[df.barge_age_at_op>0].copy()
+
+    df["waiting_time"]=df.waiting_time/np.timedelta64(1,"h")
+    return df
+
+def compact_ops(df):
+    '''Sorted on start_of_service with compact dtypes'''
+    ##Sorted on start of service so date windows are found by binary search
+    df=df.sort_values(by=["start_of_service"],kind="mergesort").reset_index(drop=True)
+
+    ##Compact layout. Text columns as categories (integer codes) and numbers downcast
+    for col in ["bunkering_port","code","ConType"]:
+        df[col]=df[col].astype("category")
+    ##GT as integers, or as float32 with missing values since the GT values are exact in it
+    gt=pd.to_numeric(df.VesselGT,downcast="integer")
+    if gt.dtype.kind=="f" and np.array_equal(gt.values.astype("float32"),gt.values,equal_nan=True):
+        gt=gt.astype("float32")
+    df["VesselGT"]=gt
+    df["barge_age_at_op"]=pd.to_numeric(df.barge_age_at_op,downcast="integer")
+    df["service_time"]=df.service_time.astype("float32")
+    df["waiting_time"]=df.waiting_time.astype("float32")
+    return df
+
+def clean_ops(df):
+    '''Cleaning and derived columns of the bunkering operations
+    Input:
+        df; raw ops dataframe as read from the CSV
+    Returns. Dataframe sorted on start_of_service with compact dtypes. attrs hold the
+        reference year of the barge ages and the raw ops per port, for the rows appended later'''
+    df=parse_ops(df)
+    # ##Remove the ports with less than 30 observations
+    test=df.bunkering_port.value_counts()
+    df=df[df.bunkering_port.isin(test.index[test.values>MIN_PORT_OPS])].reset_index(drop=True)
+    reference_year=int(df.start_of_service[0].year)
+    df=compact_ops(derive_ops(df,reference_year))
+    df.attrs.update(reference_year=reference_year,
+                    port_ops={k:int(v) for k,v in test.items()})
+    return df
+
+def read_ops_csv(data_dir="data"):
+    return clean_ops(pd.read_csv(os.path.join(data_dir,OPS_CSV),parse_dates=True))
+
+def read_brent_csv(data_dir="data"):
+    brent_df=pd.read_csv(os.path.join(data_dir,BRENT_CSV))
+    brent_df["Date"]=pd.to_datetime(brent_df["Date"])
+    return brent_df.sort_values(by=["Date"],kind="mergesort").reset_index(drop=True)
+
+def read_ports_csv(data_dir="data"):
+    return pd.read_csv(os.path.join(data_dir,PORTS_CSV))
+
+TABLES={"ops":(OPS_CSV,read_ops_csv),
+        "brent":(BRENT_CSV,read_brent_csv),
+        "ports":(PORTS_CSV,read_ports_csv)}
+
+##Binary store
+def write_table(frame,directory):
+    '''Writes a dataframe as one .npy file per column plus a manifest
+    Input:
+        frame; dataframe with a default index
+        directory; destination folder, created if needed
+    Returns. None'''
+    os.makedirs(directory,exist_ok=True)
+    columns=[]
+    for i,col in enumerate(frame.columns):
+        values=frame[col]
+        name="{:03d}.npy".format(i)
+        entry={"name":col,"file":name}
+        ##Text columns as codes plus categories, restored to their dtype on load
+        if isinstance(values.dtype,pd.CategoricalDtype) or values.dtype==object:
+            entry["kind"]="category" if isinstance(values.dtype,pd.CategoricalDtype) else "object"
+            values=values.astype("category")
+            entry["categories"]=values.cat.categories.tolist()
+            np.save(os.path.join(directory,name),values.cat.codes.values)
+        else:
+            entry["kind"]="array"
+            np.save(os.path.join(directory,name),values.values)
+        columns.append(entry)
+    ##Manifest written last, a table without it is incomplete
+    with open(os.path.join(directory,"manifest.json"),"w") as f:
+        json.dump({"rows":int(frame.shape[0]),"columns":columns,"attrs":frame.attrs},f,default=str)
+
+def read_table(directory,mmap=True):
+    '''Reads a table written by write_table
+    Input:
+        directory; table folder
+        mmap; memory-map the columns (read only) instead of reading them
+    Returns. Dataframe'''
+    with open(os.path.join(directory,"manifest.json")) as f:
+        manifest=json.load(f)
+    data={}
+    for entry in manifest["columns"]:
+        values=np.load(os.path.join(directory,entry["file"]),mmap_mode="r" if mmap else None)
+        if entry["kind"]=="array":
+            data[entry["name"]]=values
+        else:
+            values=pd.Categorical.from_codes(values,categories=entry["categories"])
+            data[entry["name"]]=values if entry["kind"]=="category" else np.asarray(values,dtype=object)
+    ##copy=False keeps one block per column on top of the mapped files
+    frame=pd.DataFrame(data,columns=[i["name"] for i in manifest["columns"]],copy=False)
+    frame.attrs.update(manifest.get("attrs",{}))
+    return frame
+
+def freeze(frame):
+    '''Read only copy of a parsed table, laid out as a table of the store
+    Input:
+        frame; dataframe
+    Returns. Dataframe with one read only array per column'''
+    data={}
+    for col in frame.columns:
+        values=frame[col].array
+        if isinstance(values,pd.Categorical):
+            codes=np.array(values.codes)
+            codes.flags.writeable=False
+            data[col]=pd.Categorical.from_codes(codes,dtype=values.dtype)
+        else:
+            values=np.array(values)
+            values.flags.writeable=False
+            data[col]=values
+    frame_out=pd.DataFrame(data,columns=frame.columns,copy=False)
+    frame_out.attrs.update(frame.attrs)
+    return frame_out
+
+def store_path(name,data_dir="data"):
+    return os.path.join(data_dir,"store",name)
+
+def load(name,data_dir="data"):
+    '''Table by name (ops, brent or ports), from the store when present and fresh
+    Input:
+        name; table name
+        data_dir; data folder
+    Returns. Dataframe of read only arrays, safe to share between forked workers'''
+    csv,reader=TABLES[name]
+    manifest=os.path.join(store_path(name,data_dir),"manifest.json")
+    csv=os.path.join(data_dir,csv)
+    if os.path.exists(manifest) and (not os.path.exists(csv) or os.path.getmtime(csv)<=os.path.getmtime(manifest)):
+        return read_table(store_path(name,data_dir))
+    return freeze(reader(data_dir))
+
+def convert(data_dir="data"):
+    '''Parses every CSV of the data folder and writes the binary store'''
+    for name,(csv,reader) in TABLES.items():
+        frame=reader(data_dir)
+        write_table(frame,store_path(name,data_dir))
+        print("{}: {:,} rows -> {}".format(csv,frame.shape[0],store_path(name,data_dir)))
+
+if __name__=="__main__":
+    parser=argparse.ArgumentParser(description="Converts the dashboard CSV files to the binary columnar store")
+    parser.add_argument("--data",default="data",help="data folder holding the CSV files")
+    convert(parser.parse_args().data)
@@ -0,0 +1,103 @@
+"""
+Versioned JSON API (api.py) served by the dashboard on generated data.
+"""
+import importlib
+import os
+import pandas as pd
+import pytest
+import analytics
+from api import MAX_BATCH, plain
+from filters import normalize_filters
+from ingest import Ingestor
+
+@pytest.fixture(scope="module")
+def app(data_dir):
+    ##The app loads its tables at import, from BUNKER_DATA_DIR
+    for name in [i for i in os.environ if i.startswith("BUNKER_")]:
+        os.environ.pop(name)
+    os.environ["BUNKER_DATA_DIR"]=data_dir
+    return importlib.import_module("app")
+
+@pytest.fixture
+def client(app):
+    return app.server.test_client()
+
+def test_index(client,app):
+    response=client.get("/api/v1")
+    assert response.status_code==200
+    body=response.get_json()
+    assert body["version"]=="v1" and body["dataset"]==app.current().version and body["batch"]==MAX_BATCH
+    assert body["queries"]["ranking"]==["top"] and body["queries"]["rollup"]==["resolution"]
+
+def test_query_and_not_modified(client,app):
+    url="/api/v1/ranking?fr=2016-01-01&to=2017-12-31&type=Tanker&top=3"
+    response=client.get(url)
+    assert response.status_code==200 and response.headers["ETag"]
+    body=response.get_json()
+    state=normalize_filters("2016-01-01","2017-12-31",None,["Tanker"],None)
+    assert body["data"]==plain(analytics.ranking(app.current().backend,state,3))
+    assert len(body["data"]["port"])==3
+    ##Same query, the ETag sent back
+    again=client.get(url,headers={"If-None-Match":response.headers["ETag"]})
+    assert again.status_code==304 and again.data==b""
+    ##Same filters in another order and form, same answer
+    other=client.get("/api/v1/ranking?type=Tanker&top=3&to=2017-12-31&fr=2016-01-01",
+                     headers={"If-None-Match":response.headers["ETag"]})
+    assert other.status_code==304
+    assert client.get("/api/v1/ranking?top=4",headers={"If-None-Match":response.headers["ETag"]}).status_code==200
+
+@pytest.mark.parametrize("query",["summary","barge_ages?width=5","distribution?graph=waiting","brent","rollup?resolution=M"])
+def test_queries(client,query):
+    response=client.get("/api/v1/"+query+("&" if "?" in query else "?")+"fr=2015-01-01&to=2015-12-31&port=ESALG")
+    assert response.status_code==200
+    assert response.get_json()["query"]==query.split("?")[0]
+
+@pytest.mark.parametrize("query,status",[("ranking?size=1000",400),("ranking?fr=not-a-date",400),
+                                         ("ranking?top=0",400),("barge_ages?width=-1",400),
+                                         ("distribution?graph=age",400),("rollup?resolution=Y",400),
+                                         ("nothing",404)])
+def test_errors(client,query,status):
+    response=client.get("/api/v1/"+query)
+    assert response.status_code==status and response.get_json()["error"]
+
+def test_batch(client):
+    queries=[{"query":"ranking","port":["ESALG","GIGIB"],"top":2},{"query":"summary","fr":"2016-01-01"},
+             {"query":"nothing"},{"query":"ranking","size":"x"}]
+    response=client.post("/api/v1/batch",json={"queries":queries})
+    assert response.status_code==200
+    results=response.get_json()["results"]
+    assert [i.get("query") for i in results[:2]]==["ranking","summary"]
+    assert results[2]["error"]=="unknown query nothing" and "error" in results[3]
+    assert results[0]["data"]==client.get("/api/v1/ranking?port=ESALG,GIGIB&top=2").get_json()["data"]
+    again=client.post("/api/v1/batch",json={"queries":queries},headers={"If-None-Match":response.headers["ETag"]})
+    assert again.status_code==304
+
+@pytest.mark.parametrize("body",[None,{"queries":"ranking"},{"queries":[1]},
+                                 {"queries":[{"query":"brent"}]*(MAX_BATCH+1)}])
+def test_batch_errors(client,body):
+    response=client.post("/api/v1/batch",json=body)
+    assert response.status_code==400
+
+def test_new_version_after_append(client,app,tmp_path):
+    response=client.get("/api/v1/rollup?resolution=M")
+    tag=response.headers["ETag"]
+    frame=app.current().backend.frame
+    ##The operations of 2018 again, a day after the last one
+    rows=frame[frame.start_of_service.dt.year==2018]
+    shift=frame.start_of_service.max()-rows.start_of_service.min()+pd.Timedelta(days=1)
+    rows=rows.assign(start_of_service=rows.start_of_service+shift,vessel_inside_port=rows.vessel_inside_port+shift)
+    rows.to_csv(tmp_path/"new.csv",index=False)
+    ingestor=Ingestor(frame,str(tmp_path),app.append_ops)
+    assert ingestor.scan()["appended"]==rows.shape[0]
+    response=client.get("/api/v1/rollup?resolution=M",headers={"If-None-Match":tag})
+    assert response.status_code==200 and response.headers["ETag"]!=tag
+    body=response.get_json()
+    assert body["dataset"]==app.current().version
+    assert sum(body["data"]["ops"])==frame.shape[0]+rows.shape[0]
+
+def test_inverted_window(client):
+    ##No periods when the window ends before it starts, in the API and the csv of the series panel
+    body=client.get("/api/v1/rollup?fr=2019-05-02&to=2019-05-01&resolution=M").get_json()
+    assert body["data"]["period"]==[] and body["data"]["ops"]==[]
+    response=client.get("/series.csv?fr=2019-05-02&to=2019-05-01&resolution=M")
+    assert response.status_code==200 and len(response.data.decode().strip().splitlines())==1
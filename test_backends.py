@@ -0,0 +1,101 @@
+"""
+Query backends (backends.py, partitions.py, sqlbackend.py) answering the same selections.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+import partitions
+import sqlbackend
+from backends import EXPORT_COLUMNS, FrameBackend, export_frame
+from conftest import GT_EDGES, random_states
+from cube import LogSketch, OpsCube
+
+@pytest.fixture(scope="module")
+def backends(ops,tmp_path_factory):
+    path=tmp_path_factory.mktemp("backends")
+    sketch=LogSketch(0.01)
+    cube=OpsCube.from_frame(ops,gt_edges=GT_EDGES,sketch=sketch)
+    partitions.from_frame(ops,str(path/"partitions"),chunksize=3000)
+    sqlbackend.from_frame(ops,str(path/"ops.sqlite"),chunksize=3000)
+    return dict(frame=FrameBackend(ops,cube),exact=FrameBackend(ops,cube,exact=True),
+                partitions=partitions.PartitionedOps(str(path/"partitions"),sketch=sketch),
+                sqlite=sqlbackend.SQLiteOps(str(path/"ops.sqlite")))
+
+def others(backends):
+    return [(name,backends[name]) for name in ["partitions","sqlite"]]
+
+def test_counts(backends,ops):
+    frame=backends["frame"]
+    for state in random_states(ops,80,seed=10):
+        for name,backend in others(backends):
+            assert backend.code_counts(state).equals(frame.code_counts(state)),(name,state)
+            assert backend.port_counts(state).equals(frame.port_counts(state)),(name,state)
+            for width in [2,5]:
+                starts,count=backend.age_histogram(state,width)
+                expected=frame.age_histogram(state,width)
+                assert np.array_equal(starts,expected[0]) and np.array_equal(count,expected[1]),(name,state)
+
+def test_port_stats(backends,ops):
+    frame,exact,part,sqlite=[backends[i] for i in ["frame","exact","partitions","sqlite"]]
+    for state in random_states(ops,60,seed=11):
+        for code in frame.code_counts(state).index[:2]:
+            expected=exact.port_stats(state,code)
+            ##Exact trimmed means in SQLite, from the sketches in the partitions (and the cube)
+            got=sqlite.port_stats(state,code)
+            assert got["name"]==expected["name"] and got["ops"]==expected["ops"]
+            for key in ["age","service","waiting"]:
+                assert got[key]==pytest.approx(expected[key],rel=1e-5),(key,state)
+            got=part.port_stats(state,code)
+            assert got["ops"]==expected["ops"] and got["age"]==pytest.approx(expected["age"])
+            for key in ["service","waiting"]:
+                assert got[key]==pytest.approx(expected[key],rel=part.sketch.alpha),(key,state)
+                if frame.cube.covers(state):
+                    assert got[key]==pytest.approx(frame.port_stats(state,code)[key],rel=1e-9),(key,state)
+
+def test_grouped_kde(backends,ops):
+    frame,exact,part,sqlite=[backends[i] for i in ["frame","exact","partitions","sqlite"]]
+    for state in random_states(ops,20,seed=12):
+        port_count=frame.port_counts(state)
+        labels=port_count.index[port_count.values>=30].tolist()
+        if not labels:
+            continue
+        for column,clip in [("service_time",None),("waiting_time",13)]:
+            pairs=[(exact,sqlite)]
+            ##Trimmed at the same sketch buckets when the cube covers the selection
+            if frame.cube.covers(state):
+                pairs.append((frame,part))
+            for a,b in pairs:
+                grid,density,bounds=a.grouped_kde(state,column,labels,0.95,clip)
+                other=b.grouped_kde(state,column,labels,0.95,clip)
+                assert np.allclose(grid,other[0]) and np.allclose(density,other[1],atol=1e-9)
+                assert np.array_equal(bounds,other[2])
+
+def exported(backend,state,chunksize):
+    ##Rows of every chunk, an empty export_frame first for the selections without rows
+    empty=export_frame(**{col:[] for col in EXPORT_COLUMNS})
+    return pd.concat([empty]+list(backend.export_chunks(state,chunksize=chunksize)),ignore_index=True)
+
+def test_export_chunks(backends,ops):
+    for state in random_states(ops,10,seed=13):
+        expected=exported(backends["frame"],state,500)
+        for name,backend in others(backends):
+            got=exported(backend,state,700)
+            assert got.shape==expected.shape,(name,state)
+            if not got.shape[0]:
+                continue
+            ##Same rows, the order of equal start times may differ between backends
+            key=["start_of_service","code","VesselGT","service_time"]
+            got=got.sort_values(key,kind="mergesort").reset_index(drop=True)
+            want=expected.sort_values(key,kind="mergesort").reset_index(drop=True)
+            pd.testing.assert_frame_equal(got,want,check_exact=False,rtol=1e-5)
+
+def test_time_chunks(backends):
+    def collect(backend):
+        times,service,waiting=[np.concatenate(i) for i in zip(*backend.time_chunks())]
+        order=np.lexsort((service,times))
+        return times[order],service[order].astype("float64"),waiting[order].astype("float64")
+    expected=collect(backends["frame"])
+    for name,backend in others(backends):
+        got=collect(backend)
+        assert np.array_equal(got[0],expected[0]),name
+        assert np.allclose(got[1],expected[1],rtol=1e-6) and np.allclose(got[2],expected[2],rtol=1e-6,equal_nan=True),name
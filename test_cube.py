@@ -0,0 +1,74 @@
+"""
+Aggregate cube (cube.py) against the rows of the ops table.
+"""
+import numpy as np
+import pytest
+from conftest import GT_EDGES, random_states
+from cube import AGE_WIDTH, LogSketch, OpsCube
+from filters import apply_filters, counts
+
+@pytest.fixture(scope="module")
+def cube(ops):
+    return OpsCube.from_frame(ops,gt_edges=GT_EDGES,sketch=LogSketch(0.01))
+
+def lower_quantile(values,q):
+    ##Lower interpolation point of the q quantile, the rank the sketches look for
+    values=np.sort(values[~np.isnan(values)])
+    return values[int(np.floor(q*(len(values)-1)))]
+
+def exact_trimmed_mean(values,q):
+    values=values[~np.isnan(values)]
+    return values[values<=lower_quantile(values,q)].mean()
+
+def test_covers(cube,ops):
+    for state in random_states(ops,30,seed=5):
+        assert cube.covers(state)==("full" in state.size or set(state.size)<=set(GT_EDGES))
+
+def test_counts_match_rows(cube,ops):
+    for state in random_states(ops,100,seed=6,on_grid=True):
+        rows=apply_filters(ops,state)
+        assert cube.code_counts(state).equals(counts(rows.code)),state
+        assert cube.port_counts(state).equals(counts(rows.bunkering_port)),state
+        starts,count=cube.age_histogram(state)
+        expected=np.bincount((rows.barge_age_at_op.values//AGE_WIDTH).astype("int64"))
+        assert np.array_equal(count,expected) and np.array_equal(starts,np.arange(len(expected))*AGE_WIDTH),state
+
+def test_port_summary_matches_rows(cube,ops):
+    sketch=cube.sketch
+    for state in random_states(ops,60,seed=7,on_grid=True):
+        rows=apply_filters(ops,state)
+        for code in rows.code.unique()[:3]:
+            port=rows[rows.code==code]
+            stats=cube.port_summary(state,code)
+            assert stats["ops"]==port.shape[0]
+            assert stats["age_sum"]==pytest.approx(port.barge_age_at_op.sum())
+            for col in ["service_time","waiting_time"]:
+                counts_,sums=sketch.histogram(port[col].values)
+                assert np.array_equal(stats[col][0],counts_)
+                assert np.allclose(stats[col][1],sums)
+                values=port[col].values.astype("float64")
+                ##Quantiles within the relative accuracy of the sketch, trimmed means close to it
+                exact=lower_quantile(values,0.95)
+                assert sketch.quantile(stats[col][0],0.95)==pytest.approx(exact,rel=sketch.alpha)
+                assert sketch.trimmed_mean(*stats[col],0.95)==pytest.approx(exact_trimmed_mean(values,0.95),
+                                                                            rel=sketch.alpha)
+
+def test_merge_matches_cube_of_all_rows(cube,ops):
+    split=ops.shape[0]*2//3
+    head=ops.iloc[:split].reset_index(drop=True)
+    tail=ops.iloc[split:].reset_index(drop=True)
+    first=OpsCube.from_frame(head,gt_edges=GT_EDGES,sketch=cube.sketch)
+    merged=first.merge(OpsCube.from_frame(tail,gt_edges=GT_EDGES,sketch=cube.sketch),ops)
+    for state in random_states(ops,40,seed=8,on_grid=True):
+        assert merged.code_counts(state).equals(cube.code_counts(state))
+        assert np.array_equal(merged.age_histogram(state)[1],cube.age_histogram(state)[1])
+        code=cube.ports[0]
+        a,b=merged.port_summary(state,code),cube.port_summary(state,code)
+        assert a["ops"]==b["ops"] and np.array_equal(a["service_time"][0],b["service_time"][0])
+
+def test_save_and_load(cube,ops,tmp_path):
+    path=str(tmp_path/"cube.npz")
+    cube.save(path)
+    loaded=OpsCube.load(path,ops)
+    for state in random_states(ops,20,seed=9,on_grid=True):
+        assert loaded.port_counts(state).equals(cube.port_counts(state))
@@ -0,0 +1,59 @@
+"""
+Shared filter stage (filters.py) against the filtering of the original panels.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from conftest import random_states
+from filters import FilterStore, apply_filters, counts, normalize_filters, query_filters
+
+def baseline(frame,state):
+    ##Filtering of the panels before the filter stage, row by row on the whole table
+    df_in=frame[frame.start_of_service.between(state.date_from,state.date_to)]
+    if "full" not in state.port:
+        df_in=df_in[df_in.code.isin(state.port)]
+    if "full" not in state.type_vessel:
+        df_in=df_in[df_in.ConType.isin(state.type_vessel)]
+    if "full" not in state.size:
+        df_in=df_in[(df_in.VesselGT>state.size[0])&(df_in.VesselGT<=state.size[1])]
+    return df_in
+
+def test_apply_filters_matches_baseline(ops):
+    for state in random_states(ops,100,seed=3):
+        expected=baseline(ops,state)
+        got=apply_filters(ops,state)
+        assert np.array_equal(got.index.values,expected.index.values),state
+
+def test_filter_store_shares_one_frame_per_selection(ops):
+    store=FilterStore(ops,maxsize=4)
+    states=random_states(ops,10,seed=4)
+    for state in states:
+        assert np.array_equal(store.get(state).index.values,baseline(ops,state).index.values)
+    assert store.get(states[-1]) is store.get(states[-1])
+    ##Least recently used selections are evicted
+    assert len(store._entries)==4
+
+def test_filter_store_needs_sorted_frame(ops):
+    with pytest.raises(ValueError):
+        FilterStore(ops.iloc[::-1])
+
+def test_normalize_filters_equivalent_selections():
+    a=normalize_filters("2016-01-01","2016-06-01",["ITGOA","ESALG","ITGOA"],[],None)
+    b=normalize_filters("2016-01-01","2016-06-01",["ESALG","ITGOA"],["full"],["full"])
+    assert a==b and hash(a)==hash(b)
+
+def test_query_filters():
+    args={"fr":["2016-01-01"],"port":["ESALG,GIGIB","ITGOA"],"size":["1000,50000"]}
+    state=query_filters(lambda name: args.get(name,[]),"01-01-2014","01-06-2019")
+    assert state==normalize_filters("2016-01-01","01-06-2019",["ESALG","GIGIB","ITGOA"],None,[1000.0,50000.0])
+    for size in ["1000","a,b"]:
+        with pytest.raises(ValueError):
+            query_filters(lambda name: {"size":[size]}.get(name,[]),"01-01-2014","01-06-2019")
+    with pytest.raises(ValueError):
+        query_filters(lambda name: {"fr":["not a date"]}.get(name,[]),"01-01-2014","01-06-2019")
+
+def test_counts_ties_in_category_order():
+    values=pd.Series(pd.Categorical(["b","a","b","a","c"],categories=["c","b","a","d"]),name="code")
+    count=counts(values)
+    assert count.index.tolist()==["b","a","c"] and count.tolist()==[2,2,1]
+    assert counts(pd.Series(["b","a","b","a","c"])).index.tolist()==["a","b","c"]
@@ -0,0 +1,84 @@
+"""
+Appending new ops files to the ops table (ingest.py).
+"""
+import numpy as np
+import pandas as pd
+import pytest
+import store
+from benchmark import synthetic_ops
+from conftest import DATA
+from ingest import Ingestor
+
+@pytest.fixture
+def raw():
+    ##Raw rows with a column beyond store.OPS_COLUMNS, kept by the cleaning
+    raw=synthetic_ops(3000,store.load("ports",DATA),seed=1)
+    return raw.assign(vessel_imo=np.arange(raw.shape[0])+9500000)
+
+def split(raw,at="2019-01-01"):
+    return raw[raw.start_of_service<at].reset_index(drop=True),raw[raw.start_of_service>=at].reset_index(drop=True)
+
+def ingestor(base,directory):
+    updates=[]
+    frame=store.freeze(store.clean_ops(base.copy()))
+    return Ingestor(frame,str(directory),lambda frame,rows: updates.append(rows)),updates
+
+def test_append_matches_cleaning_all_rows(raw,tmp_path):
+    base,new=split(raw)
+    ingest,updates=ingestor(base,tmp_path)
+    new.to_csv(tmp_path/"new.csv",index=False)
+    result=ingest.scan()
+    assert result["appended"]==new.shape[0] and result["files"]==[("new.csv",dict(accepted=new.shape[0],rejected=0))]
+    assert len(updates)==1
+    expected=store.clean_ops(raw.copy())
+    got=ingest.frame
+    assert list(got.columns)==list(expected.columns)
+    assert got.shape[0]==expected.shape[0]
+    assert (got.start_of_service.values==expected.start_of_service.values).all()
+    assert sorted(got.vessel_imo)==sorted(expected.vessel_imo)
+    assert got.code.value_counts().sort_index().equals(expected.code.value_counts().sort_index())
+    ##Files already seen are not appended twice
+    assert ingest.scan()["appended"]==0
+
+def test_columns_absent_from_the_file_are_missing(raw,tmp_path):
+    base,new=split(raw)
+    ingest,_=ingestor(base,tmp_path)
+    new.drop(columns="vessel_imo").to_csv(tmp_path/"new.csv",index=False)
+    assert ingest.scan()["appended"]==new.shape[0]
+    tail=ingest.frame[ingest.frame.start_of_service>="2019-01-01"]
+    assert tail.vessel_imo.isna().all()
+    assert ingest.frame.vessel_imo.notna().sum()==ingest.frame.shape[0]-new.shape[0]
+
+def test_invalid_rows_and_files(raw,tmp_path):
+    base,new=split(raw)
+    ingest,updates=ingestor(base,tmp_path)
+    new.loc[:9,"start_of_service"]="not a date"
+    new.to_csv(tmp_path/"a.csv",index=False)
+    new.drop(columns="code").to_csv(tmp_path/"b.csv",index=False)
+    files=dict(ingest.scan()["files"])
+    assert files["a.csv"]==dict(accepted=new.shape[0]-10,rejected=10)
+    assert "missing columns: code" in files["b.csv"]
+    assert len(updates)==1
+
+def test_failed_update_keeps_the_table(raw,tmp_path):
+    base,new=split(raw)
+    frame=store.freeze(store.clean_ops(base.copy()))
+
+    def fail(frame,rows):
+        raise RuntimeError("swap failed")
+    ingest=Ingestor(frame,str(tmp_path),fail)
+    port_ops=dict(ingest.port_ops)
+    new.to_csv(tmp_path/"new.csv",index=False)
+    result=ingest.scan()
+    assert result["appended"]==0 and result["files"][0][1]=="not appended: swap failed"
+    assert ingest.frame is frame and ingest.port_ops==port_ops
+
+def test_rows_of_small_ports_are_held(raw,tmp_path):
+    base,new=split(raw)
+    ingest,_=ingestor(base,tmp_path)
+    few=new.iloc[:5].assign(bunkering_port="Nowhere",code="XXNOW")
+    few.to_csv(tmp_path/"a.csv",index=False)
+    assert ingest.scan()==dict(appended=0,held=5,files=[("a.csv",dict(accepted=5,rejected=0))])
+    pd.concat([few]*6).to_csv(tmp_path/"b.csv",index=False)
+    assert ingest.scan()["appended"]==35
+    assert (ingest.frame.code=="XXNOW").sum()==35
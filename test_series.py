@@ -0,0 +1,35 @@
+"""
+Series of the operations and the Brent price (series.py).
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from series import SeriesStore, epoch_day, period_starts
+
+@pytest.fixture(scope="module")
+def series(ops):
+    times=ops.start_of_service.values
+    brent=pd.date_range("2014-01-01","2019-06-30",freq="B")
+    return SeriesStore.build([(times,ops.service_time.values,ops.waiting_time.values)],
+                             brent,np.linspace(60,80,len(brent)))
+
+@pytest.mark.parametrize("resolution,expected",[("D",["2019-04-29","2019-04-30","2019-05-01","2019-05-02"]),
+                                                ("W",["2019-04-29"]),
+                                                ("M",["2019-04-29","2019-05-01"])])
+def test_period_starts(resolution,expected):
+    ##From a Monday to the Thursday after, the first period moved to the first day
+    starts=period_starts(epoch_day("2019-04-29"),epoch_day("2019-05-02"),resolution)
+    assert [str(i) for i in starts.astype("datetime64[D]")]==expected
+
+def test_inverted_range_has_no_periods(series):
+    for resolution in ["D","W","M"]:
+        assert len(period_starts(epoch_day("2019-05-02"),epoch_day("2019-05-01"),resolution))==0
+        assert series.table("2019-05-02","2019-05-01",resolution).empty
+
+def test_table_matches_rows(series,ops):
+    table=series.table("2015-03-10","2016-02-20","M")
+    rows=ops[ops.start_of_service.between("2015-03-10","2016-02-20 23:59:59")]
+    assert table.index[0]==pd.Timestamp("2015-03-10") and len(table)==12
+    assert table.ops.sum()==rows.shape[0]
+    month=rows.start_of_service.dt.to_period("M")
+    assert np.allclose(table.service.values,rows.groupby(month).service_time.mean().values)
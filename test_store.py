@@ -0,0 +1,20 @@
+"""
+Cleaning and compact layout of the ops table (store.py).
+"""
+import numpy as np
+import store
+from benchmark import synthetic_ops
+from conftest import DATA
+
+def test_compact_gt():
+    raw=synthetic_ops(2000,store.load("ports",DATA),seed=2)
+    assert store.clean_ops(raw.copy()).VesselGT.dtype.kind=="i"
+    ##Missing GT values are kept in float32, other values are exact
+    raw["VesselGT"]=raw.VesselGT.astype("float64")
+    raw.loc[:49,"VesselGT"]=np.nan
+    ops=store.clean_ops(raw.copy())
+    assert ops.VesselGT.dtype=="float32" and ops.VesselGT.isna().any()
+    assert np.isin(ops.VesselGT.dropna().values.astype("float64"),raw.VesselGT.values).all()
+    ##Fractions that float32 rounds stay float64
+    raw.loc[60,"VesselGT"]=1000.1
+    assert store.clean_ops(raw.copy()).VesselGT.dtype=="float64"